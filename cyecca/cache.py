@@ -0,0 +1,166 @@
+import functools
+import hashlib
+import json
+import os
+import sys
+
+import casadi as ca
+
+__all__ = ["cached", "clear", "source_hash"]
+
+# the cache is stored in CYECCA_CACHE_DIR, set CYECCA_CACHE=0 to disable it
+cache_dir = os.environ.get(
+    "CYECCA_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "cyecca", "functions"),
+)
+enabled = os.environ.get("CYECCA_CACHE", "1") != "0"
+
+_source_hash = None
+
+
+def source_hash():
+    """
+    Hash of the source of the cyecca package
+
+    Derivations reach into many modules (lie groups, symbolic series,
+    shared symbols), so any change to the package invalidates the cache.
+    """
+    global _source_hash
+    if _source_hash is None:
+        root = os.path.dirname(os.path.abspath(__file__))
+        h = hashlib.sha1()
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.endswith(".py"):
+                    path = os.path.join(dirpath, name)
+                    h.update(os.path.relpath(path, root).encode())
+                    with open(path, "rb") as f:
+                        h.update(f.read())
+        _source_hash = h.hexdigest()
+    return _source_hash
+
+
+def _module_constants(module):
+    """
+    Module level numbers and strings, these may be changed at runtime
+    """
+    return {
+        k: v
+        for k, v in vars(module).items()
+        if not k.startswith("_") and isinstance(v, (bool, int, float, str))
+    }
+
+
+def _layout(value, functions):
+    """
+    JSON layout of a result, functions are replaced by their index in the
+    functions list
+    """
+    if isinstance(value, ca.Function):
+        functions.append(value)
+        return ["function", len(functions) - 1]
+    if isinstance(value, dict) and all(isinstance(k, str) for k in value.keys()):
+        return ["dict", {k: _layout(v, functions) for k, v in value.items()}]
+    if isinstance(value, (list, tuple)):
+        return [type(value).__name__, [_layout(v, functions) for v in value]]
+    raise TypeError("cannot cache {:s}".format(str(type(value))))
+
+
+def _restore(layout, functions):
+    kind, value = layout
+    if kind == "function":
+        return functions[value]
+    if kind == "dict":
+        return {k: _restore(v, functions) for k, v in value.items()}
+    if kind == "list":
+        return [_restore(v, functions) for v in value]
+    return tuple(_restore(v, functions) for v in value)
+
+
+def _save(path, result):
+    """
+    Writes a result with the casadi FileSerializer, raises TypeError if it
+    holds anything but functions
+    """
+    functions = []
+    layout = json.dumps(_layout(result, functions))
+    tmp = "{:s}.{:d}.tmp".format(path, os.getpid())
+    s = ca.FileSerializer(tmp)
+    s.pack(layout)
+    s.pack(functions)
+    del s  # flushes and closes the file
+    os.replace(tmp, path)
+
+
+def _load(path):
+    d = ca.FileDeserializer(path)
+    layout = json.loads(d.unpack())
+    return _restore(layout, d.unpack())
+
+
+def cached(f):
+    """
+    Decorator caching the casadi functions returned by a derivation
+
+    The result, a ca.Function or a dict, list or tuple of them, is stored
+    with the casadi FileSerializer, no pickle is loaded from the cache
+    directory. The key hashes the cyecca source, the module level constants
+    of f's module, the arguments and the casadi version, so the cache
+    invalidates when the code changes. Arguments must be JSON serializable,
+    anything else raises TypeError rather than keying on a repr that may
+    differ between runs. Side effects of f only happen when it is derived.
+    """
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return f(*args, **kwargs)
+        module = sys.modules[f.__module__]
+        try:
+            key = json.dumps(
+                [
+                    f.__module__,
+                    f.__qualname__,
+                    source_hash(),
+                    _module_constants(module),
+                    args,
+                    kwargs,
+                    ca.__version__,
+                ],
+                sort_keys=True,
+            )
+        except TypeError as e:
+            raise TypeError(
+                "{:s} is cached, its arguments must be JSON serializable: {:s}".format(
+                    f.__qualname__, str(e)
+                )
+            ) from e
+        key = hashlib.sha1(key.encode()).hexdigest()
+        path = os.path.join(cache_dir, "{:s}_{:s}.casadi".format(f.__name__, key))
+        if os.path.exists(path):
+            try:
+                return _load(path)
+            except Exception:
+                pass  # corrupt or incompatible entry, derive again
+        result = f(*args, **kwargs)
+        os.makedirs(cache_dir, exist_ok=True)
+        try:
+            _save(path, result)
+        except TypeError:
+            pass
+        return result
+
+    wrapper.uncached = f
+    return wrapper
+
+
+def clear():
+    """
+    Removes all cached functions
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    for f in os.listdir(cache_dir):
+        if f.endswith(".casadi"):
+            os.remove(os.path.join(cache_dir, f))
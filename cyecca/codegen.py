@@ -1,8 +1,507 @@
-import casadi as ca
+import ctypes
+import hashlib
+import importlib.util
+import json
+import multiprocessing as mp
+import os
 import pathlib
+import re
+import shutil
+import subprocess
+import tempfile
+
+import casadi as ca
+import numpy as np
+from beartype.typing import Optional
+
+
+manifest_file = "manifest.json"
+cost_report_file = "cost_report.json"
+default_flags = ("-O2",)  # compiler flags when flags is None
+
+
+def _hash_functions(functions):
+    """
+    Hash of each function from its serialized form
+    """
+    return {
+        f.name(): hashlib.sha1(f.serialize().encode()).hexdigest() for f in functions
+    }
+
+
+_bench_template = """\
+/* benchmark of {name:s}.c, generated by cyecca.codegen */
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+#if defined(__x86_64__) || defined(__i386__)
+#include <x86intrin.h>
+#define CYECCA_CYCLES() ((double)__rdtsc())
+#else
+#define CYECCA_CYCLES() (-1.0)
+#endif
+
+#include "{name:s}.c"
+
+static double cyecca_now_ns(void) {{
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (double)ts.tv_sec * 1000000000L + ts.tv_nsec; /* no float constants */
+}}
+{functions:s}
+int main(int argc, char* argv[]) {{
+  long n = argc > 1 ? atol(argv[1]) : {n:d};
+{calls:s}  return 0;
+}}
+"""
+
+_bench_function_template = """
+static void bench_{f:s}(long n) {{
+{inputs:s}  static casadi_real res_data[{sz_res_data:d}];
+  static const casadi_real* arg[{sz_arg:d}];
+  static casadi_real* res[{sz_res:d}];
+  static casadi_int iw[{sz_iw:d}];
+  static casadi_real w[{sz_w:d}];
+  long i;
+  double t0, t1, c0, c1;
+{setup:s}  for (i = 0; i < n / 10 + 1; i++) {f:s}(arg, res, iw, w, 0); /* warm up */
+  t0 = cyecca_now_ns();
+  c0 = CYECCA_CYCLES();
+  for (i = 0; i < n; i++) {{
+    {f:s}(arg, res, iw, w, 0);
+    __asm__ volatile("" ::: "memory"); /* keep every call */
+  }}
+  c1 = CYECCA_CYCLES();
+  t1 = cyecca_now_ns();
+  printf("{{\\"unit\\": \\"{unit:s}\\", \\"function\\": \\"{f:s}\\", "
+         "\\"n\\": %ld, \\"ns_per_call\\": %.3f, \\"cycles_per_call\\": %.3f}}\\n",
+         n, (t1 - t0) / n, c0 < 0 ? -1.0 : (c1 - c0) / n);
+}}
+"""
+
+
+def _bench_inputs(f, inputs=None):
+    """
+    Nonzeros of each input of f, from inputs or uniform in [-1, 1]
+    """
+    rng = np.random.default_rng(0)
+    values = []
+    for i in range(f.n_in()):
+        sp = f.sparsity_in(i)
+        if inputs is None:
+            values.append(rng.uniform(-1, 1, sp.nnz()))
+        else:
+            a = ca.DM(inputs[i])
+            if a.sparsity() != sp:
+                a = ca.project(ca.reshape(a, sp.size1(), sp.size2()), sp)
+            values.append(np.array(a.nonzeros(), dtype=float))
+    return values
+
+
+def _bench_source(name, functions, inputs, n=100000):
+    """
+    C source of a main calling each function of a unit in a tight loop
+
+    Each function prints one json line with the mean ns and cycles per call.
+    """
+    source = []
+    calls = []
+    for f in functions:
+        fn = f.name()
+        lines = []
+        setup = []
+        offset = 0
+        for i, v in enumerate(_bench_inputs(f, inputs.get(fn))):
+            if len(v) == 0:
+                setup.append("  arg[{:d}] = 0;\n".format(i))
+                continue
+            data = ", ".join(repr(float(x)) for x in v)
+            lines.append(
+                "  static const casadi_real arg{:d}[{:d}] = {{{:s}}};\n".format(
+                    i, len(v), data
+                )
+            )
+            setup.append("  arg[{:d}] = arg{:d};\n".format(i, i))
+        for i in range(f.n_out()):
+            setup.append("  res[{:d}] = res_data + {:d};\n".format(i, offset))
+            offset += f.sparsity_out(i).nnz()
+        source.append(
+            _bench_function_template.format(
+                f=fn,
+                unit=name,
+                inputs="".join(lines),
+                setup="".join(setup),
+                sz_res_data=max(offset, 1),
+                sz_arg=max(f.sz_arg(), 1),
+                sz_res=max(f.sz_res(), 1),
+                sz_iw=max(f.sz_iw(), 1),
+                sz_w=max(f.sz_w(), 1),
+            )
+        )
+        calls.append("  bench_{:s}(n);\n".format(fn))
+    return _bench_template.format(
+        name=name, functions="".join(source), calls="".join(calls), n=n
+    )
+
+
+_bindings_template = """\
+\"\"\"
+ctypes bindings of {name:s}.c, generated by cyecca.codegen
+
+Build the library with build_bindings. Each function keeps preallocated
+numpy buffers, a call copies the arguments into the input buffers and
+returns the output buffers, so calls do not allocate arrays. Outputs are
+dense 2d arrays like np.array of a DM, they are overwritten by the next
+call of the same function, copy them to keep them.
+\"\"\"
+
+import ctypes
+import os
+
+import numpy as np
+
+real = np.{real:s}
+library = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lib{name:s}.so")
+
+
+class Function:
+    def __init__(self, lib, name, names_in, names_out, sparsity_in, sparsity_out, sz):
+        \"\"\"
+        :param sparsity_in: list of (shape, nz) of the inputs, nz is None if
+            dense, else the rows and columns of the nonzeros
+        :param sparsity_out: list of (shape, nz) of the outputs
+        :param sz: sz_arg, sz_res, sz_iw, sz_w of the function
+        \"\"\"
+        self.name = name
+        self.names_in = names_in
+        self.names_out = names_out
+        self._c = getattr(lib, name)
+        self._c.restype = ctypes.c_int
+        self._c.argtypes = [ctypes.c_void_p] * 4 + [ctypes.c_int]
+        sz_arg, sz_res, sz_iw, sz_w = sz
+
+        def nnz(shape, nz):
+            return shape[0] * shape[1] if nz is None else len(nz[0])
+
+        # nonzeros, column-major, passed to c
+        self.args = [np.zeros(nnz(*sp), dtype=real) for sp in sparsity_in]
+        self.res = [np.zeros(nnz(*sp), dtype=real) for sp in sparsity_out]
+        self._shape_in = [shape for shape, nz in sparsity_in]
+        self._nz_in = [nz for shape, nz in sparsity_in]
+        self._nz_out = [nz for shape, nz in sparsity_out]
+        self._views = [
+            a.reshape(shape, order="F") if nz is None else None
+            for a, (shape, nz) in zip(self.args, sparsity_in)
+        ]
+        self.out = tuple(
+            r.reshape(shape, order="F") if nz is None else np.zeros(shape, dtype=real)
+            for r, (shape, nz) in zip(self.res, sparsity_out)
+        )
+        self._sparse_out = [
+            (r, self.out[i], nz)
+            for i, (r, nz) in enumerate(zip(self.res, self._nz_out))
+            if nz is not None
+        ]
+        self.iw = np.zeros(max(sz_iw, 1), dtype=np.int64)
+        self.w = np.zeros(max(sz_w, 1), dtype=real)
+        self._arg = (ctypes.c_void_p * max(sz_arg, 1))()
+        self._res = (ctypes.c_void_p * max(sz_res, 1))()
+        for i, a in enumerate(self.args):
+            self._arg[i] = a.ctypes.data if a.size > 0 else None
+        for i, r in enumerate(self.res):
+            self._res[i] = r.ctypes.data if r.size > 0 else None
+        self._iw = self.iw.ctypes.data
+        self._w = self.w.ctypes.data
+
+    def call(self):
+        \"\"\"
+        Evaluates on the current input nonzeros, self.args, the output
+        nonzeros are in self.res
+        \"\"\"
+        if self._c(self._arg, self._res, self._iw, self._w, 0):
+            raise RuntimeError(self.name + " failed")
+        for r, out, nz in self._sparse_out:
+            out[nz] = r
+
+    def __call__(self, *args, **kwargs):
+        \"\"\"
+        Evaluates on args, 2d args are matrices, 1d or scalar args are
+        the nonzeros, column-major
+
+        As for a casadi Function, a 1 x 1 arg fills the input and a vector
+        input takes a row or a column vector. A call by keyword, or without
+        arguments, returns a dict of the outputs by name.
+        \"\"\"
+        by_name = len(args) == 0
+        if by_name:
+            args = [kwargs.get(k, 0) for k in self.names_in]
+        for i, v in enumerate(args):
+            a = self.args[i]
+            if np.ndim(v) != 2:
+                a[...] = v
+                continue
+            shape = self._shape_in[i]
+            v = np.asarray(v)
+            if v.shape != shape and v.size != 1:
+                if 1 not in shape or v.size != shape[0] * shape[1]:
+                    raise ValueError(
+                        "%s input %s is %dx%d, expected %dx%d"
+                        % ((self.name, self.names_in[i]) + v.shape + tuple(shape))
+                    )
+                v = v.reshape(shape)  # transposed vector
+            if self._views[i] is not None:
+                self._views[i][...] = v
+            else:
+                a[...] = np.broadcast_to(v, shape)[self._nz_in[i]]
+        self.call()
+        if by_name:
+            return dict(zip(self.names_out, self.out))
+        return self.out[0] if len(self.out) == 1 else self.out
+
+
+_lib = ctypes.CDLL(library)
+{functions:s}
+functions = {{{names:s}}}
+"""
+
+
+def _bindings_sparsity(sp):
+    if sp.is_dense():
+        return (sp.size(), None)
+    rows, cols = sp.get_triplet()
+    return (sp.size(), (rows, cols))
+
+
+def _bindings_source(name, functions, real="double"):
+    """
+    Source of a python module binding the functions of a unit with ctypes
+    """
+    source = []
+    for f in functions:
+        sp_in = [_bindings_sparsity(f.sparsity_in(i)) for i in range(f.n_in())]
+        sp_out = [_bindings_sparsity(f.sparsity_out(i)) for i in range(f.n_out())]
+        sz = (f.sz_arg(), f.sz_res(), f.sz_iw(), f.sz_w())
+        args = [f.name(), f.name_in(), f.name_out(), sp_in, sp_out, sz]
+        source.append(
+            "{:s} = Function(\n    _lib,\n{:s})\n".format(
+                f.name(), "".join("    {!r},\n".format(a) for a in args)
+            )
+        )
+    names = ", ".join("{0!r}: {0:s}".format(f.name()) for f in functions)
+    return _bindings_template.format(
+        name=name,
+        real={"double": "float64", "float": "float32"}[real],
+        functions="".join(source),
+        names=names,
+    )
+
+
+def _generate_unit(args):
+    name, functions, p, dest_dir, bench, bindings = args
+    gen = ca.CodeGenerator(name + ".c", p)
+    for f in functions:
+        gen.add(f)
+    gen.generate(str(dest_dir) + os.sep)
+    if p["casadi_real"] == "float":
+        path = os.path.join(dest_dir, name + ".c")
+        with open(path, "r") as f:
+            source = f.read()
+        with open(path, "w") as f:
+            f.write(_single_precision(source))
+    files = [name + ".c"]
+    if p["with_header"]:
+        files.append(name + ".h")
+    if bench is not None:
+        with open(os.path.join(dest_dir, name + "_bench.c"), "w") as f:
+            f.write(_bench_source(name, functions, bench))
+        files.append(name + "_bench.c")
+    if bindings:
+        with open(os.path.join(dest_dir, name + "_py.py"), "w") as f:
+            f.write(_bindings_source(name, functions, p["casadi_real"]))
+        files.append(name + "_py.py")
+    return name, files
+
+
+_op_names = {getattr(ca, k): k[3:].lower() for k in dir(ca) if k.startswith("OP_")}
+_trig_ops = {"sin", "cos", "tan", "asin", "acos", "atan", "atan2"}
+_trig_ops |= {"sinh", "cosh", "tanh", "asinh", "acosh", "atanh"}
+_data_ops = {"input", "output", "const", "parameter"}
+
+
+def count_instructions(f):
+    """
+    Instruction count by opcode, from the algorithm of the function
+
+    MX functions are expanded to SX when possible, so counts are scalar
+    operations. A fast replacement for util.count_ops.
+    """
+    if not f.is_a("SXFunction"):
+        try:
+            f = f.expand()
+        except RuntimeError:
+            pass  # external or non expandable calls, count MX nodes
+    counts = {}
+    for k in range(f.n_instructions()):
+        op = _op_names.get(f.instruction_id(k), str(f.instruction_id(k)))
+        counts[op] = counts.get(op, 0) + 1
+    return counts
+
+
+_c_function = re.compile(
+    r"^static int (casadi_f\d+)\(const casadi_real\*\* arg.*?\{\n(.*?)^\}$",
+    re.M | re.S,
+)
+_c_declaration = re.compile(r"^  (?:const )?(casadi_real|casadi_int|int)\b(.*);$")
+
+
+def _declared_bytes(body, sizes):
+    """
+    Bytes of the locals declared at the top of a generated function body
+    """
+    n = 0
+    for line in body.splitlines():
+        m = _c_declaration.match(line)
+        if m is None:
+            break
+        for decl in m.group(2).split(","):
+            decl = decl.split("=")[0].strip()
+            if decl.startswith("*"):
+                n += sizes["pointer"]
+            elif "[" in decl:
+                n += sizes[m.group(1)] * int(decl[decl.index("[") + 1 : -1])
+            else:
+                n += sizes[m.group(1)]
+    return n
+
+
+def stack_estimate(f, avoid_stack: bool, real_size: int = 8) -> int:
+    """
+    Stack bytes of the generated code of a function, from the locals each
+    generated function declares, along the deepest chain of calls to
+    subfunctions, e.g. of MX call nodes
+
+    Return addresses and register spills are not counted, the work vectors
+    and argument/result pointer arrays are supplied by the caller.
+    """
+    gen = ca.CodeGenerator("stack.c", {"avoid_stack": avoid_stack})
+    gen.add(f)
+    source = gen.dump()
+    sizes = {"casadi_real": real_size, "casadi_int": 8, "int": 4, "pointer": 8}
+    frames = {}
+    for name, body in _c_function.findall(source):
+        callees = set(re.findall(r"\b(casadi_f\d+)\(", body)) - {name}
+        frames[name] = (_declared_bytes(body, sizes), callees)
+
+    def depth(name):
+        own, callees = frames[name]
+        return own + max([depth(c) for c in callees], default=0)
+
+    entry = re.search(
+        r"int {:s}\(const casadi_real\*\* arg.*?return (casadi_f\d+)\(".format(
+            re.escape(f.name())
+        ),
+        source,
+        re.S,
+    )
+    return depth(entry.group(1))
+
 
+def function_cost(f, real_size=8):
+    """
+    Cost of the generated code of a function
 
-def generate_code(eqs: dict, dest_dir: str, **kwargs):
+    The stack usage is estimated from the generated code with and without
+    avoid_stack, see stack_estimate. Without avoid_stack an SX function
+    declares its sz_w temporaries as casadi_real locals, with avoid_stack
+    it works in the caller supplied w array.
+    """
+    ops = count_instructions(f)
+    return {
+        "ops": ops,
+        "flops": sum(n for op, n in ops.items() if op not in _data_ops),
+        "trig": sum(n for op, n in ops.items() if op in _trig_ops),
+        "sqrt": ops.get("sqrt", 0),
+        "sz_w": int(f.sz_w()),
+        "sz_iw": int(f.sz_iw()),
+        "sz_arg": int(f.sz_arg()),
+        "sz_res": int(f.sz_res()),
+        "stack_avoid_stack": stack_estimate(f, True, real_size),
+        "stack": stack_estimate(f, False, real_size),
+    }
+
+
+def cost_report(eqs: dict, real_size: int = 8):
+    """
+    Cost of each function, as a dict of unit name to function name to cost
+    """
+    return {
+        name: {
+            eq[f_name].name(): function_cost(eq[f_name], real_size=real_size)
+            for f_name in eq
+        }
+        for name, eq in eqs.items()
+    }
+
+
+def compare_cost(report: dict, baseline: dict, tol: float = 0.0):
+    """
+    Lists the costs that grew more than the relative tol over the baseline
+
+    :return: list of (unit, function, metric, baseline, new)
+    """
+    regressions = []
+    for name, functions in report.items():
+        for f_name, cost in functions.items():
+            old = baseline.get(name, {}).get(f_name)
+            if old is None:
+                continue
+            for metric, value in cost.items():
+                if metric == "ops" or metric not in old:
+                    continue
+                if value > old[metric] * (1 + tol):
+                    regressions.append((name, f_name, metric, old[metric], value))
+    return regressions
+
+
+def generate_code(
+    eqs: dict,
+    dest_dir: str,
+    jobs: int = None,
+    baseline: str = None,
+    benchmark: bool = False,
+    bench_inputs: dict = None,
+    bindings: bool = False,
+    **kwargs,
+):
+    """
+    Generates a C translation unit for each group of casadi functions
+
+    :param eqs: dict of unit name to dict of functions, written to <name>.c
+    :param dest_dir: output directory
+    :param jobs: number of processes, defaults to the number of cpus
+    :param baseline: optional cost report json to compare against
+    :param benchmark: also write <name>_bench.c, a standalone main timing
+        each function of the unit, see run_benchmark
+    :param bench_inputs: optional dict of function name to input tuple for
+        the benchmark, e.g. a sample from record_inputs, inputs default to
+        uniform random values in [-1, 1]
+    :param bindings: also write <name>_py.py, a ctypes module calling the
+        functions on preallocated numpy buffers, see build_bindings
+    :param kwargs: ca.CodeGenerator options, casadi_real="float" generates
+        single precision code, compile it with -fsingle-precision-constant
+    :return: the manifest
+
+    Each function is hashed from its serialized form. A unit is only
+    regenerated when its functions, the options or the casadi version
+    changed, stale units are generated in parallel. The manifest.json
+    written to dest_dir lists per unit its hash, files and function
+    hashes, and the units changed by this call, so a firmware build can
+    recompile only those. Units from earlier calls into dest_dir are kept,
+    so several modules can share a directory. A cost report of every
+    function is written to cost_report.json, cost increases of the units of
+    this call over the baseline are listed in the manifest under
+    regressions.
+    """
     dest_dir = pathlib.Path(dest_dir)
     p = {
         "verbose": True,
@@ -15,18 +514,393 @@ def generate_code(eqs: dict, dest_dir: str, **kwargs):
         "with_import": False,
         "include_math": True,
         "avoid_stack": True,
+        "casadi_real": "double",
     }
     for k, v in kwargs.items():
         assert k in p.keys()
         p[k] = v
+    if p["with_mem"]:
+        try:
+            ca.CodeGenerator("probe.c", {"with_mem": True})
+        except RuntimeError:
+            # newer casadi only supports with_mem with canonical code
+            p["force_canonical"] = True
+    dest_dir.mkdir(parents=True, exist_ok=True)
 
+    # previous manifest
+    manifest_path = dest_dir / manifest_file
+    old_units = {}
+    if manifest_path.exists():
+        with open(manifest_path, "r") as f:
+            old_units = json.load(f).get("units", {})
+
+    if bench_inputs is None:
+        bench_inputs = {}
+    # units of earlier calls into the same directory are kept
+    units = dict(old_units)
+    todo = []
     for name, eq in eqs.items():
-        filename = "{:s}.c".format(name)
-        gen = ca.CodeGenerator(filename, p)
-        for f_name in eq:
-            gen.add(eq[f_name])
+        functions = [eq[f_name] for f_name in eq]
+        f_hashes = _hash_functions(functions)
+        key = [p, list(f_hashes.items()), ca.__version__]
+        bench = None
+        if benchmark:
+            bench = {
+                f.name(): [np.array(a).tolist() for a in bench_inputs[f.name()]]
+                for f in functions
+                if f.name() in bench_inputs
+            }
+            key.append(bench)
+        if bindings:
+            key.append("bindings")
+        h = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        old = old_units.get(name, {})
+        files = old.get("files", [])
+        if (
+            old.get("hash") == h
+            and len(files) > 0
+            and all((dest_dir / f).exists() for f in files)
+        ):
+            units[name] = old
+            continue
+        units[name] = {"hash": h, "functions": f_hashes}
+        todo.append((name, functions, p, dest_dir, bench, bindings))
+
+    if jobs is None:
+        jobs = os.cpu_count()
+    if len(todo) > 1 and jobs > 1:
+        with mp.Pool(min(jobs, len(todo))) as pool:
+            results = pool.map(_generate_unit, todo)
+    else:
+        results = [_generate_unit(args) for args in todo]
+    for name, files in results:
+        units[name]["files"] = files
+        # files the unit no longer produces, e.g. a dropped benchmark
+        for f in old_units.get(name, {}).get("files", []):
+            if f not in files and (dest_dir / f).exists():
+                (dest_dir / f).unlink()
+
+    manifest = {
+        "casadi": ca.__version__,
+        "options": p,
+        "units": units,
+        "changed": [name for name, files in results],
+    }
+
+    # cost report, merged with the units of earlier calls
+    report = cost_report(eqs, real_size=4 if p["casadi_real"] == "float" else 8)
+    report_all = {}
+    if (dest_dir / cost_report_file).exists():
+        with open(dest_dir / cost_report_file, "r") as f:
+            report_all = json.load(f)
+    report_all.update(report)
+    with open(str(dest_dir / cost_report_file) + ".tmp", "w") as f:
+        json.dump(report_all, f, indent=2, sort_keys=True)
+    os.replace(str(dest_dir / cost_report_file) + ".tmp", dest_dir / cost_report_file)
+    if baseline is not None:
+        with open(baseline, "r") as f:
+            manifest["regressions"] = compare_cost(report, json.load(f))
+        for r in manifest["regressions"]:
+            print("cost regression {:s}/{:s} {:s}: {} -> {}".format(*r))
+    with open(str(manifest_path) + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(str(manifest_path) + ".tmp", manifest_path)
+    return manifest
+
+
+def run_benchmark(
+    dest_dir: str,
+    name: str,
+    compiler: str = "gcc",
+    flags: Optional[list] = None,
+    n: int = None,
+):
+    """
+    Builds and runs the benchmark of a unit written by generate_code
+
+    :param dest_dir: directory passed to generate_code with benchmark=True
+    :param name: unit name
+    :param n: number of calls per function, the generated default if None
+    :return: dict of function name to n, ns_per_call and cycles_per_call,
+        cycles are -1 where no cycle counter is available
+    """
+    if flags is None:
+        flags = default_flags
+    dest_dir = pathlib.Path(dest_dir)
+    with open(dest_dir / manifest_file, "r") as f:
+        options = json.load(f)["options"]
+    # with_mem code includes casadi/mem.h
+    cmd = [compiler] + list(flags) + ["-I", ca.GlobalOptions.getCasadiIncludePath()]
+    if options["casadi_real"] == "float":
+        cmd.append("-fsingle-precision-constant")
+    exe = str(dest_dir / (name + "_bench"))
+    subprocess.run(
+        cmd + [str(dest_dir / (name + "_bench.c")), "-o", exe, "-lm"], check=True
+    )
+    args = [exe] if n is None else [exe, str(n)]
+    out = subprocess.run(args, check=True, capture_output=True, text=True).stdout
+    results = {}
+    for line in out.splitlines():
+        r = json.loads(line)
+        results[r.pop("function")] = r
+    return results
+
+
+def build_bindings(
+    dest_dir: str, name: str, compiler: str = "gcc", flags: Optional[list] = None
+):
+    """
+    Builds the library of a unit written by generate_code with bindings=True
+    and imports its binding module
+
+    :return: the module, its functions dict maps function names to callables
+    """
+    if flags is None:
+        flags = default_flags
+    dest_dir = pathlib.Path(dest_dir)
+    with open(dest_dir / manifest_file, "r") as f:
+        options = json.load(f)["options"]
+    cmd = [compiler] + list(flags) + ["-fPIC", "-shared"]
+    cmd += ["-I", ca.GlobalOptions.getCasadiIncludePath()]
+    if options["casadi_real"] == "float":
+        cmd.append("-fsingle-precision-constant")
+    lib = dest_dir / ("lib" + name + ".so")
+    tmp = "{:s}.{:d}.tmp".format(str(lib), os.getpid())
+    subprocess.run(cmd + [str(dest_dir / (name + ".c")), "-o", tmp, "-lm"], check=True)
+    os.replace(tmp, lib)
+    return _import_bindings(dest_dir, name)
+
+
+def _import_bindings(dest_dir, name):
+    path = pathlib.Path(dest_dir) / (name + "_py.py")
+    spec = importlib.util.spec_from_file_location(name + "_py", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_bindings(
+    eqs: dict,
+    name: str = "cyecca_bindings",
+    compiler: str = "gcc",
+    flags: Optional[list] = None,
+    cache_dir: Optional[str] = None,
+    real: str = "double",
+):
+    """
+    Generates, builds and imports ctypes bindings of a dict of functions
+
+    Like compile_and_load, but the returned callables work on preallocated
+    numpy buffers instead of converting to and from DM. Outputs are views
+    overwritten by the next call. Builds are cached by content hash.
+
+    :return: dict with the keys of eqs and the bound functions as values
+    """
+    if flags is None:
+        flags = default_flags
+    if cache_dir is None:
+        cache_dir = jit_dir
+    key = json.dumps(
+        [
+            list(_hash_functions(eqs.values()).items()),
+            compiler,
+            list(flags),
+            real,
+            ca.__version__,
+            _bindings_template,
+        ]
+    )
+    key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    dest_dir = pathlib.Path(cache_dir) / (key + "_py")
+    if not (dest_dir / ("lib" + name + ".so")).exists():
+        # build in a temporary directory, parallel workers may race
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_dir = pathlib.Path(tempfile.mkdtemp(dir=cache_dir))
+        generate_code(
+            {name: eqs},
+            tmp_dir,
+            jobs=1,
+            bindings=True,
+            verbose=False,
+            casadi_real=real,
+        )
+        build_bindings(tmp_dir, name, compiler, flags)
+        try:
+            os.rename(tmp_dir, dest_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir)  # built by another process
+    module = _import_bindings(dest_dir, name)
+    return {k: module.functions[f.name()] for k, f in eqs.items()}
+
+
+# compiled libraries are cached here by content hash, CYECCA_JIT_DIR overrides
+jit_dir = os.environ.get(
+    "CYECCA_JIT_DIR", os.path.join(os.path.expanduser("~"), ".cache", "cyecca", "jit")
+)
+
+
+def _single_precision(source):
+    """
+    Makes math calls type generic, so float arguments call sinf, sqrtf, ...
+    """
+    return source.replace("#include <math.h>", "#include <tgmath.h>")
+
+
+def compile_library(
+    eqs: dict,
+    name: str = "cyecca_jit",
+    compiler: str = "gcc",
+    flags: Optional[list] = None,
+    cache_dir: Optional[str] = None,
+    real: str = "double",
+):
+    """
+    Compiles a dict of casadi functions to a shared library
+
+    The library is built in a directory named by the hash of the code, the
+    compiler and the flags, so it is only built once and rebuilt when the
+    functions change. With real="float" the code uses single precision.
+
+    :return: path of the library
+    """
+    if flags is None:
+        flags = default_flags
+    if cache_dir is None:
+        cache_dir = jit_dir
+    gen = ca.CodeGenerator(name + ".c", {"with_header": False, "casadi_real": real})
+    for f in eqs.values():
+        gen.add(f)
+    source = gen.dump()
+    cmd = [compiler] + list(flags) + ["-fPIC", "-shared"]
+    if real == "float":
+        source = _single_precision(source)
+        cmd.append("-fsingle-precision-constant")
+    key = hashlib.sha1("\n".join(cmd + [source]).encode()).hexdigest()[:16]
+    lib_dir = os.path.join(cache_dir, key)
+    lib = os.path.join(lib_dir, name + ".so")
+    if not os.path.exists(lib):
+        os.makedirs(lib_dir, exist_ok=True)
+        src = os.path.join(lib_dir, name + ".c")
+        with open(src, "w") as f:
+            f.write(source)
+        # build to a temporary file, parallel workers may race
+        tmp = "{:s}.{:d}.tmp".format(lib, os.getpid())
+        subprocess.run(cmd + [src, "-o", tmp, "-lm"], check=True)
+        os.replace(tmp, lib)
+    return lib
+
+
+def compile_and_load(
+    eqs: dict,
+    name: str = "cyecca_jit",
+    compiler: str = "gcc",
+    flags: Optional[list] = None,
+    cache_dir: Optional[str] = None,
+):
+    """
+    Compiles a dict of casadi functions to a shared library and loads them
+
+    The returned dict has the same keys, with each function replaced by the
+    ca.external loaded from the library, a drop in for the casadi virtual
+    machine.
+    """
+    if flags is None:
+        flags = default_flags
+    lib = compile_library(eqs, name, compiler, flags, cache_dir)
+    return {k: ca.external(f.name(), lib) for k, f in eqs.items()}
+
+
+class CFunction:
+    """
+    Calls a generated function of a shared library through ctypes
+
+    Unlike ca.external this works for any casadi_real, so single precision
+    builds can be evaluated. Called like a ca.Function with positional
+    arguments, the outputs are returned as DM.
+    """
+
+    def __init__(self, lib: str, f: ca.Function, real: str = "double"):
+        self.f = f
+        self.dtype = {"double": np.float64, "float": np.float32}[real]
+        self._c = getattr(ctypes.CDLL(lib), f.name())
+        self._c.restype = ctypes.c_int
+        self._c.argtypes = [ctypes.c_void_p] * 4 + [ctypes.c_int]
+        self.sp_in = [f.sparsity_in(i) for i in range(f.n_in())]
+        self.sp_out = [f.sparsity_out(i) for i in range(f.n_out())]
+        self.res = [np.zeros(sp.nnz(), dtype=self.dtype) for sp in self.sp_out]
+        self.iw = np.zeros(max(f.sz_iw(), 1), dtype=np.int64)
+        self.w = np.zeros(max(f.sz_w(), 1), dtype=self.dtype)
+        self._arg = (ctypes.c_void_p * max(f.sz_arg(), 1))()
+        self._res = (ctypes.c_void_p * max(f.sz_res(), 1))()
+        for i, r in enumerate(self.res):
+            self._res[i] = r.ctypes.data
+
+    def __call__(self, *args):
+        assert len(args) == len(self.sp_in)
+        bufs = []
+        for i, (a, sp) in enumerate(zip(args, self.sp_in)):
+            a = ca.DM(a)
+            if a.sparsity() != sp:
+                a = ca.project(ca.reshape(a, sp.size1(), sp.size2()), sp)
+            bufs.append(np.array(a.nonzeros(), dtype=self.dtype))
+            self._arg[i] = bufs[-1].ctypes.data
+        if self._c(self._arg, self._res, self.iw.ctypes.data, self.w.ctypes.data, 0):
+            raise RuntimeError("{:s} failed".format(self.f.name()))
+        out = [ca.DM(sp, r.astype(float)) for sp, r in zip(self.sp_out, self.res)]
+        return out[0] if len(out) == 1 else tuple(out)
+
+
+def record_inputs(eqs: dict):
+    """
+    Wraps a dict of functions to record the arguments of every call
+
+    :return: the wrapped dict, a drop in for eqs, and a dict of function
+        key to a list of argument tuples
+    """
+    samples = {k: [] for k in eqs.keys()}
+
+    def wrap(k, f):
+        def recorded(*args, **kwargs):
+            if len(args) > 0:
+                samples[k].append(tuple(ca.DM(a) for a in args))
+            return f(*args, **kwargs)
+
+        return recorded
+
+    return {k: wrap(k, f) for k, f in eqs.items()}, samples
+
 
-        dest_dir = pathlib.Path(dest_dir)
-        dest_dir.mkdir(exist_ok=True)
+def float32_divergence(eqs: dict, samples: dict, name="cyecca_f32", **kwargs):
+    """
+    Runs the compiled float64 and float32 builds side by side
 
-        gen.generate(str(dest_dir) + pathlib.os.sep)
+    :param eqs: dict of functions
+    :param samples: dict of function key to list of argument tuples, e.g.
+        from record_inputs or simulated inputs
+    :param kwargs: passed to compile_library
+    :return: dict of function key to output name to max and rms of the
+        absolute difference of the float32 build from the float64 build
+    """
+    eqs = {k: f for k, f in eqs.items() if len(samples.get(k, [])) > 0}
+    lib64 = compile_library(eqs, name + "_64", real="double", **kwargs)
+    lib32 = compile_library(eqs, name + "_32", real="float", **kwargs)
+    report = {}
+    for k, f in eqs.items():
+        f64 = CFunction(lib64, f, "double")
+        f32 = CFunction(lib32, f, "float")
+        err = [[] for i in range(f.n_out())]
+        for args in samples[k]:
+            y64 = f64(*args)
+            y32 = f32(*args)
+            if f.n_out() == 1:
+                y64, y32 = [y64], [y32]
+            for i in range(f.n_out()):
+                err[i].append(np.abs(np.array(y32[i] - y64[i])).reshape(-1))
+        report[k] = {}
+        for i in range(f.n_out()):
+            e = np.concatenate(err[i])
+            report[k][f.name_out(i)] = {
+                "max": float(np.max(e)) if e.size > 0 else 0.0,
+                "rms": float(np.sqrt(np.mean(e**2))) if e.size > 0 else 0.0,
+            }
+    return report
@@ -1,34 +1,72 @@
-import casadi as ca
-import os
+import importlib
+from collections.abc import Mapping
 
-# from . import mekf, mrp, quat, sim
+from cyecca import codegen
 
-import cyecca.estimate.attitude.algorithms.mrp as mrp
-import cyecca.estimate.attitude.algorithms.sim as sim
+# algorithm name -> module with an eqs(**kwargs) function, modules are only
+# imported when the algorithm is first requested
+registry = {
+    # mekf and quat need porting to the current lie group api
+    # "mekf": "cyecca.estimate.attitude.algorithms.mekf",
+    "mrp": "cyecca.estimate.attitude.algorithms.mrp",
+    # "quat": "cyecca.estimate.attitude.algorithms.quat",
+    "sim": "cyecca.estimate.attitude.algorithms.sim",
+}
 
 
-def eqs(**kwargs):
-    return {
-        # "mekf": mekf.eqs(**kwargs),
-        "mrp": mrp.eqs(**kwargs),
-        # "quat": quat.eqs(**kwargs),
-        "sim": sim.eqs(**kwargs),
-    }
+class LazyEqs(Mapping):
+    """
+    Dict of algorithm name to its casadi functions, each algorithm is
+    derived the first time it is requested
+    """
+
+    def __init__(self, names=None, **kwargs):
+        """
+        :param names: algorithms to provide, all registered if None
+        :param kwargs: passed to the eqs function of each algorithm
+        """
+        self.names = list(registry.keys()) if names is None else list(names)
+        for name in self.names:
+            if name not in registry:
+                raise KeyError(name)
+        self.kwargs = kwargs
+        self._eqs = {}
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        if name not in self._eqs:
+            module = importlib.import_module(registry[name])
+            self._eqs[name] = module.eqs(**self.kwargs)
+        return self._eqs[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def derived(self):
+        """
+        Names of the algorithms derived so far
+        """
+        return list(self._eqs.keys())
+
+
+def eqs(names=None, **kwargs):
+    return LazyEqs(names, **kwargs)
 
 
 def generate_code(eqs, dest_dir, **kwargs):
     p = {"main": False, "mex": False, "with_header": True, "with_mem": True}
+    p["with_export"] = True
+    p["avoid_stack"] = False
+    p["casadi_real"] = "double"
+    p["benchmark"] = False
+    p["bench_inputs"] = None
+    p["bindings"] = False
     for k, v in kwargs.items():
         assert k in p.keys()
         p[k] = v
-
-    # generate code
-    # Code Generation
-    for name, eqs in eqs.items():
-        filename = "casadi_{:s}.c".format(name)
-        gen = ca.CodeGenerator(filename, p)
-        for f_name in eqs:
-            gen.add(eqs[f_name])
-
-        os.makedirs(dest_dir, exist_ok=True)
-        gen.generate(dest_dir + os.path.sep)
+    units = {"casadi_{:s}".format(name): eqs[name] for name in eqs}
+    return codegen.generate_code(units, dest_dir, **p)
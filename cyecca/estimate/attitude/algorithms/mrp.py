@@ -1,4 +1,5 @@
 from cyecca.estimate.attitude.algorithms.common import *
+from cyecca.cache import cached
 
 """
 A right invariant extended kalman filter parameterized with
@@ -274,6 +275,7 @@ def correct_accel(**kwargs):
     )
 
 
+@cached
 def eqs(**kwargs):
     return {
         "initialize": initialize(**kwargs),
@@ -1,4 +1,5 @@
 from .common import *
+from cyecca.cache import cached
 
 # x, state (7)
 # -----------
@@ -91,6 +92,7 @@ def rotation_error(**kwargs):
     )
 
 
+@cached
 def eqs(**kwargs):
     return {
         "simulate": simulate(**kwargs),
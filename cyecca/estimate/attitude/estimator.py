@@ -51,6 +51,18 @@ class AttitudeEstimator:
 
         self.g = add_param("g", 9.8, "f8")
 
+        # nan checks, configured by <name>/nan_check_* params
+        self.nan_guard = uros.NanGuard(core, name)
+        self.nan_guard.register("prediction", ("x", "W", "q", "r", "b_g"))
+        self.nan_guard.register(
+            "mag correction",
+            ("x", "W", "beta_mag", "r_mag", "r_std_mag", "mag_ret"),
+        )
+        self.nan_guard.register(
+            "accel correction",
+            ("x", "W", "beta_accel", "r_accel", "r_std_accel", "accel_ret"),
+        )
+
         # misc
         self.x = eqs["constants"]()["x0"]
         self.W = eqs["constants"]()["W0"]
@@ -96,19 +108,19 @@ class AttitudeEstimator:
         )
         cpu_mag = time.thread_time() - start
 
-        uros.check_nan(
-            locals(),
-            "{:s} mag correction".format(self.name),
+        self.nan_guard.check(
+            "mag correction",
             t,
-            ["self.x", "self.W", "beta_mag", "r_mag", "r_std_mag", "mag_ret"],
+            ("x", "W", "beta_mag", "r_mag", "r_std_mag", "mag_ret"),
+            (self.x, self.W, beta_mag, r_mag, r_std_mag, mag_ret),
         )
 
-        self.msg_est_status.data["beta_mag"] = beta_mag
+        self.msg_est_status.data["beta_mag"] = np.array(beta_mag).item()
         self.msg_est_status.data["r_mag"][: r_mag.shape[0]] = np.array(r_mag).T
         self.msg_est_status.data["r_std_mag"][: r_std_mag.shape[0]] = np.array(
             r_std_mag
         ).T
-        self.msg_est_status.data["mag_ret"] = mag_ret
+        self.msg_est_status.data["mag_ret"] = np.array(mag_ret).item()
         self.msg_est_status.data["cpu_mag"] = cpu_mag
 
     def imu_callback(self, msg):
@@ -157,11 +169,8 @@ class AttitudeEstimator:
         )
         q, r, b_g = self.eqs["get_state"](self.x)
         cpu_predict = time.thread_time() - start
-        uros.check_nan(
-            locals(),
-            "{:s} prediction".format(self.name),
-            t,
-            ["self.x", "self.W", "q", "r", "b_g"],
+        self.nan_guard.check(
+            "prediction", t, ("x", "W", "q", "r", "b_g"), (self.x, self.W, q, r, b_g)
         )
 
         if t - self.t_last_accel >= (self.dt_min_accel.get() - self.time_eps):
@@ -183,28 +192,21 @@ class AttitudeEstimator:
             )
             cpu_accel = time.thread_time() - start
 
-            uros.check_nan(
-                locals(),
-                "{:s} accel correction".format(self.name),
+            self.nan_guard.check(
+                "accel correction",
                 t,
-                [
-                    "self.x",
-                    "self.W",
-                    "beta_accel",
-                    "r_accel",
-                    "r_std_accel",
-                    "accel_ret",
-                ],
+                ("x", "W", "beta_accel", "r_accel", "r_std_accel", "accel_ret"),
+                (self.x, self.W, beta_accel, r_accel, r_std_accel, accel_ret),
             )
 
-            self.msg_est_status.data["beta_accel"] = beta_accel
+            self.msg_est_status.data["beta_accel"] = np.array(beta_accel).item()
             self.msg_est_status.data["r_accel"][: r_accel.shape[0]] = np.array(
                 r_accel
             ).T
             self.msg_est_status.data["r_std_accel"][: r_accel.shape[0]] = np.array(
                 r_std_accel
             ).T
-            self.msg_est_status.data["accel_ret"] = accel_ret
+            self.msg_est_status.data["accel_ret"] = np.array(accel_ret).item()
             self.msg_est_status.data["cpu_accel"] = cpu_accel
             self.t_last_accel = t
 
@@ -223,4 +225,7 @@ class AttitudeEstimator:
         W_vect = np.reshape(np.array(self.W)[np.diag_indices(self.n_e)], -1)
         self.msg_est_status.data["W"][: len(W_vect)] = W_vect
         self.msg_est_status.data["cpu_predict"] = cpu_predict
+        self.msg_est_status.data["nan_count"] = self.nan_guard.n_fail
+        self.msg_est_status.data["nan_time"] = self.nan_guard.t_first_fail
+        self.msg_est_status.data["nan_first"] = self.nan_guard.first_fail_code
         self.pub_est.publish(self.msg_est_status)
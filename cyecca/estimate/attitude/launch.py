@@ -1,9 +1,14 @@
+import hashlib
+import json
 import multiprocessing as mp
+import os
 
 import numpy as np
 
+from cyecca import cache, codegen
 from cyecca.sim import replay
 from cyecca.sim import uros
+from cyecca.sim.log import SharedArray
 from cyecca.estimate.attitude import algorithms
 from cyecca.estimate.attitude.estimator import AttitudeEstimator
 from cyecca.estimate.attitude.simulator import Simulator
@@ -13,6 +18,14 @@ default_params = {
     "tf": 1,
     "n_monte_carlo": 1,
     "replay_log_file": None,
+    "log_dir": None,
+    "log_spec": None,
+    "profile": False,
+    "seed": None,
+    "cache_dir": None,
+    "chunk_size": 1,
+    "jit": False,
+    "bindings": False,
     "name": "default",
     "initialize": True,
     "estimators": [],
@@ -32,37 +45,179 @@ def init_params(params):
     return p
 
 
-def launch_sim(params):
-    p = init_params(params)
-    core = uros.Core()
-    Simulator(core, eqs, p["x0"])
+def get_eqs(names, jit=False, bindings=False):
+    """
+    Functions of the named algorithms, compiled to C and loaded if jit, or
+    called through ctypes bindings on preallocated buffers if bindings
+    """
+
+    def load(k):
+        # the simulator maps its functions over blocks, it needs ca.Function
+        if bindings and k != "sim":
+            return codegen.load_bindings(eqs[k], "attitude_" + k)
+        if jit:
+            return codegen.compile_and_load(eqs[k], "attitude_" + k)
+        return eqs[k]
+
+    return {k: load(k) for k in names}
+
+
+def setup_sim(p):
+    core = uros.Core(profile=p["profile"])
+    sim_eqs = get_eqs(["sim"] + list(p["estimators"]), p["jit"], p["bindings"])
+    Simulator(core, sim_eqs, p["x0"], p["seed"])
     for name in p["estimators"]:
-        AttitudeEstimator(core, name, eqs[name], p["initialize"])
-    logger = uros.Logger(core)
+        AttitudeEstimator(core, name, sim_eqs[name], p["initialize"])
+    logger = uros.Logger(core, log_dir=p["log_dir"], spec=p["log_spec"])
     core.init_params()
     for k, v in p["params"].items():
         core.set_param(k, v)
+    return core, logger
+
+
+def launch_sim(params):
+    p = init_params(params)
+    core, logger = setup_sim(p)
     core.run(until=p["tf"])
     print(p["name"], "done")
+    if p["profile"]:
+        print(core.profile_summary())
     return logger.get_log_as_array()
 
 
+def _jsonable(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if callable(obj):
+        return getattr(obj, "__qualname__", repr(obj))
+    if hasattr(obj, "__dict__"):
+        return vars(obj)
+    return repr(obj)
+
+
+def params_hash(p):
+    """
+    Hash of the params that determine the outcome of a trial, and of the
+    cyecca source, so cached trials are not reused after the code changed
+    """
+    ignore = ["name", "n_monte_carlo", "log_dir", "cache_dir", "chunk_size"]
+    ignore += ["profile", "seed"]
+    d = {k: v for k, v in p.items() if k not in ignore}
+    d["source"] = cache.source_hash()
+    s = json.dumps(d, sort_keys=True, default=_jsonable)
+    return hashlib.sha1(s.encode()).hexdigest()[:16]
+
+
+def _trial_file(cache_dir, key, seed):
+    return os.path.join(
+        cache_dir,
+        "{:s}_{:x}_{:s}.npy".format(
+            key, seed.entropy, "_".join(str(k) for k in seed.spawn_key)
+        ),
+    )
+
+
+def _launch_sim_shared(args):
+    """
+    Runs one trial and writes its log into row i of the shared results
+    """
+    params, i, shm_name, shape, dtype = args
+    log = launch_sim(params)
+    if len(log) != shape[1]:
+        raise ValueError(
+            "trial {:d} logged {:d} samples, expected {:d}".format(
+                i, len(log), shape[1]
+            )
+        )
+    shm, data = SharedArray.attach(shm_name, shape, dtype)
+    data[i] = log
+    del data
+    shm.close()
+    return i
+
+
+def _launch_sim_indexed(args):
+    i, params = args
+    return i, launch_sim(params)
+
+
 def launch_monte_carlo_sim(params):
+    """
+    Runs n_monte_carlo trials in a process pool
+
+    Trial i draws its noise from child i of SeedSequence(seed), so a study
+    with a fixed seed is reproducible, and extending n_monte_carlo keeps
+    the earlier trials. With cache_dir set, each completed trial is saved
+    keyed by the params hash and its seed, and later runs only compute the
+    trials that are missing.
+    """
     p = init_params(params)
     if p["n_monte_carlo"] == 1:
         d = dict(p)
         d.pop("n_monte_carlo")
-        data = [launch_sim(d)]
-    else:
-        new_params = []
-        for i in range(p["n_monte_carlo"]):
-            d = dict(p)
-            d.pop("n_monte_carlo")
-            d["name"] = i
-            new_params.append(d)
+        return [launch_sim(d)]
+    seeds = np.random.SeedSequence(p["seed"]).spawn(p["n_monte_carlo"])
+    new_params = []
+    for i in range(p["n_monte_carlo"]):
+        d = dict(p)
+        d.pop("n_monte_carlo")
+        d["name"] = i
+        d["seed"] = seeds[i]
+        if p["log_dir"] is not None:
+            d["log_dir"] = os.path.join(p["log_dir"], str(i))
+        new_params.append(d)
+    if p["log_dir"] is not None:
+        # trials stream to disk, only readers come back
+        data = [None] * len(new_params)
+        with mp.Pool(mp.cpu_count()) as pool:
+            for i, log in pool.imap_unordered(
+                _launch_sim_indexed, enumerate(new_params), p["chunk_size"]
+            ):
+                data[i] = log
+        return data
+
+    # trials write their log in place into one shared array, so no log is
+    # pickled back. The record layout comes from a trial that is set up
+    # with the plain casadi functions, nothing is compiled, and the number
+    # of samples from the logger ticks of the rate group scheduler.
+    d = dict(new_params[0])
+    d.update(profile=False, jit=False, bindings=False)
+    core, logger = setup_sim(d)
+    dtype = logger.data_latest.dtype
+    n_samples = core.rate_task_runs(logger.run, p["tf"])
+    shape = (p["n_monte_carlo"], n_samples)
+    data = SharedArray.create(shape, dtype)
+
+    # load cached trials
+    todo = list(range(len(new_params)))
+    if p["cache_dir"] is not None:
+        os.makedirs(p["cache_dir"], exist_ok=True)
+        key = params_hash(p)
+        todo = []
+        for i, seed in enumerate(seeds):
+            f = _trial_file(p["cache_dir"], key, seed)
+            log = np.load(f) if os.path.exists(f) else None
+            if log is not None and log.shape == (n_samples,):
+                data[i] = log
+            else:
+                todo.append(i)
+
+    try:
+        args = [(new_params[i], i, data.shm_name, shape, dtype) for i in todo]
         with mp.Pool(mp.cpu_count()) as pool:
-            data = np.array(pool.map(launch_sim, new_params))
-    return data
+            for i in pool.imap_unordered(_launch_sim_shared, args, p["chunk_size"]):
+                if p["cache_dir"] is not None:
+                    f = _trial_file(p["cache_dir"], key, seeds[i])
+                    with open(f + ".tmp", "wb") as fp:
+                        np.save(fp, data[i].view(np.ndarray))
+                    os.replace(f + ".tmp", f)
+    finally:
+        data.unlink()
+    # a plain array view of a slice, its base keeps the shared block alive,
+    # a view of the owner itself would collapse onto the raw buffer
+    return data[:].view(np.ndarray)
 
 
 def launch_replay(params):
@@ -71,7 +226,7 @@ def launch_replay(params):
     replay.ULogReplay(core, p["replay_log_file"])
     for name in p["estimators"]:
         AttitudeEstimator(core, name, eqs[name], p["initialize"])
-    logger = uros.Logger(core)
+    logger = uros.Logger(core, log_dir=p["log_dir"], spec=p["log_spec"])
     core.init_params()
     for k, v in p["params"].items():
         core.set_param(k, v)
@@ -3,6 +3,7 @@ import os
 import matplotlib.pyplot as plt
 import numpy as np
 
+from cyecca.sim.log import LogReader
 from . import algorithms
 
 eqs = algorithms.eqs()
@@ -24,6 +25,9 @@ def plot(
 ):
     plt.close("all")
 
+    # log directories written by a streaming logger are memory mapped lazily
+    data = [LogReader(d) if isinstance(d, str) else d for d in data]
+
     # topic names
     est_att_topics = [name + "_attitude" for name in est_names]
     est_status_topics = [name + "_status" for name in est_names]
@@ -1,12 +1,11 @@
 import numpy as np
-import simpy
 
 import cyecca.sim.msgs as msgs
 import cyecca.sim.uros as uros
 
 
 class Simulator:
-    def __init__(self, core, eqs, x0):
+    def __init__(self, core, eqs, x0, seed=None):
         self.core = core
 
         # publications
@@ -39,6 +38,19 @@ class Simulator:
         self.mag_str = add_param("mag_str", 1e-1, "f8")
         self.g = add_param("g", 9.8, "f8")
         self.enable_noise = add_param("enable_noise", True, "?")
+        self.block_size = add_param("block_size", 400, "f8")
+        # params the pending ticks of a block are simulated with
+        self.block_params = [
+            self.std_mag,
+            self.std_accel,
+            self.std_gyro,
+            self.sn_gyro_rw,
+            self.mag_decl,
+            self.mag_incl,
+            self.mag_str,
+            self.g,
+            self.enable_noise,
+        ]
 
         # msgs
         self.msg_att = msgs.Attitude()
@@ -46,116 +58,204 @@ class Simulator:
         self.msg_mag = msgs.Mag()
 
         # misc
-        self.t_last_sim = 0
-        self.t_last_imu = 0
-        self.t_last_mag = 0
-        self.x0 = x0
+        self.x0 = np.array(x0, dtype=float).reshape(-1)
+        self.x = self.x0
+        self.i = 0  # sim tick
+        self.k = 0  # column of current tick in the block
+        self.block = None
+        self._funcs = {}
 
         self.eqs = eqs
-        np.random.seed()
-        simpy.Process(core, self.run())
+        # an int or SeedSequence makes the noise reproducible
+        self.rng = np.random.default_rng(seed)
+        # one stream per noise source, so the draws do not depend on the
+        # block size
+        self.noise = dict(zip(["gyro_rw", "gyro", "accel", "mag"], self.rng.spawn(4)))
+        core.add_rate_task(self.run, self.dt_sim)
+        core.add_rate_task(self.run_imu, self.dt_imu)
+        core.add_rate_task(self.run_mag, self.dt_mag)
 
     def params_callback(self, msg):
+        before = [p.get() for p in self.block_params]
         for p in self.param_list:
             p.update()
+        if self.block is not None and before != [p.get() for p in self.block_params]:
+            self.resimulate_block()
 
-    def randn(self, *args, **kwargs):
-        return np.random.randn(*args) * self.enable_noise.get()
+    def randn(self, name, n):
+        """
+        3 x n unit noise, drawn tick by tick from the named stream
+        """
+        return self.noise[name].standard_normal((n, 3)).T
 
-    def run(self):
-        x = self.x0
-        i = 0
-        time_eps = 1e-3  # small period of time to prevent missing pub
-
-        while True:
-            # time
-            t = self.core.now
-
-            # true angular velocity in body frame
-            time_varying_omega = True
-            if time_varying_omega:
-                omega_b = 10 * np.array(
-                    [
-                        (1 + np.sin(2 * np.pi * 0.1 * t + 1)) / 2,
-                        -(1 + np.sin(2 * np.pi * 0.2 * t + 2)) / 2,
-                        (1 + np.cos(2 * np.pi * 0.3 * t + 3)) / 2,
-                    ]
+    @staticmethod
+    def body_rate(t):
+        """
+        true angular velocity in body frame, t is an array of times
+        """
+        time_varying_omega = True
+        if time_varying_omega:
+            return 10 * np.array(
+                [
+                    (1 + np.sin(2 * np.pi * 0.1 * t + 1)) / 2,
+                    -(1 + np.sin(2 * np.pi * 0.2 * t + 2)) / 2,
+                    (1 + np.cos(2 * np.pi * 0.3 * t + 3)) / 2,
+                ]
+            )
+        else:
+            return np.array([[10], [11], [12]]) * np.ones_like(t)
+
+    def _get_funcs(self, n):
+        """
+        sim functions over n steps: state propagation accumulated with
+        mapaccum, measurements mapped
+        """
+        if n not in self._funcs:
+            f = self.eqs["sim"]
+            self._funcs[n] = {
+                "simulate": f["simulate"].mapaccum(
+                    "simulate_{:d}".format(n), n, [1], [0]
+                ),
+                "get_state": f["get_state"].map(n),
+                "measure_gyro": f["measure_gyro"].map(n),
+                "measure_accel": f["measure_accel"].map(n),
+                "measure_mag": f["measure_mag"].map(n),
+            }
+        return self._funcs[n]
+
+    def simulate_block(self, i0, n, x, w=None):
+        """
+        Truth state and sensor streams for sim ticks i0 to i0 + n - 1
+
+        The body rates and noise of all ticks are drawn as arrays and the
+        state is propagated in one call, x is the state at tick i0 - 1, or
+        the initial state if i0 is 0. Each returned array has one column
+        per tick, w holds the unit noise of the ticks by source, drawn if
+        not given.
+        """
+        if w is None:
+            w = {name: self.randn(name, n) for name in self.noise.keys()}
+        dt = self.dt_sim.get()
+        t = (i0 + np.arange(n)) * dt
+        omega = self.body_rate(t)
+        scale = float(self.enable_noise.get())
+        w_gyro_rw = scale * w["gyro_rw"]
+        w_gyro = scale * w["gyro"]
+        w_accel = scale * w["accel"]
+        w_mag = scale * w["mag"]
+
+        # propagate, the state at tick 0 is the initial state
+        if i0 == 0:
+            X = [x.reshape(-1, 1)]
+            if n > 1:
+                X.append(
+                    self._get_funcs(n - 1)["simulate"](
+                        t[1:],
+                        x,
+                        omega[:, 1:],
+                        self.sn_gyro_rw.get(),
+                        w_gyro_rw[:, 1:],
+                        dt,
+                    )
                 )
-            else:
-                omega_b = np.array([10, 11, 12])
-
-            # compute dt
-            dt = t - self.t_last_sim
-            self.t_last_sim = t
-
-            # propagate
-            w_gyro_rw = self.randn(3)
-            if t != 0:
-                x = self.eqs["sim"]["simulate"](
-                    t, x, omega_b, self.sn_gyro_rw.get(), w_gyro_rw, dt
+            X = np.hstack([np.array(xi) for xi in X])
+        else:
+            X = np.array(
+                self._get_funcs(n)["simulate"](
+                    t, x, omega, self.sn_gyro_rw.get(), w_gyro_rw, dt
                 )
+            )
 
-            # measure and publish accel/gyro
-            if t == 0 or t - self.t_last_imu >= self.dt_imu.get() - time_eps:
-                self.t_last_imu = t
-
-                # publish sim state at same rate as estimators, which are based
-                # on imu pub so that logger doesn't grab data out of sync and
-                # report larger error than exists in reality due to delayed data
-                q, r, b_g = self.eqs["sim"]["get_state"](x)
-
-                self.msg_att.data["time"] = t
-                self.msg_att.data["q"] = np.array(q).T
-                self.msg_att.data["r"] = np.array(r).T
-                self.msg_att.data["b"] = np.array(b_g).T
-                self.msg_att.data["omega"] = np.array(omega_b).T
-                self.pub_att.publish(self.msg_att)
-
-                # measure
-                w_gyro = self.randn(3)
-                w_accel = self.randn(3)
-                y_gyro = np.array(
-                    self.eqs["sim"]["measure_gyro"](
-                        x, omega_b, self.std_gyro.get(), w_gyro
-                    )
-                ).T
+        # measure
+        f = self._get_funcs(n)
+        q, r, b_g = f["get_state"](X)
+        return {
+            "w": w,
+            "t": t,
+            "x": X,
+            "omega": omega,
+            "q": np.array(q),
+            "r": np.array(r),
+            "b": np.array(b_g),
+            "gyro": np.array(f["measure_gyro"](X, omega, self.std_gyro.get(), w_gyro)),
+            "accel": np.array(
+                f["measure_accel"](X, self.g.get(), self.std_accel.get(), w_accel)
+            ),
+            "mag": np.array(
+                f["measure_mag"](
+                    X,
+                    self.mag_str.get(),
+                    self.mag_decl.get(),
+                    self.mag_incl.get(),
+                    self.std_mag.get(),
+                    w_mag,
+                )
+            ),
+        }
 
-                y_accel = np.array(
-                    self.eqs["sim"]["measure_accel"](
-                        x, self.g.get(), self.std_accel.get(), w_accel
-                    )
-                ).T
+    def resimulate_block(self):
+        """
+        Simulates the pending ticks of the block again with the current
+        params, the current tick is kept and the noise draws are reused
+        """
+        b = self.block
+        k = self.k
+        n = b["t"].shape[0] - k - 1
+        if n == 0:
+            return
+        w = {name: v[:, k + 1 :] for name, v in b["w"].items()}
+        pending = self.simulate_block(self.i, n, self.x, w)
+        self.block = {
+            key: np.concatenate([v[..., k : k + 1], pending[key]], axis=-1)
+            for key, v in b.items()
+            if key != "w"
+        }
+        self.block["w"] = {name: v[:, k:] for name, v in b["w"].items()}
+        self.k = 0
 
-                # fake centrip acceleration term to model disturbance
-                # y_accel += 1e-3*np.array([[0, 1, 0]]) * np.linalg.norm(omega_b)**2
+    def run(self):
+        """
+        steps to the next sim tick, generating a new block when needed
+        """
+        if self.block is None or self.k + 1 == self.block["t"].shape[0]:
+            self.block = self.simulate_block(self.i, int(self.block_size.get()), self.x)
+            self.k = 0
+        else:
+            self.k += 1
+        self.x = self.block["x"][:, self.k]
+        self.i += 1
 
-                # publish
-                self.msg_imu.data["time"] = t
-                self.msg_imu.data["gyro"] = y_gyro
-                self.msg_imu.data["accel"] = y_accel
-                self.pub_imu.publish(self.msg_imu)
+    def run_imu(self):
+        """
+        publish sim state and accel/gyro, runs after the sim step of the tick
+        """
+        t = self.core.now
+        k = self.k
+        b = self.block
 
-            # measure and publish mag
-            if t == 0 or t - self.t_last_mag >= self.dt_mag.get() - time_eps:
-                self.t_last_mag = t
+        # publish sim state at same rate as estimators, which are based
+        # on imu pub so that logger doesn't grab data out of sync and
+        # report larger error than exists in reality due to delayed data
+        self.msg_att.data["time"] = t
+        self.msg_att.data["q"] = b["q"][:, k]
+        self.msg_att.data["r"] = b["r"][:, k]
+        self.msg_att.data["b"] = b["b"][:, k]
+        self.msg_att.data["omega"] = b["omega"][:, k]
+        self.pub_att.publish(self.msg_att)
 
-                # measure
-                w_mag = self.randn(3)
-                y_mag = np.array(
-                    self.eqs["sim"]["measure_mag"](
-                        x,
-                        self.mag_str.get(),
-                        self.mag_decl.get(),
-                        self.mag_incl.get(),
-                        self.std_mag.get(),
-                        w_mag,
-                    )
-                ).T
+        # fake centrip acceleration term to model disturbance
+        # y_accel += 1e-3*np.array([[0, 1, 0]]) * np.linalg.norm(omega_b)**2
 
-                # publish
-                self.msg_mag.data["time"] = t
-                self.msg_mag.data["mag"] = y_mag
-                self.pub_mag.publish(self.msg_mag)
+        # publish
+        self.msg_imu.data["time"] = t
+        self.msg_imu.data["gyro"] = b["gyro"][:, k]
+        self.msg_imu.data["accel"] = b["accel"][:, k]
+        self.pub_imu.publish(self.msg_imu)
 
-            i += 1
-            yield simpy.Timeout(self.core, self.dt_sim.get())
+    def run_mag(self):
+        """
+        publish mag, runs after the sim step of the tick
+        """
+        self.msg_mag.data["time"] = self.core.now
+        self.msg_mag.data["mag"] = self.block["mag"][:, self.k]
+        self.pub_mag.publish(self.msg_mag)
@@ -1,4 +1,5 @@
 import argparse
+import bisect
 import os
 import sys
 import math
@@ -6,8 +7,10 @@ import numpy as np
 import matplotlib.pyplot as plt
 from pathlib import Path
 import casadi as ca
+from cyecca import codegen
+from cyecca.cache import cached
 import cyecca.lie as lie
-from cyecca.lie.group_so3 import SO3Quat, SO3EulerB321, SO3Dcm
+from cyecca.lie.group_so3 import SO3Quat, SO3EulerB321, SO3Dcm, so3
 
 print("python: ", sys.executable)
 
@@ -48,6 +51,57 @@ class Bezier:
         return Bezier(D / self.T**m, self.T)
 
 
+def bernstein_matrix(n: int, beta, m: int = 0) -> np.ndarray:
+    """
+    Matrix mapping the n + 1 control points of a degree n curve on [0, 1]
+    to its m-th derivative at each normalized time in beta
+
+    :return: (len(beta), n + 1) array
+    """
+    beta = np.asarray(beta, dtype=float).reshape(-1, 1)
+    if m > n:
+        return np.zeros((beta.shape[0], n + 1))
+    k = n - m
+    i = np.arange(k + 1)
+    binom = np.array([math.comb(k, j) for j in i], dtype=float)
+    B = binom * beta**i * (1 - beta) ** (k - i)
+    # m-th forward difference of the control points, as in Bezier.deriv
+    D = np.eye(n + 1)
+    for j in range(m):
+        D = (n - j) * (D[1:] - D[:-1])
+    return B @ D
+
+
+class BezierGrid:
+    """
+    Numeric evaluation of many Bezier curves on a fixed time grid
+
+    The Bernstein basis matrices of the curve and its first m derivatives
+    are computed once for the normalized times beta = t / T, then all
+    curves are evaluated with one matrix multiply. For symbolic batches map
+    the generated functions instead, e.g. eqs["bezier7_traj"].map(N).
+    """
+
+    def __init__(self, n: int, beta, m: int = 0):
+        self.n = n
+        self.m = m
+        self.beta = np.asarray(beta, dtype=float).reshape(-1)
+        self.B = np.vstack([bernstein_matrix(n, self.beta, d) for d in range(m + 1)])
+
+    def eval(self, P, T):
+        """
+        :param P: (k, n + 1) control points of k curves, e.g. segments or axes
+        :param T: duration of the curves, scalar or (k,)
+        :return: (k, m + 1, len(beta)) array, derivative d of curve i at
+            grid point j is [i, d, j]
+        """
+        P = np.atleast_2d(P)
+        R = (P @ self.B.T).reshape(P.shape[0], self.m + 1, -1)
+        T = np.reshape(np.asarray(T, dtype=float), (-1, 1, 1))
+        return R * T ** -np.arange(self.m + 1).reshape(1, -1, 1)
+
+
+@cached
 def derive_bezier7():
     n = 8
     T = ca.SX.sym("T")
@@ -103,6 +157,7 @@ def derive_bezier7():
     return {f.name(): f for f in functions}
 
 
+@cached
 def derive_bezier3():
     n = 4
     T = ca.SX.sym("T")
@@ -152,6 +207,7 @@ def derive_bezier3():
     return {f.name(): f for f in functions}
 
 
+@cached
 def derive_dcm_to_quat():
     R = SO3Dcm.elem(ca.SX.sym("R", 9))
     q = SO3Quat.from_Dcm(R)
@@ -161,6 +217,7 @@ def derive_dcm_to_quat():
     return {f.name(): f for f in functions}
 
 
+@cached
 def derive_ref():
     # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
     # Symbols and Parameters
@@ -306,6 +363,7 @@ def derive_ref():
     return {f.name(): f for f in functions}
 
 
+@cached
 def derive_multirotor():
     n1 = 8
     bezier_7 = derive_bezier7()
@@ -371,6 +429,7 @@ def derive_multirotor():
     return {f.name(): f for f in functions}
 
 
+@cached
 def derive_eulerB321_to_quat():
     """
     eulerB321 to quaternion converion
@@ -397,34 +456,238 @@ def derive_eulerB321_to_quat():
     return {"eulerB321_to_quat": f_eulerB321_to_quat}
 
 
+@cached
+def derive_ref_table():
+    """
+    Flatness reference of the multirotor trajectory from its control
+    points, and the quaternion interpolation used to look up tables of it
+    """
+    T = ca.SX.sym("T")
+    t = ca.SX.sym("t")
+    PX = ca.SX.sym("PX", 1, 8)
+    PY = ca.SX.sym("PY", 1, 8)
+    PZ = ca.SX.sym("PZ", 1, 8)
+    Ppsi = ca.SX.sym("Ppsi", 1, 4)
+    x, y, z, psi, dpsi, ddpsi, v, a, j, s = derive_multirotor()["bezier_multirotor"](
+        t, T, PX, PY, PZ, Ppsi
+    )
+    _, quat, omega, omega_dot, _, thrust = derive_ref()["f_ref"](
+        psi, dpsi, ddpsi, v, a, j, s
+    )
+
+    # q = q0 exp(alpha xi), with xi = log(q0^-1 q1) from the table
+    q0 = SO3Quat.elem(ca.SX.sym("q0", 4))
+    q1 = SO3Quat.elem(ca.SX.sym("q1", 4))
+    xi = so3.elem(ca.SX.sym("xi", 3))
+    alpha = ca.SX.sym("alpha")
+    q = q0 * SO3Quat.exp(alpha * xi)
+
+    functions = [
+        ca.Function(
+            "bezier_ref",
+            [t, T, PX, PY, PZ, Ppsi],
+            [quat, omega, omega_dot, thrust],
+            ["t", "T", "PX", "PY", "PZ", "Ppsi"],
+            ["quat", "omega", "omega_dot", "thrust"],
+        ),
+        ca.Function(
+            "quat_delta",
+            [q0.param, q1.param],
+            [(q0.inverse() * q1).log().param],
+            ["q0", "q1"],
+            ["xi"],
+        ),
+        ca.Function(
+            "quat_interp",
+            [q0.param, xi.param, alpha],
+            [q.param],
+            ["q0", "xi", "alpha"],
+            ["q"],
+        ),
+    ]
+
+    return {f.name(): f for f in functions}
+
+
+class FlatnessTable:
+    """
+    Flatness reference of a known multi segment trajectory, tabulated on a
+    uniform time grid
+
+    The flatness map is evaluated for the whole grid with one map call
+    offline, at runtime a lookup interpolates the attitude on SO3 and the
+    rates and thrust linearly between the two nearest rows.
+    """
+
+    def __init__(self, T, PX, PY, PZ, Ppsi, dt: float, bindings: bool = False):
+        """
+        :param T: (n,) durations of the n segments
+        :param PX: (n, 8) x control points of each segment, likewise PY, PZ
+        :param Ppsi: (n, 4) yaw control points of each segment
+        :param dt: maximum spacing of the table
+        :param bindings: interpolate the attitude with compiled ctypes
+            bindings of quat_interp instead of the casadi virtual machine
+        """
+        eqs = derive_ref_table()
+        T = np.asarray(T, dtype=float).reshape(-1)
+        t_start = np.concatenate([[0], np.cumsum(T)])
+        n = max(math.ceil(t_start[-1] / dt), 1) + 1
+        self.t = np.linspace(0, t_start[-1], n)
+        self.dt = self.t[1] - self.t[0]
+
+        # segment and segment time of each row
+        seg = np.clip(np.searchsorted(t_start, self.t, "right") - 1, 0, T.shape[0] - 1)
+        row = lambda P: np.reshape(np.asarray(P, dtype=float)[seg], (1, -1))
+        quat, omega, omega_dot, thrust = eqs["bezier_ref"].map(n)(
+            self.t - t_start[seg], T[seg], row(PX), row(PY), row(PZ), row(Ppsi)
+        )
+        self.quat = np.array(quat).T
+        self.xi = np.array(eqs["quat_delta"].map(n - 1)(quat[:, :-1], quat[:, 1:])).T
+        self.omega = np.array(omega).T
+        self.omega_dot = np.array(omega_dot).T
+        self.thrust = np.array(thrust).reshape(-1)
+        self._lerp = np.hstack([self.omega, self.omega_dot, self.thrust[:, None]])
+        self._quat_interp = eqs["quat_interp"]
+        if bindings:
+            self._quat_interp = codegen.load_bindings(
+                {"quat_interp": self._quat_interp}, "bezier_quat_interp"
+            )["quat_interp"]
+
+    def lookup(self, t: float):
+        """
+        :return: quat, omega, omega_dot and thrust at time t, clamped to the
+            ends of the table
+        """
+        s = min(max(t / self.dt, 0), self.t.shape[0] - 1)
+        i = min(int(s), self.t.shape[0] - 2)
+        alpha = s - i
+        y = (1 - alpha) * self._lerp[i] + alpha * self._lerp[i + 1]
+        q = np.array(self._quat_interp(self.quat[i], self.xi[i], alpha)).reshape(-1)
+        return q, y[0:3], y[3:6], y[6]
+
+
+class TrajectoryBuffer:
+    """
+    Time indexed ring of multirotor bezier segments
+
+    Segments are stored once when they arrive, as start and stop time and
+    the control points packed as [PX, PY, PZ, Ppsi]. The active segment is
+    found by bisection and segments that ended are dropped from the ring,
+    so the cost per tick does not grow with the length of the mission.
+    """
+
+    n_coef = 3 * 8 + 4
+
+    def __init__(self, capacity: int = 64, bindings: bool = False):
+        """
+        :param capacity: initial number of segments, the ring grows if needed
+        :param bindings: evaluate the reference with compiled ctypes bindings
+            instead of the casadi virtual machine
+        """
+        self.t_start = np.zeros(capacity)
+        self.t_stop = np.zeros(capacity)
+        self.coef = np.zeros((capacity, self.n_coef))
+        self.head = 0
+        self.count = 0
+        eqs = derive_multirotor()
+        if bindings:
+            eqs = codegen.load_bindings(eqs)
+        self.f = eqs["bezier_multirotor"]
+
+    def __len__(self):
+        return self.count
+
+    def _index(self, i):
+        return (self.head + i) % self.t_stop.shape[0]
+
+    def _bisect(self, t):
+        """
+        number of buffered segments with stop time at or before t
+        """
+        return bisect.bisect_right(
+            range(self.count), t, key=lambda i: self.t_stop[self._index(i)]
+        )
+
+    def extend(self, t_start: float, t_stop, PX, PY, PZ, Ppsi):
+        """
+        Adds segments following each other from t_start, buffered segments
+        ending after t_start are replaced
+
+        :param t_stop: (n,) stop time of each segment
+        :param PX: (n, 8) x control points, likewise PY, PZ
+        :param Ppsi: (n, 4) yaw control points
+        """
+        t_stop = np.asarray(t_stop, dtype=float).reshape(-1)
+        n = t_stop.shape[0]
+        self.count = self._bisect(t_start)
+        if self.count + n > self.t_stop.shape[0]:
+            self._grow(self.count + n)
+        i = self._index(self.count + np.arange(n))
+        self.t_start[i] = np.concatenate([[t_start], t_stop[:-1]])
+        self.t_stop[i] = t_stop
+        self.coef[i] = np.hstack([PX, PY, PZ, Ppsi])
+        self.count += n
+
+    def _grow(self, n):
+        i = self._index(np.arange(self.count))
+        capacity = max(2 * self.t_stop.shape[0], n)
+        for k in ["t_start", "t_stop", "coef"]:
+            a = getattr(self, k)
+            b = np.zeros((capacity,) + a.shape[1:])
+            b[: self.count] = a[i]
+            setattr(self, k, b)
+        self.head = 0
+
+    def segment(self, t: float):
+        """
+        Active segment at time t, segments that ended before t are dropped,
+        the last segment is held
+
+        :return: time in the segment clamped to [0, T], duration T and the
+            packed control points, or None if the buffer is empty
+        """
+        if self.count == 0:
+            return None
+        i = min(self._bisect(t), self.count - 1)
+        self.head = self._index(i)
+        self.count -= i
+        k = self.head
+        T = self.t_stop[k] - self.t_start[k]
+        return min(max(t - self.t_start[k], 0), T), T, self.coef[k]
+
+    @staticmethod
+    def hold(pw, psi: float, T: float = 1.0):
+        """
+        Stationary segment at position pw with yaw psi, in the format of
+        segment, to hold a setpoint while the buffer is empty
+        """
+        P = np.hstack([np.repeat(np.reshape(pw, -1), 8), np.full(4, float(psi))])
+        return 0.0, T, P
+
+    def eval(self, t: float):
+        """
+        bezier_multirotor reference at time t, None if the buffer is empty
+        """
+        seg = self.segment(t)
+        if seg is None:
+            return None
+        t, T, P = seg
+        return self.f(t, T, P[None, 0:8], P[None, 8:16], P[None, 16:24], P[None, 24:28])
+
+
 def generate_code(eqs: dict, filename, dest_dir: str, **kwargs):
-    dest_dir = Path(dest_dir)
-    dest_dir.mkdir(exist_ok=True)
-    p = {
-        "verbose": True,
-        "mex": False,
-        "cpp": False,
-        "main": False,
-        "with_header": True,
-        "with_mem": False,
-        "with_export": False,
-        "with_import": False,
-        "include_math": True,
-        "avoid_stack": True,
-    }
-    for k, v in kwargs.items():
-        assert k in p.keys()
-        p[k] = v
-
-    gen = ca.CodeGenerator(filename, p)
-    for name, eq in eqs.items():
-        gen.add(eq)
-    gen.generate(str(dest_dir) + os.sep)
+    """
+    Generate C Code from python CasADi functions.
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return codegen.generate_code({name: eqs}, dest_dir, **kwargs)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("dest_dir")
+    parser.add_argument("--benchmark", action="store_true", help="write benchmark main")
+    parser.add_argument("--bindings", action="store_true", help="write ctypes bindings")
     args = parser.parse_args()
 
     print("generating casadi equations in {:s}".format(args.dest_dir))
@@ -434,9 +697,16 @@ if __name__ == "__main__":
     eqs.update(derive_dcm_to_quat())
     eqs.update(derive_ref())
     eqs.update(derive_multirotor())
+    eqs.update(derive_ref_table())
 
     for name, eq in eqs.items():
         print("eq: ", name)
 
-    generate_code(eqs, filename="bezier.c", dest_dir=args.dest_dir)
+    generate_code(
+        eqs,
+        filename="bezier.c",
+        dest_dir=args.dest_dir,
+        benchmark=args.benchmark,
+        bindings=args.bindings,
+    )
     print("complete")
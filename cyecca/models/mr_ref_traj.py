@@ -1,6 +1,8 @@
 import casadi as ca
+from cyecca.cache import cached
 
 
+@cached
 def derive_mr_ref_traj():
     # Symbols and Parameters
 
@@ -0,0 +1,210 @@
+import math
+
+import casadi as ca
+import numpy as np
+from beartype import beartype
+from beartype.typing import Optional
+
+from cyecca.models.bezier import bernstein_matrix
+
+n_points = 8  # control points of a 7th order segment, as bezier7
+n_cont = 4  # derivatives continuous at interior waypoints, up to snap
+n_bc = 4  # pos/vel/accel/jerk fixed at the first and last waypoint
+
+
+def snap_cost(T: float) -> np.ndarray:
+    """
+    Hessian of the integral of squared snap of a 7th order segment with
+    duration T, with respect to its control points
+
+    The snap is a 3rd order Bezier, the integral of the product of two
+    Bernstein polynomials of order k over [0, 1] is
+    C(k, i) C(k, j) / (C(2k, i + j) (2k + 1)).
+    """
+    k = n_points - 1 - 4
+    i = np.arange(k + 1)
+    G = np.array(
+        [
+            [math.comb(k, a) * math.comb(k, b) / math.comb(2 * k, a + b) for b in i]
+            for a in i
+        ]
+    ) / (2 * k + 1)
+    D = np.eye(n_points)
+    for j in range(4):
+        D = (n_points - 1 - j) * (D[1:] - D[:-1])
+    return 2 * D.T @ G @ D / T**7
+
+
+@beartype
+class MinSnapPlanner:
+    """
+    Minimum snap trajectory through waypoints, one 7th order Bezier segment
+    per leg and axis
+
+    The QP has a fixed sparsity for a number of segments and axes, so the
+    solver is created once and each replan only fills in the matrix values
+    for the new segment durations, warm started from the last solution.
+    The axes are decoupled and solved as blocks of one QP.
+    """
+
+    def __init__(
+        self,
+        n_seg: int,
+        n_dim: int = 3,
+        solver: str = "qrqp",
+        opts: Optional[dict] = None,
+    ):
+        """
+        :param n_seg: number of segments, there are n_seg + 1 waypoints
+        :param n_dim: number of axes
+        :param solver: casadi conic plugin, qrqp is sparse and exact for
+            this equality constrained QP
+        :param opts: options for the solver, quiet qrqp by default
+        """
+        if n_seg < 1:
+            raise ValueError("need at least one segment")
+        self.n_seg = n_seg
+        self.n_dim = n_dim
+        n_x = n_dim * n_seg * n_points
+
+        # hessian, one dense block per segment and axis, scaled by T**-7
+        idx = np.arange(n_points)
+        h_rows, h_cols, h_seg = [], [], []
+        for d in range(n_dim):
+            for s in range(n_seg):
+                i0 = self._index(d, s, 0)
+                h_rows.append(np.repeat(i0 + idx, n_points))
+                h_cols.append(np.tile(i0 + idx, n_points))
+                h_seg.append(np.full(n_points**2, s))
+        self._h = self._layout(
+            np.concatenate(h_rows),
+            np.concatenate(h_cols),
+            n_x,
+            n_x,
+        )
+        self._h_seg = np.concatenate(h_seg)
+        self._h_val = np.tile(snap_cost(1.0).reshape(-1), n_dim * n_seg)
+
+        # linear constraints, rows of derivative m at the start or end of a
+        # segment, scaled by T**-m
+        a_rows, a_cols, a_seg, a_pow, a_val = [], [], [], [], []
+        n_a = 0
+
+        def add(terms):
+            nonlocal n_a
+            for d_row in range(n_dim):
+                for s, m, beta, sign in terms:
+                    b = sign * bernstein_matrix(n_points - 1, [beta], m)[0]
+                    k = idx[: m + 1] if beta == 0 else idx[-m - 1 :]
+                    a_rows.append(np.full(k.shape, n_a + d_row))
+                    a_cols.append(self._index(d_row, s, 0) + k)
+                    a_seg.append(np.full(k.shape, s))
+                    a_pow.append(np.full(k.shape, m))
+                    a_val.append(b[k])
+            n_a += n_dim
+
+        for m in range(n_bc):
+            add([(0, m, 0, 1)])
+        for s in range(1, n_seg):
+            add([(s - 1, 0, 1, 1)])
+            add([(s, 0, 0, 1)])
+            for m in range(1, n_cont + 1):
+                add([(s - 1, m, 1, 1), (s, m, 0, -1)])
+        for m in range(n_bc):
+            add([(n_seg - 1, m, 1, 1)])
+        self._a = self._layout(np.concatenate(a_rows), np.concatenate(a_cols), n_a, n_x)
+        self._a_seg = np.concatenate(a_seg)
+        self._a_pow = np.concatenate(a_pow)
+        self._a_val = np.concatenate(a_val)
+
+        if opts is None:
+            opts = {}
+            if solver == "qrqp":
+                opts = {"print_header": False, "print_iter": False, "print_info": False}
+        self.solver = ca.conic(
+            "min_snap_{:d}".format(n_seg),
+            solver,
+            {"h": self._h[0], "a": self._a[0]},
+            opts,
+        )
+        self.x = np.zeros(n_x)
+        self.lam_a = np.zeros(n_a)
+
+    def _index(self, d, s, k):
+        return (d * self.n_seg + s) * n_points + k
+
+    @staticmethod
+    def _layout(rows, cols, n_rows, n_cols):
+        """
+        Sparsity of the triplets and the order of the triplets in its
+        nonzeros
+        """
+        marker = ca.DM.triplet(
+            rows.tolist(),
+            cols.tolist(),
+            np.arange(1, rows.shape[0] + 1),
+            n_rows,
+            n_cols,
+        )
+        order = np.array(marker.nonzeros(), dtype=int) - 1
+        return marker.sparsity(), order
+
+    def qp_matrices(self, T: np.ndarray):
+        """
+        Hessian and constraint matrix of the QP for segment durations T
+        """
+        H = ca.DM(self._h[0], (self._h_val * T[self._h_seg] ** -7)[self._h[1]])
+        A = ca.DM(
+            self._a[0], (self._a_val * T[self._a_seg] ** -self._a_pow)[self._a[1]]
+        )
+        return H, A
+
+    def plan(
+        self,
+        waypoints: np.ndarray,
+        T: np.ndarray,
+        start: Optional[np.ndarray] = None,
+        end: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        :param waypoints: (n_seg + 1, n_dim) positions
+        :param T: (n_seg,) segment durations
+        :param start: (3, n_dim) vel/accel/jerk at the first waypoint, zero
+            by default
+        :param end: (3, n_dim) vel/accel/jerk at the last waypoint, zero by
+            default
+        :return: (n_seg, n_dim, 8) control points, P[s, d] is PX, PY, PZ for
+            segment s as used by bezier_multirotor
+        """
+        waypoints = np.asarray(waypoints, dtype=float)
+        T = np.asarray(T, dtype=float).reshape(-1)
+        if waypoints.shape != (self.n_seg + 1, self.n_dim):
+            raise ValueError(
+                "waypoints must be {:d} x {:d}".format(self.n_seg + 1, self.n_dim)
+            )
+        if T.shape[0] != self.n_seg or np.any(T <= 0):
+            raise ValueError("need {:d} positive durations".format(self.n_seg))
+        zero = np.zeros((n_bc - 1, self.n_dim))
+        start = zero if start is None else np.asarray(start, dtype=float)
+        end = zero if end is None else np.asarray(end, dtype=float)
+
+        H, A = self.qp_matrices(T)
+        b = [waypoints[0], *start]
+        for s in range(1, self.n_seg):
+            b += [waypoints[s], waypoints[s]]
+            b += [np.zeros(self.n_dim)] * n_cont
+        b += [waypoints[-1], *end]
+        b = np.concatenate(b)
+
+        res = self.solver(
+            h=H,
+            g=np.zeros(self.x.shape[0]),
+            a=A,
+            lba=b,
+            uba=b,
+            x0=self.x,
+            lam_a0=self.lam_a,
+        )
+        self.x = np.array(res["x"]).reshape(-1)
+        self.lam_a = np.array(res["lam_a"]).reshape(-1)
+        return self.x.reshape(self.n_dim, self.n_seg, n_points).transpose(1, 0, 2)
@@ -5,6 +5,7 @@ import matplotlib.pyplot as plt
 from pathlib import Path
 
 import cyecca.lie
+from cyecca import util
 
 
 def derive_model():
@@ -280,6 +281,11 @@ def derive_model():
     u_index = {u[i].name(): i for i in range(u.shape[0])}
     z_index = {z[i].name(): i for i in range(z.shape[0])}
 
+    # structured layouts, for zero-copy named views of x, u and p vectors
+    p_dtype = util.structured_dtype(p_index)
+    x_dtype = util.structured_dtype(x_index)
+    u_dtype = util.structured_dtype(u_index)
+
     return locals()
 
 
@@ -6,6 +6,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from pathlib import Path
 import casadi as ca
+from cyecca import codegen
+from cyecca.cache import cached
 import cyecca.lie as lie
 from cyecca.lie.group_so3 import SO3Quat, SO3EulerB321, so3
 from cyecca.lie.group_se23 import (
@@ -42,6 +44,7 @@ att_w_gyro_bias = 0.1
 param_att_w_mag = 0.2
 
 
+@cached
 def derive_control_allocation():
     """
     quadrotor control allocation
@@ -136,6 +139,7 @@ def saturate(x, x_min, x_max):
     return ca.if_else(x > x_max, x_max, ca.if_else(x < x_min, x_min, x))
 
 
+@cached
 def derive_input_acro():
     """
     Acro mode manual input:
@@ -178,6 +182,7 @@ def derive_input_acro():
     return {"input_acro": f_input_acro}
 
 
+@cached
 def derive_input_velocity():
     # INPUT VARIABLES
     # -------------------------------
@@ -241,6 +246,7 @@ def derive_input_velocity():
     return {"input_velocity": f_input_velocity}
 
 
+@cached
 def derive_input_auto_level():
     """
     Auto level mode manual input:
@@ -294,6 +300,7 @@ def derive_input_auto_level():
     return {"input_auto_level": f_input_auto_level}
 
 
+@cached
 def derive_attitude_control():
     """
     Attitude control loop
@@ -329,6 +336,7 @@ def derive_attitude_control():
     return {"attitude_control": f_attitude_control}
 
 
+@cached
 def derive_attitude_rate_control():
     """
     Attitude rate control loop
@@ -393,6 +401,7 @@ def derive_attitude_rate_control():
     return {"attitude_rate_control": f_attitude_rate_control}
 
 
+@cached
 def derive_position_control():
     """
     Given the position, velocity ,and acceleration set points, find the
@@ -486,6 +495,7 @@ def derive_position_control():
     return {"position_control": f_get_u}
 
 
+@cached
 def derive_common():
     q = SO3Quat.elem(ca.SX.sym("q", 4))
     vw0 = ca.SX.sym("vw0", 3)
@@ -504,6 +514,7 @@ def derive_common():
     }
 
 
+@cached
 def derive_strapdown_ins_propagation():
     """
     INS strapdown propagation
@@ -529,6 +540,7 @@ def derive_strapdown_ins_propagation():
     return eqs
 
 
+@cached
 def derive_position_correction():
     ## Initilaizing measurments
     z = ca.SX.sym("gps", 3)
@@ -579,6 +591,7 @@ def derive_position_correction():
     return {"position_correction": f_pos_estimator}
 
 
+@cached
 def derive_attitude_estimator():
     # Define Casadi variables
     q0 = ca.SX.sym("q", 4)
@@ -662,37 +675,245 @@ def derive_attitude_estimator():
     return {"attitude_estimator": f_att_estimator}
 
 
-def generate_code(eqs: dict, filename, dest_dir: str, **kwargs):
+input_modes = ["acro", "auto_level", "velocity", "bezier"]
+control_modes = ["mellinger", "loglinear"]
+
+
+@cached
+def derive_controller(input_mode: str, control_mode: str = "mellinger"):
     """
-    Generate C Code from python CasADi functions.
+    Control stack of a mode fused into a single function
+
+    Composes the input mapping, position control, attitude control, rate
+    control and allocation of rdd2_sim.Simulator.update_controller, so a
+    tick is one call. control_mode selects the velocity mode position and
+    attitude control, bezier always uses mellinger. All modes share the
+    same inputs and outputs, unused inputs are ignored and setpoints a
+    mode does not update are passed through.
     """
-    dest_dir = Path(dest_dir)
-    dest_dir.mkdir(exist_ok=True)
-    p = {
-        "verbose": True,
-        "mex": False,
-        "cpp": False,
-        "main": False,
-        "with_header": True,
-        "with_mem": False,
-        "with_export": False,
-        "with_import": False,
-        "include_math": True,
-        "avoid_stack": True,
+    if input_mode not in input_modes:
+        raise ValueError("unknown input mode {:s}".format(input_mode))
+    if control_mode not in control_modes:
+        raise ValueError("unknown control mode {:s}".format(control_mode))
+
+    def sym(name, n=1, m=1):
+        return ca.SX.sym(name, n, m)
+
+    # INPUTS
+    # -------------------------------
+    inputs = {
+        # constants
+        "thrust_trim": sym("thrust_trim"),
+        "thrust_delta": sym("thrust_delta"),
+        "F_max": sym("F_max"),
+        "l": sym("l"),
+        "CM": sym("CM"),
+        "CT": sym("CT"),
+        "k_p_att": sym("k_p_att", 3),
+        "kp": sym("kp", 3),
+        "ki": sym("ki", 3),
+        "kd": sym("kd", 3),
+        "f_cut": sym("f_cut"),
+        "i_max": sym("i_max", 3),
+        "dt": sym("dt"),
+        # pilot input
+        "input_aetr": sym("input_aetr", 4),
+        "reset_position": sym("reset_position"),
+        # vehicle state
+        "q": sym("q", 4),
+        "pw": sym("pw", 3),
+        "vw": sym("vw", 3),
+        "omega": sym("omega", 3),
+        # controller state
+        "psi_sp": sym("psi_sp"),
+        "psi_vel_sp": sym("psi_vel_sp"),
+        "pw_sp": sym("pw_sp", 3),
+        "vw_sp": sym("vw_sp", 3),
+        "aw_sp": sym("aw_sp", 3),
+        "qc_sp": sym("qc_sp", 4),
+        "q_sp": sym("q_sp", 4),
+        "z_i": sym("z_i"),
+        "i0": sym("i0", 3),
+        "e0": sym("e0", 3),
+        "de0": sym("de0", 3),
+        # bezier curve
+        "t": sym("t"),
+        "T": sym("T"),
+        "PX": sym("PX", 1, 8),
+        "PY": sym("PY", 1, 8),
+        "PZ": sym("PZ", 1, 8),
+        "Ppsi": sym("Ppsi", 1, 4),
     }
-    for k, v in kwargs.items():
-        assert k in p.keys()
-        p[k] = v
+    v = dict(inputs)
+    eqs = {}
+    eqs.update(derive_input_acro())
+    eqs.update(derive_input_auto_level())
+    eqs.update(derive_input_velocity())
+    eqs.update(derive_position_control())
+    eqs.update(derive_attitude_control())
+    eqs.update(derive_attitude_rate_control())
+    eqs.update(derive_control_allocation())
 
-    gen = ca.CodeGenerator(filename, p)
-    for name, eq in eqs.items():
-        gen.add(eq)
-    gen.generate(str(dest_dir) + os.sep)
+    # CALC
+    # -------------------------------
+    thrust = 0
+    if input_mode == "acro":
+        omega_sp, thrust = eqs["input_acro"](
+            v["thrust_trim"], v["thrust_delta"], v["input_aetr"]
+        )
+    elif input_mode == "auto_level":
+        v["q_sp"], thrust = eqs["input_auto_level"](
+            v["thrust_trim"], v["thrust_delta"], v["input_aetr"], v["q"]
+        )
+        omega_sp = eqs["attitude_control"](v["k_p_att"], v["q"], v["q_sp"])
+    elif input_mode == "velocity":
+        (
+            v["psi_sp"],
+            v["psi_vel_sp"],
+            v["pw_sp"],
+            v["vw_sp"],
+            v["aw_sp"],
+            v["qc_sp"],
+        ) = eqs["input_velocity"](
+            v["dt"],
+            v["psi_sp"],
+            v["pw_sp"],
+            v["pw"],
+            v["input_aetr"],
+            v["reset_position"],
+        )
+        if control_mode == "mellinger":
+            thrust, v["q_sp"], v["z_i"] = eqs["position_control"](
+                v["thrust_trim"],
+                v["pw_sp"],
+                v["vw_sp"],
+                v["aw_sp"],
+                v["qc_sp"],
+                v["pw"],
+                v["vw"],
+                v["z_i"],
+                v["dt"],
+            )
+            omega_sp = eqs["attitude_control"](v["k_p_att"], v["q"], v["q_sp"])
+        else:
+            from cyecca.models import rdd2_loglinear
+
+            eqs.update(rdd2_loglinear.derive_se23_error())
+            eqs.update(rdd2_loglinear.derive_so3_attitude_control())
+            eqs.update(rdd2_loglinear.derive_outerloop_control())
+            zeta = eqs["se23_error"](
+                v["pw"], v["vw"], v["q"], v["pw_sp"], v["vw_sp"], v["qc_sp"]
+            )
+            thrust, v["q_sp"], v["z_i"] = eqs["se23_position_control"](
+                v["thrust_trim"],
+                v["k_p_att"],
+                zeta,
+                v["aw_sp"],
+                v["qc_sp"],
+                v["z_i"],
+                v["dt"],
+            )
+            omega_sp = eqs["so3_attitude_control"](v["k_p_att"], v["q"], v["q_sp"])
+    elif input_mode == "bezier":
+        from cyecca.models import bezier
+
+        eqs.update(bezier.derive_multirotor())
+        eqs.update(bezier.derive_ref())
+        eqs.update(bezier.derive_eulerB321_to_quat())
+        x, y, z, psi, dpsi, ddpsi, v["vw_sp"], a, j, s = eqs["bezier_multirotor"](
+            v["t"], v["T"], v["PX"], v["PY"], v["PZ"], v["Ppsi"]
+        )
+        # as in rdd2_sim, the rate loop is fed the reference body rate
+        _, q_att, v["omega"], _, M, _ = eqs["f_ref"](
+            psi, dpsi, ddpsi, v["vw_sp"], a, j, s
+        )
+        v["qc_sp"] = eqs["eulerB321_to_quat"](psi, 0, 0)
+        v["pw_sp"] = ca.vertcat(x, y, z)
+        thrust, v["q_sp"], v["z_i"] = eqs["position_control"](
+            v["thrust_trim"],
+            v["pw_sp"],
+            v["vw_sp"],
+            v["aw_sp"],
+            v["qc_sp"],
+            v["pw"],
+            v["vw"],
+            v["z_i"],
+            v["dt"],
+        )
+        omega_sp = eqs["attitude_control"](v["k_p_att"], v["q"], v["q_sp"])
+
+    M, i1, e1, de1, alpha = eqs["attitude_rate_control"](
+        v["kp"],
+        v["ki"],
+        v["kd"],
+        v["f_cut"],
+        v["i_max"],
+        v["omega"],
+        omega_sp,
+        v["i0"],
+        v["e0"],
+        v["de0"],
+        v["dt"],
+    )
+    u, Fp, Fm, Ft, Msat = eqs["f_alloc"](
+        v["F_max"], v["l"], v["CM"], v["CT"], thrust, M
+    )
+
+    # FUNCTION
+    # -------------------------------
+    outputs = {
+        "u": u,
+        "M": M,
+        "thrust": thrust,
+        "omega_sp": omega_sp,
+        "i1": i1,
+        "e1": e1,
+        "de1": de1,
+    }
+    for k in ["psi_sp", "psi_vel_sp", "pw_sp", "vw_sp", "aw_sp", "qc_sp", "q_sp"]:
+        outputs[k + "1"] = v[k]
+    outputs["z_i1"] = v["z_i"]
+    name = "controller_" + input_mode
+    if input_mode == "velocity":
+        name += "_" + control_mode
+    f_controller = ca.Function(
+        name,
+        list(inputs.values()),
+        [ca.SX(y) for y in outputs.values()],
+        list(inputs.keys()),
+        list(outputs.keys()),
+    )
+    return {name: f_controller}
+
+
+@cached
+def derive_controllers():
+    """
+    Fused controllers of all modes, see derive_controller
+    """
+    eqs = {}
+    for input_mode in input_modes:
+        if input_mode == "velocity":
+            for control_mode in control_modes:
+                eqs.update(derive_controller(input_mode, control_mode))
+        else:
+            eqs.update(derive_controller(input_mode))
+    return eqs
+
+
+def generate_code(eqs: dict, filename, dest_dir: str, **kwargs):
+    """
+    Generate C Code from python CasADi functions.
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return codegen.generate_code({name: eqs}, dest_dir, **kwargs)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("dest_dir")
+    parser.add_argument("--benchmark", action="store_true", help="write benchmark main")
+    parser.add_argument("--bindings", action="store_true", help="write ctypes bindings")
     args = parser.parse_args()
 
     print("generating casadi equations in {:s}".format(args.dest_dir))
@@ -708,9 +929,16 @@ if __name__ == "__main__":
     eqs.update(derive_common())
     eqs.update(derive_attitude_estimator())
     eqs.update(derive_position_correction())
+    eqs.update(derive_controllers())
 
     for name, eq in eqs.items():
         print("eq: ", name)
 
-    generate_code(eqs, filename="rdd2.c", dest_dir=args.dest_dir)
+    generate_code(
+        eqs,
+        filename="rdd2.c",
+        dest_dir=args.dest_dir,
+        benchmark=args.benchmark,
+        bindings=args.bindings,
+    )
     print("complete")
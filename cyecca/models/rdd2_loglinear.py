@@ -6,6 +6,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from pathlib import Path
 import casadi as ca
+from cyecca import codegen
+from cyecca.cache import cached
 import cyecca.lie as lie
 from cyecca.lie.group_so3 import so3, SO3Quat, SO3EulerB321
 from cyecca.lie.group_se23 import (
@@ -63,6 +65,7 @@ def saturate(x, x_min, x_max):
     return y
 
 
+@cached
 def derive_se23_error():
     """
     SE2(3) Error
@@ -96,6 +99,7 @@ def derive_se23_error():
     return eqs
 
 
+@cached
 def derive_so3_attitude_control():
     """
     Attitude control loop
@@ -131,6 +135,7 @@ def derive_so3_attitude_control():
     return {"so3_attitude_control": f_attitude_control}
 
 
+@cached
 def derive_outerloop_control():
     """
     Given the position, velocity ,and acceleration set points, find the
@@ -240,33 +245,15 @@ def generate_code(eqs: dict, filename, dest_dir: str, **kwargs):
     """
     Generate C Code from python CasADi functions.
     """
-    dest_dir = Path(dest_dir)
-    dest_dir.mkdir(exist_ok=True)
-    p = {
-        "verbose": True,
-        "mex": False,
-        "cpp": False,
-        "main": False,
-        "with_header": True,
-        "with_mem": False,
-        "with_export": False,
-        "with_import": False,
-        "include_math": True,
-        "avoid_stack": True,
-    }
-    for k, v in kwargs.items():
-        assert k in p.keys()
-        p[k] = v
-
-    gen = ca.CodeGenerator(filename, p)
-    for name, eq in eqs.items():
-        gen.add(eq)
-    gen.generate(str(dest_dir) + os.sep)
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return codegen.generate_code({name: eqs}, dest_dir, **kwargs)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("dest_dir")
+    parser.add_argument("--benchmark", action="store_true", help="write benchmark main")
+    parser.add_argument("--bindings", action="store_true", help="write ctypes bindings")
     args = parser.parse_args()
 
     print("generating casadi equations in {:s}".format(args.dest_dir))
@@ -278,5 +265,11 @@ if __name__ == "__main__":
     for name, eq in eqs.items():
         print("eq: ", name)
 
-    generate_code(eqs, filename="rdd2_loglinear.c", dest_dir=args.dest_dir)
+    generate_code(
+        eqs,
+        filename="rdd2_loglinear.c",
+        dest_dir=args.dest_dir,
+        benchmark=args.benchmark,
+        bindings=args.bindings,
+    )
     print("complete")
@@ -0,0 +1,453 @@
+import json
+import os
+import re
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from beartype import beartype
+from beartype.typing import Callable, Dict, List, Optional, Union
+
+
+@beartype
+class LogSpec:
+    """
+    Declarative selection of what a uros Logger records
+
+    Topics are filtered by the allow list (all topics if None) and the deny
+    list. Topics with an entry in rates are sampled into their own log at
+    that period instead of the main log at logger/dt. An entry in fields
+    projects a topic onto the listed message fields. A trigger is a
+    predicate on a received message, when it returns True the current main
+    log record is also captured into the event log.
+    """
+
+    def __init__(
+        self,
+        topics: Optional[List[str]] = None,
+        exclude: Optional[List[str]] = None,
+        rates: Optional[Dict[str, Union[int, float]]] = None,
+        fields: Optional[Dict[str, List[str]]] = None,
+        triggers: Optional[Dict[str, Callable]] = None,
+    ):
+        """
+        :param topics: topics to record, None for all published topics
+        :param exclude: topics never recorded
+        :param rates: topic to sampling period in seconds
+        :param fields: topic to list of message fields to record
+        :param triggers: topic to predicate(msg) capturing an event record
+        """
+        exclude = [] if exclude is None else exclude
+        rates = {} if rates is None else rates
+        fields = {} if fields is None else fields
+        triggers = {} if triggers is None else triggers
+        for topic, dt in rates.items():
+            if not dt > 0:
+                raise ValueError("{:s} rate period must be positive".format(topic))
+        for topic in triggers.keys():
+            if topic in rates:
+                raise ValueError(
+                    "{:s} triggers capture the main log, it cannot have a rate".format(
+                        topic
+                    )
+                )
+        self.topics = topics
+        self.exclude = list(exclude)
+        self.rates = dict(rates)
+        self.fields = dict(fields)
+        self.triggers = dict(triggers)
+
+    def selected(self, topic):
+        """
+        Whether topic is recorded
+        """
+        if topic in self.exclude:
+            return False
+        return self.topics is None or topic in self.topics
+
+    def check(self, topics):
+        """
+        Raises KeyError if the spec names a topic that is not published
+        """
+        named = set(self.exclude).union(self.rates, self.fields, self.triggers)
+        if self.topics is not None:
+            named = named.union(self.topics)
+        for topic in named:
+            if topic not in topics:
+                raise KeyError(topic)
+        for topic, fields in self.fields.items():
+            if len(fields) == 0:
+                raise ValueError("{:s} field projection is empty".format(topic))
+        for topic in self.triggers.keys():
+            if not self.selected(topic):
+                raise ValueError("{:s} has a trigger but is not logged".format(topic))
+
+
+@beartype
+class LogBuffer:
+    """
+    Preallocated structured array storage for log records
+
+    Records are written in place into chunks of chunk_size rows. When a chunk
+    fills, a new one is allocated, existing rows are never moved, so appends
+    are constant time. If filename is given, each chunk is a memory mapped
+    region of that file instead of process memory.
+    """
+
+    def __init__(
+        self, dtype: np.dtype, chunk_size: int = 4096, filename: Optional[str] = None
+    ):
+        """
+        :param dtype: the numpy structured dtype of a record
+        :param chunk_size: number of records allocated at a time
+        :param filename: optional backing file, truncated on creation
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive")
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.filename = filename
+        self.chunks = []
+        self.n = 0
+        self._chunk = None
+        self._i = chunk_size  # row in current chunk, full forces allocation
+        if filename is not None:
+            open(filename, "wb").close()
+
+    def __len__(self):
+        return self.n
+
+    def _new_chunk(self):
+        if self.filename is None:
+            chunk = np.empty(self.chunk_size, dtype=self.dtype)
+        else:
+            # memmap in r+ mode extends the file to cover the new chunk
+            offset = len(self.chunks) * self.chunk_size * self.dtype.itemsize
+            chunk = np.memmap(
+                self.filename,
+                dtype=self.dtype,
+                mode="r+",
+                offset=offset,
+                shape=(self.chunk_size,),
+            )
+        self.chunks.append(chunk)
+        self._chunk = chunk
+        self._i = 0
+
+    def next_record(self):
+        """
+        Reserves the next row and returns it as a writable view
+        """
+        if self._i == self.chunk_size:
+            self._new_chunk()
+        record = self._chunk[self._i]
+        self._i += 1
+        self.n += 1
+        return record
+
+    def append(self, record):
+        """
+        Copies record into the next row
+        """
+        if self._i == self.chunk_size:
+            self._new_chunk()
+        self._chunk[self._i] = record
+        self._i += 1
+        self.n += 1
+
+    def array(self):
+        """
+        Returns all records as one structured array
+
+        A view is returned when the records fit in one chunk or are file
+        backed, otherwise the chunks are concatenated.
+        """
+        if self.filename is not None:
+            for chunk in self.chunks:
+                chunk.flush()
+            if self.n == 0:
+                return np.zeros(0, dtype=self.dtype)
+            return np.memmap(self.filename, dtype=self.dtype, mode="r", shape=(self.n,))
+        if len(self.chunks) == 0:
+            return np.zeros(0, dtype=self.dtype)
+        if len(self.chunks) == 1:
+            return self.chunks[0][: self.n]
+        return np.concatenate(self.chunks[:-1] + [self._chunk[: self._i]])
+
+
+def _columns(dtype, prefix=()):
+    """
+    Lists the leaf field paths of a structured dtype
+    """
+    cols = []
+    for name in dtype.names:
+        sub = dtype.fields[name][0]
+        if sub.names is not None:
+            cols += _columns(sub, prefix + (name,))
+        else:
+            cols.append(prefix + (name,))
+    return cols
+
+
+def _get_column(data, path):
+    for name in path:
+        data = data[name]
+    return data
+
+
+def _fix_descr(descr):
+    """
+    Converts a json round tripped dtype descr back to tuples
+    """
+    if isinstance(descr, str):
+        return descr
+    fixed = []
+    for d in descr:
+        d = list(d)
+        d[1] = _fix_descr(d[1])
+        if len(d) > 2:
+            d[2] = tuple(d[2])
+        fixed.append(tuple(d))
+    return fixed
+
+
+def _get_dtype(dtype, path):
+    for name in path:
+        dtype = dtype.fields[name][0]
+    return dtype
+
+
+@beartype
+class LogWriter:
+    """
+    Streams structured log records to disk in fixed size chunks
+
+    Only one chunk of records is kept in memory, when it fills every leaf
+    field is written to its own .npy file and the chunk is reused, so memory
+    stays bounded regardless of the length of the simulation. The directory
+    is read back lazily with LogReader.
+    """
+
+    def __init__(self, dtype: np.dtype, log_dir: str, chunk_size: int = 4096):
+        """
+        :param dtype: the numpy structured dtype of a record
+        :param log_dir: output directory, created if needed
+        :param chunk_size: number of records per chunk file
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive")
+        self.dtype = dtype
+        self.log_dir = log_dir
+        self.chunk_size = chunk_size
+        self.columns = _columns(dtype)
+        self.chunk_rows = []
+        self.n = 0
+        self._chunk = np.empty(chunk_size, dtype=dtype)
+        self._i = 0
+        os.makedirs(log_dir, exist_ok=True)
+        for f in os.listdir(log_dir):
+            if f == LogReader.index_file or LogReader.chunk_pattern.match(f):
+                os.remove(os.path.join(log_dir, f))
+        self._write_index()
+
+    def __len__(self):
+        return self.n
+
+    def _write_index(self):
+        index = {
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "columns": self.columns,
+            "chunk_rows": self.chunk_rows,
+        }
+        path = os.path.join(self.log_dir, LogReader.index_file)
+        with open(path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(path + ".tmp", path)
+
+    def flush(self):
+        """
+        Writes the buffered records to a new chunk
+        """
+        if self._i == 0:
+            return
+        k = len(self.chunk_rows)
+        data = self._chunk[: self._i]
+        for j, path in enumerate(self.columns):
+            np.save(
+                os.path.join(self.log_dir, LogReader.chunk_file.format(j, k)),
+                _get_column(data, path),
+            )
+        self.chunk_rows.append(self._i)
+        self._i = 0
+        self._write_index()
+
+    def next_record(self):
+        """
+        Reserves the next row and returns it as a writable view
+        """
+        if self._i == self.chunk_size:
+            self.flush()
+        record = self._chunk[self._i]
+        self._i += 1
+        self.n += 1
+        return record
+
+    def append(self, record):
+        """
+        Copies record into the next row
+        """
+        if self._i == self.chunk_size:
+            self.flush()
+        self._chunk[self._i] = record
+        self._i += 1
+        self.n += 1
+
+    def array(self):
+        """
+        Flushes buffered records and returns a lazy reader of the log
+        """
+        self.flush()
+        return LogReader(self.log_dir)
+
+
+@beartype
+class LogReader:
+    """
+    Lazy, memory mapped view of a log written by LogWriter
+
+    Indexing mimics a structured array: a field name of a nested record
+    returns another reader, a leaf field name returns a numpy array and a
+    slice returns a reader over a window of rows. Only the chunks that
+    overlap the window of a requested leaf field are touched.
+    """
+
+    index_file = "index.json"
+    chunk_file = "c{:04d}_{:06d}.npy"
+    chunk_pattern = re.compile(r"c\d{4}_\d{6}\.npy$")
+
+    def __init__(self, log_dir: str):
+        self.log_dir = log_dir
+        with open(os.path.join(log_dir, self.index_file), "r") as f:
+            index = json.load(f)
+        self.dtype = np.lib.format.descr_to_dtype(_fix_descr(index["descr"]))
+        self.columns = [tuple(c) for c in index["columns"]]
+        self.chunk_rows = index["chunk_rows"]
+        self.chunk_start = np.concatenate([[0], np.cumsum(self.chunk_rows)])
+        self.prefix = ()
+        self.start = 0
+        self.stop = int(self.chunk_start[-1])
+
+    def _view(self, prefix, start, stop):
+        view = object.__new__(LogReader)
+        view.__dict__.update(self.__dict__)
+        view.prefix = prefix
+        view.start = start
+        view.stop = stop
+        return view
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    def _load(self, path):
+        j = self.columns.index(path)
+        parts = []
+        for k in range(len(self.chunk_rows)):
+            c0 = self.chunk_start[k]
+            c1 = self.chunk_start[k + 1]
+            if c1 <= self.start or c0 >= self.stop:
+                continue
+            chunk = np.load(
+                os.path.join(self.log_dir, self.chunk_file.format(j, k)),
+                mmap_mode="r",
+            )
+            parts.append(chunk[max(self.start - c0, 0) : min(self.stop, c1) - c0])
+        if len(parts) == 0:
+            return np.zeros((0,) + _get_dtype(self.dtype, path).shape)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            path = self.prefix + (key,)
+            if path in self.columns:
+                return self._load(path)
+            if not any(c[: len(path)] == path for c in self.columns):
+                raise KeyError(key)
+            return self._view(path, self.start, self.stop)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise IndexError("only unit step slices are supported")
+            return self._view(
+                self.prefix, self.start + start, self.start + max(start, stop)
+            )
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if key < 0 or key >= len(self):
+                raise IndexError(key)
+            return self[key : key + 1].to_array()[0]
+        raise TypeError("unsupported index {:s}".format(str(type(key))))
+
+    def to_array(self):
+        """
+        Materializes the rows of the reader window as a structured array
+        """
+        dtype = _get_dtype(self.dtype, self.prefix)
+        data = np.zeros(len(self), dtype=dtype)
+        for path in self.columns:
+            if path[: len(self.prefix)] == self.prefix:
+                _get_column(data, path[len(self.prefix) :])[...] = self._load(path)
+        return data
+
+
+class SharedArray(np.ndarray):
+    """
+    Array in a shared memory block that worker processes fill in place
+
+    The owning array holds the block, views of it keep the owner alive, so
+    the block is closed only once no array refers to it. Workers attach by
+    name with attach and write their slice, nothing is pickled back.
+    """
+
+    @staticmethod
+    def create(shape, dtype):
+        """
+        Allocates a zero filled shared array
+        """
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf).view(SharedArray)
+        data._shm = shm
+        return data
+
+    @staticmethod
+    def attach(name, shape, dtype):
+        """
+        Maps an existing block, returns the shared memory, which the caller
+        must close once done, and a plain array over it
+        """
+        shm = shared_memory.SharedMemory(name=name)
+        return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+    @property
+    def shm_name(self):
+        return self._owner()._shm.name
+
+    def _owner(self):
+        owner = self
+        while "_shm" not in owner.__dict__:
+            owner = owner.base
+        return owner
+
+    def unlink(self):
+        """
+        Removes the block name, the memory stays mapped for this process
+        """
+        self._owner()._shm.unlink()
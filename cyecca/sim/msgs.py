@@ -94,6 +94,9 @@ class EstimatorStatus(Msg):
             ("r_std_accel", float_type, 3),  # accelerometer residual standard deviation
             ("beta_accel", float_type),  # accelerometer fault detection
             ("accel_ret", float_type),  # accelerometer return code
+            ("nan_count", float_type),  # number of failed nan checks
+            ("nan_time", time_type),  # time of first failed nan check
+            ("nan_first", float_type),  # code of first failed nan check, see NanGuard
         ]
     )
 
@@ -116,13 +119,25 @@ class Params(Msg):
 
 @beartype
 class Log(Msg):
-    def __init__(self, core):
+    def __init__(self, core, topics=None, fields=None):
+        """
+        :param core: the uros core, all publishers are logged by default
+        :param topics: optional list of topics to log
+        :param fields: optional dict of topic to list of fields to keep
+        """
         dtype = [("time", time_type)]
         for topic, publisher in core._publishers.items():
+            if topics is not None and topic not in topics:
+                continue
             if not hasattr(publisher.msg_type, "dtype"):
                 msg = publisher.msg_type(core)
-                dtype.append((topic, msg.dtype))
+                msg_dtype = msg.dtype
             else:
-                dtype.append((topic, publisher.msg_type.dtype))
+                msg_dtype = publisher.msg_type.dtype
+            if fields is not None and topic in fields:
+                msg_dtype = np.dtype(
+                    [(f, msg_dtype.fields[f][0]) for f in fields[topic]]
+                )
+            dtype.append((topic, msg_dtype))
         self.dtype = np.dtype(dtype)
         super().__init__(self.dtype)
@@ -1,24 +1,297 @@
 import copy
+import functools
+import os
+import time
 
+import casadi as ca
 import numpy as np
 import simpy
 
 import cyecca.sim.msgs as msgs
+from cyecca.sim.log import LogBuffer, LogSpec, LogWriter
 
 from beartype import beartype
 
 
+@beartype
+class LatencyHistogram:
+    """
+    Streaming histogram of durations with logarithmic bins
+
+    Memory is constant, quantiles are resolved to the bin, which spans
+    1/bins_per_decade of a decade.
+    """
+
+    t_min = 1e-8
+    t_max = 1e2
+    bins_per_decade = 20
+
+    def __init__(self):
+        n_decades = int(round(np.log10(self.t_max / self.t_min)))
+        self.n_bins = n_decades * self.bins_per_decade
+        self.counts = np.zeros(self.n_bins + 2, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, dt):
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+        if dt <= self.t_min:
+            i = 0
+        else:
+            i = int(np.log10(dt / self.t_min) * self.bins_per_decade) + 1
+            if i > self.n_bins + 1:
+                i = self.n_bins + 1
+        self.counts[i] += 1
+
+    def quantile(self, q):
+        """
+        Upper edge of the bin holding quantile q, capped at the maximum
+        """
+        if self.count == 0:
+            return np.nan
+        i = int(np.searchsorted(np.cumsum(self.counts), q * self.count))
+        if i > self.n_bins:
+            return self.max
+        edge = self.t_min * 10 ** (i / self.bins_per_decade)
+        return min(edge, self.max)
+
+
+def _callable_name(f):
+    obj = getattr(f, "__self__", None)
+    if obj is None:
+        return f.__qualname__.split(".<locals>")[0]
+    name = type(obj).__name__
+    if isinstance(getattr(obj, "name", None), str):
+        name += "[{:s}]".format(obj.name)
+    return "{:s}.{:s}".format(name, f.__name__)
+
+
 @beartype
 class Core(simpy.Environment):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, type_check=True, profile=False, **kwargs):
+        """
+        :param type_check: check message types on publish
+        :param profile: time subscriber callbacks and process steps
+        """
         super().__init__(*args, **kwargs)
         self._params = None
         self._publishers = {}
         self._subscribers = {}
         self._declared_params = {}
-        self.pub_sub_locked = False
+        self._pub_sub_locked = False
+        self.type_check = type_check
+        self.profile = profile
+        self.profile_data = {}  # name -> (wall, cpu) histograms
+        self._rate_tasks = []
+        self._rate_groups_started = False
         self.pub_params = Publisher(self, "params", msgs.Params)
 
+    @property
+    def pub_sub_locked(self):
+        return self._pub_sub_locked
+
+    @pub_sub_locked.setter
+    def pub_sub_locked(self, locked):
+        self._pub_sub_locked = locked
+        if locked:
+            self.compile_dispatch()
+        else:
+            for publisher in self._publishers.values():
+                publisher._callbacks = None
+
+    def compile_dispatch(self):
+        """
+        Gives each publisher a tuple of its subscriber callbacks, so publish
+        does not look up subscribers per message
+        """
+        for topic, publisher in self._publishers.items():
+            callbacks = [s.callback for s in self._subscribers.get(topic, [])]
+            if self.profile:
+                callbacks = [
+                    self._profile_callback(
+                        cb, "sub {:s} {:s}".format(topic, _callable_name(cb))
+                    )
+                    for cb in callbacks
+                ]
+            publisher._callbacks = tuple(callbacks)
+
+    def _get_histograms(self, name):
+        if name not in self.profile_data:
+            self.profile_data[name] = (LatencyHistogram(), LatencyHistogram())
+        return self.profile_data[name]
+
+    def _profile_callback(self, callback, name):
+        wall, cpu = self._get_histograms(name)
+
+        def profiled(*args):
+            t0 = time.perf_counter()
+            c0 = time.thread_time()
+            callback(*args)
+            cpu.record(time.thread_time() - c0)
+            wall.record(time.perf_counter() - t0)
+
+        return profiled
+
+    def _profile_generator(self, generator, name):
+        wall, cpu = self._get_histograms(name)
+        value = None
+        error = None
+        while True:
+            t0 = time.perf_counter()
+            c0 = time.thread_time()
+            try:
+                if error is None:
+                    event = generator.send(value)
+                else:
+                    event = generator.throw(error)
+            except StopIteration as e:
+                return e.value
+            finally:
+                cpu.record(time.thread_time() - c0)
+                wall.record(time.perf_counter() - t0)
+            value = None
+            error = None
+            try:
+                value = yield event
+            except BaseException as e:
+                error = e
+
+    def process(self, generator, name=None):
+        """
+        Starts a simpy process, steps are timed when profiling
+        """
+        if self.profile:
+            if name is None:
+                owner = generator.gi_frame.f_locals.get("self")
+                name = _callable_name(generator)
+                if owner is not None:
+                    name = _callable_name(getattr(owner, generator.__name__))
+            generator = self._profile_generator(generator, "proc " + name)
+        return simpy.Process(self, generator)
+
+    def add_rate_task(self, callback, period, name=None):
+        """
+        Registers a fixed rate task with the rate group scheduler
+
+        All tasks run from one simpy process ticking at the smallest task
+        period, each task period must be an integer multiple of it. Tasks
+        due in the same tick run in order of increasing period, then in
+        order of registration. Periods are resolved once, when the
+        simulation starts.
+
+        :param callback: called with no arguments when the task is due
+        :param period: period in seconds, a float or a Param
+        :param name: label used when profiling
+        """
+        if self._rate_groups_started:
+            raise RuntimeError("rate groups already started")
+        if name is None:
+            name = _callable_name(callback)
+        if len(self._rate_tasks) == 0:
+            self.process(self._run_rate_groups(), "rate groups")
+        self._rate_tasks.append((callback, period, name))
+
+    def _resolve_rate_groups(self):
+        """
+        Base tick period and the tick divisor of each rate task
+        """
+        periods = []
+        for callback, period, name in self._rate_tasks:
+            if isinstance(period, Param):
+                period = period.get()
+            if not period > 0:
+                raise ValueError("{:s} period must be positive".format(name))
+            periods.append(float(period))
+        base = min(periods)
+        divisors = []
+        for (callback, period, name), dt in zip(self._rate_tasks, periods):
+            divisor = int(round(dt / base))
+            if abs(divisor * base - dt) > 1e-9 * dt:
+                raise ValueError(
+                    "{:s} period {:g} is not a multiple of {:g}".format(name, dt, base)
+                )
+            divisors.append(divisor)
+        return base, divisors
+
+    def rate_task_runs(self, callback, until):
+        """
+        Number of times a rate task runs if the simulation is started now
+        and run until the given time
+
+        :param callback: callback the task was registered with
+        """
+        base, divisors = self._resolve_rate_groups()
+        for (cb, period, name), divisor in zip(self._rate_tasks, divisors):
+            if cb == callback:
+                break
+        else:
+            raise KeyError(_callable_name(callback))
+        # ticks at now + k * base strictly before until, as run(until) stops
+        # before events due at until
+        t0 = self.now
+        n_ticks = max(int(np.ceil((until - t0) / base)), 0)
+        while t0 + n_ticks * base < until:
+            n_ticks += 1
+        while n_ticks > 0 and t0 + (n_ticks - 1) * base >= until:
+            n_ticks -= 1
+        return (n_ticks + divisor - 1) // divisor
+
+    def _run_rate_groups(self):
+        self._rate_groups_started = True
+        base, divisors = self._resolve_rate_groups()
+        groups = {}
+        for (callback, period, name), divisor in zip(self._rate_tasks, divisors):
+            if self.profile:
+                callback = self._profile_callback(callback, "task " + name)
+            groups.setdefault(divisor, []).append(callback)
+        groups = tuple((d, tuple(groups[d])) for d in sorted(groups.keys()))
+
+        # integer ticks, time is computed from the tick count so it does
+        # not drift with float accumulation
+        t0 = self.now
+        tick = 0
+        while True:
+            for divisor, callbacks in groups:
+                if tick % divisor == 0:
+                    for callback in callbacks:
+                        callback()
+            tick += 1
+            yield self.timeout(t0 + tick * base - self.now)
+
+    def profile_summary(self):
+        """
+        Table of wall and cpu time statistics per callback and process
+        """
+        lines = [
+            "{:48s} {:>8s} {:>10s} {:>9s} {:>9s} {:>9s} {:>9s}".format(
+                "name",
+                "count",
+                "total ms",
+                "p50 us",
+                "p99 us",
+                "max us",
+                "cpu p50",
+            )
+        ]
+        items = sorted(self.profile_data.items(), key=lambda kv: -kv[1][0].total)
+        for name, (wall, cpu) in items:
+            lines.append(
+                "{:48s} {:8d} {:10.3f} {:9.2f} {:9.2f} {:9.2f} {:9.2f}".format(
+                    name[:48],
+                    wall.count,
+                    1e3 * wall.total,
+                    1e6 * wall.quantile(0.5),
+                    1e6 * wall.quantile(0.99),
+                    1e6 * wall.max,
+                    1e6 * cpu.quantile(0.5),
+                )
+            )
+        return "\n".join(lines)
+
     def init_params(self):
         self._params = msgs.Params(self)
 
@@ -64,20 +337,45 @@ class Publisher:
         self.core = core
         self.topic = topic
         self.msg_type = msg_type
+        self._callbacks = None  # dispatch table, set when pub/sub is locked
         assert topic not in core._publishers
         core._publishers[topic] = self
 
-    def publish(self, msg: msgs.Msg):
+    def _check_type(self, msg):
         if not isinstance(msg, self.msg_type):
             raise ValueError(
                 "{:s} expects msg {:s}, but got {:s}".format(
                     self.topic, str(self.msg_type), str(type(msg))
                 )
             )
-        if self.topic not in self.core._subscribers:
-            return
-        for s in self.core._subscribers[self.topic]:
-            s.callback(msg)
+
+    def _get_callbacks(self):
+        if self._callbacks is not None:
+            return self._callbacks
+        return [s.callback for s in self.core._subscribers.get(self.topic, [])]
+
+    # not annotated, so beartype leaves the hot path unwrapped
+    def publish(self, msg):
+        if self.core.type_check:
+            self._check_type(msg)
+        callbacks = self._callbacks
+        if callbacks is None:
+            callbacks = self._get_callbacks()
+        for cb in callbacks:
+            cb(msg)
+
+    def publish_batch(self, msg_list):
+        """
+        Publishes several messages of this topic in order, with the type
+        check and dispatch lookup done once for the batch
+        """
+        if self.core.type_check:
+            for msg in msg_list:
+                self._check_type(msg)
+        callbacks = self._get_callbacks()
+        for msg in msg_list:
+            for cb in callbacks:
+                cb(msg)
 
 
 @beartype
@@ -103,40 +401,193 @@ class Param:
 
 @beartype
 class Logger:
-    def __init__(self, core):
+    def __init__(self, core, chunk_size=4096, filename=None, log_dir=None, spec=None):
         self.core = core
         self.dt = Param(core, "logger/dt", 1.0 / 200, "f8")
-        self.data_latest = None
-        self.data_list = []
+        self.spec = LogSpec() if spec is None else spec
+        self.spec.check(self.core._publishers)
+        self.chunk_size = chunk_size
+        self.filename = filename
+        self.log_dir = log_dir
+
+        # topics with their own rate are sampled into separate logs
+        topics = [t for t in self.core._publishers.keys() if self.spec.selected(t)]
+        main_topics = [t for t in topics if t not in self.spec.rates]
+        self.data_latest = msgs.Log(self.core, main_topics, self.spec.fields)
+        self.buffer = self._create_buffer(self.data_latest.dtype, None)
+        self.topic_logs = {}
+        for topic in topics:
+            if topic in self.spec.rates:
+                record = msgs.Log(self.core, [topic], self.spec.fields)
+                buffer = self._create_buffer(record.dtype, topic)
+                self.topic_logs[topic] = (record, buffer)
+        self.event_buffer = None
+        if len(self.spec.triggers) > 0:
+            self.event_buffer = self._create_buffer(self.data_latest.dtype, "events")
+
+        # record fields each topic callback writes into
+        self.targets = {}
+        for topic in topics:
+            if topic in self.topic_logs:
+                record = self.topic_logs[topic][0].data
+            else:
+                record = self.data_latest.data
+            self.targets[topic] = (record, self.spec.fields.get(topic))
+
         self.subs = {}
         for topic, publisher in self.core._publishers.items():
-            cb = lambda msg, topic=topic: self.callback(topic, msg)
-            self.subs[topic] = Subscriber(self.core, topic, publisher.msg_type, cb)
-        self.data_latest = msgs.Log(self.core)
+            if topic in self.targets or topic == "params":
+                cb = lambda msg, topic=topic: self.callback(topic, msg)
+                self.subs[topic] = Subscriber(self.core, topic, publisher.msg_type, cb)
         self.core.pub_sub_locked = True
         self.param_list = [self.dt]
-        simpy.Process(core, self.run())
+        core.add_rate_task(self.run, self.dt)
+        for topic, (record, buffer) in self.topic_logs.items():
+            core.add_rate_task(
+                functools.partial(self.run_topic, record, buffer),
+                self.spec.rates[topic],
+                "Logger.run_topic[{:s}]".format(topic),
+            )
+
+    def _create_buffer(self, dtype, name):
+        if self.log_dir is not None:
+            # stream chunks to disk, bounded memory for long simulations
+            log_dir = self.log_dir if name is None else os.path.join(self.log_dir, name)
+            return LogWriter(dtype, log_dir, self.chunk_size)
+        filename = self.filename
+        if filename is not None and name is not None:
+            filename = "{:s}.{:s}".format(filename, name)
+        return LogBuffer(dtype, self.chunk_size, filename)
 
     def callback(self, topic, msg):
-        self.data_latest.data[topic] = copy.deepcopy(msg.data)
+        if topic in self.targets:
+            record, fields = self.targets[topic]
+            # structured assignment copies the fields in place
+            if fields is None:
+                record[topic] = msg.data
+            else:
+                for f in fields:
+                    record[topic][f] = msg.data[f]
+            trigger = self.spec.triggers.get(topic)
+            if trigger is not None and trigger(msg):
+                self.data_latest.data["time"] = self.core.now
+                self.event_buffer.append(self.data_latest.data)
         if topic == "params":
             for p in self.param_list:
                 p.update()
 
     def run(self):
-        while True:
-            self.data_latest.data["time"] = self.core.now
-            self.data_list.append(copy.deepcopy(self.data_latest.data))
-            yield simpy.Timeout(self.core, self.dt.get())
+        self.data_latest.data["time"] = self.core.now
+        self.buffer.append(self.data_latest.data)
+
+    def run_topic(self, record, buffer):
+        record.data["time"] = self.core.now
+        buffer.append(record.data)
 
     def get_log_as_array(self):
-        return np.array(self.data_list, dtype=self.data_latest.dtype)
+        return self.buffer.array()
+
+    def get_topic_log_as_array(self, topic):
+        """
+        Log of a topic recorded at its own rate
+        """
+        return self.topic_logs[topic][1].array()
+
+    def get_event_log_as_array(self):
+        """
+        Main log records captured by triggers
+        """
+        if self.event_buffer is None:
+            raise ValueError("no triggers in log spec")
+        return self.event_buffer.array()
+
+
+@beartype
+class NanGuard:
+    """
+    Checks arrays for nan and inf values
+
+    The level of checking is set by parameters, so callers only pay for
+    what is enabled:
+    <name>/nan_check_period: check every n-th call, 0 disables checking,
+    a count stored as f8 like all params and truncated when read
+    <name>/nan_check_raise: raise ValueError on failure, otherwise count
+    failures and remember the first one
+
+    Each checked quantity, label/name, gets a code, its index in quantities
+    plus one, 0 if nothing failed, so the first failure can be logged as a
+    number. Register the checks up front to keep the codes fixed.
+    """
+
+    def __init__(self, core, name, period=1, raise_error=True):
+        self.core = core
+        self.name = name
+        self.period = Param(core, name + "/nan_check_period", period, "f8")
+        self.raise_error = Param(core, name + "/nan_check_raise", raise_error, "?")
+        self.param_list = [self.period, self.raise_error]
+        self.sub_params = Subscriber(core, "params", msgs.Params, self.params_callback)
+        self.n_calls = 0
+        self.n_fail = 0
+        self.t_first_fail = np.nan
+        self.first_fail = None
+        self.first_fail_code = 0
+        self.quantities = []
+        self._codes = {}
+        self._period = int(self.period.get())
+        self._raise = bool(self.raise_error.get())
+
+    def params_callback(self, msg):
+        for p in self.param_list:
+            p.update()
+        self._period = int(self.period.get())
+        self._raise = bool(self.raise_error.get())
+
+    def register(self, label, names):
+        """
+        Assigns codes to the quantities of a check
+        """
+        for name in names:
+            self.code(label, name)
+
+    def code(self, label, name):
+        """
+        :return: code of a quantity, 1 + its index in quantities
+        """
+        key = label + "/" + name
+        if key not in self._codes:
+            self.quantities.append(key)
+            self._codes[key] = len(self.quantities)
+        return self._codes[key]
 
+    def check(self, label, t, names, values):
+        """
+        :param label: where the values were computed, used in the report
+        :param t: time of the check
+        :param names: names of the values, used in the report
+        :param values: arrays to check, numpy or casadi DM
+        :return: False if a non finite value was found
+        """
+        self.n_calls += 1
+        if self._period <= 0 or self.n_calls % self._period != 0:
+            return True
+        for name, val in zip(names, values):
+            if isinstance(val, ca.DM):
+                ok = val.is_regular()
+            else:
+                ok = np.isfinite(val).all()
+            if not ok:
+                self.fail(label, t, name, val)
+                return False
+        return True
 
-def check_nan(locals_dict, label, t, names):
-    locals().update(locals_dict)
-    for name in names:
-        val = eval(name)
-        if np.any((np.isnan(np.array(val)))):
-            s = "nan in {:s} @ {:f} sec {:s} = {:s}".format(label, t, name, str(val))
+    def fail(self, label, t, name, val):
+        s = "nan in {:s} {:s} @ {:f} sec {:s} = {:s}".format(
+            self.name, label, t, name, str(val)
+        )
+        self.n_fail += 1
+        if self.first_fail is None:
+            self.first_fail = s
+            self.t_first_fail = t
+            self.first_fail_code = self.code(label, name)
+        if self._raise:
             raise ValueError(s)
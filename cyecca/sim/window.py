@@ -0,0 +1,49 @@
+from beartype import beartype
+from beartype.typing import Callable, Optional
+
+
+@beartype
+class MessageWindow:
+    """
+    The last messages of a stream in a list, such as the poses of a path
+
+    The messages are allocated once and reused oldest first, so a long
+    running publisher does not allocate a message per sample. Only every
+    decimation-th sample is kept.
+    """
+
+    def __init__(
+        self,
+        factory: Callable,
+        length: int,
+        decimation: int = 1,
+        items: Optional[list] = None,
+    ):
+        """
+        :param factory: creates an empty message
+        :param length: number of messages kept
+        :param decimation: keep every decimation-th sample
+        :param items: list the window is kept in, a new list by default
+        """
+        if length < 1 or decimation < 1:
+            raise ValueError("length and decimation must be positive")
+        self.items = [] if items is None else items
+        self.pool = [factory() for i in range(length)]
+        self.decimation = decimation
+        self.tick = 0
+
+    def next(self):
+        """
+        :return: the message to fill for this sample, moved to the end of
+            the window, or None if the sample is skipped
+        """
+        self.tick += 1
+        if self.tick < self.decimation:
+            return None
+        self.tick = 0
+        if len(self.items) < len(self.pool):
+            msg = self.pool[len(self.items)]
+        else:
+            msg = self.items.pop(0)
+        self.items.append(msg)
+        return msg
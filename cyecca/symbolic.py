@@ -1,3 +1,5 @@
+from collections.abc import Mapping
+
 import casadi as ca
 import sympy
 
@@ -357,14 +359,10 @@ def casadi_to_sympy(expr, syms=None):
         raise NotImplementedError("op: {:s}: {:s}".format(str(op), str(expr)))
 
 
-def derive_series(input_squared=False):
+def series_functions(input_squared=False):
     """
-    Derives taylor series near zero, useful for Lie Groups.
-
-    If use_sqrt is passed as True, will take the sqrt of the argument x before passing
-    it to the function. This is useful as many series in Lie groups depend on theta, and
-    to find theta we take the sqrt(dot(v, v)), which results in a nan for the jacobian at
-    zero. By making the series in terms of sqrt(x), we can avoid this issue.
+    The sympy functions of the series in derive_series, returns the
+    independent variable and a dict of name to function.
     """
     u = sympy.symbols("x")
 
@@ -385,48 +383,72 @@ def derive_series(input_squared=False):
     tan = sympy.tan
     atan = sympy.atan
 
-    # return series dictionary
-    return {
-        "cos(x)": taylor_series_near_zero(
-            u, cos_x
-        ),  # necessary for series of cos(sqrt(x))
-        "sin(x)/x": taylor_series_near_zero(u, sin_x / x),
-        "x/sin(x)": taylor_series_near_zero(u, x / sin_x),
-        "(1 - cos(x))/x": taylor_series_near_zero(u, (1 - cos_x) / x),
-        "(1 - cos(x))/x^2": taylor_series_near_zero(u, (1 - cos_x) / x2),
-        "(x - sin(x))/x^3": taylor_series_near_zero(u, (x - sin_x) / x3),
-        "(1 - x*sin(x)/(2*(1 - cos(x))))/x^2": taylor_series_near_zero(
-            u, (1 - x * sin_x / (2 * (1 - cos_x))) / x2
-        ),
-        "(-x^2/2 - cos(x) + 1)/x^2": taylor_series_near_zero(
-            u, (-x2 / 2 - cos_x + 1) / x2
-        ),
-        "(x^2/2 + cos(x) - 1)/x^4": taylor_series_near_zero(
-            u, (x2 / 2 + cos_x - 1) / x4
-        ),
-        "1/x^2": taylor_series_near_zero(u, 1 / x2),
-        "(2 - x cos(x))/(2 x^2)": taylor_series_near_zero(
-            u, (2 - x * cos_x) / (2 * x2)
-        ),
-        "1/x^2 + sin(x)/(2 x (cos(x) - 1))": taylor_series_near_zero(
-            u, 1 / x2 + sin_x / (2 * x * (cos_x - 1))
-        ),
-        "(x^2 + 2 cos(x) - 2)/(2 x^4)": taylor_series_near_zero(
-            u, (x2 + 2 * cos_x - 2) / (2 * x4)
-        ),
-        "(x cos(x) + 2 x - 3 sin(x))/(2 x^5)": taylor_series_near_zero(
-            u, (x * cos_x + 2 * x - 3 * sin_x) / (2 * x5)
-        ),
-        "(x^2 + x sin(x) + 4 cos(x) - 4)/(2 x^6)": taylor_series_near_zero(
-            u, (x2 + x * sin_x + 4 * cos_x - 4) / (2 * x6)
-        ),
-        "(2 - 2 cos(x) - x sin(x))/(2 x^4))": taylor_series_near_zero(
-            u, (2 - 2 * cos_x - x * sin_x) / (2 * x4)
-        ),
-        "tan(x/4)/x": taylor_series_near_zero(u, tan(x / 4) / x),
-        "4 atan(x)/x": taylor_series_near_zero(u, 4 * atan(x) / x),
+    # series functions
+    return u, {
+        "cos(x)": cos_x,  # necessary for series of cos(sqrt(x))
+        "sin(x)/x": sin_x / x,
+        "x/sin(x)": x / sin_x,
+        "(1 - cos(x))/x": (1 - cos_x) / x,
+        "(1 - cos(x))/x^2": (1 - cos_x) / x2,
+        "(x - sin(x))/x^3": (x - sin_x) / x3,
+        "(1 - x*sin(x)/(2*(1 - cos(x))))/x^2": (1 - x * sin_x / (2 * (1 - cos_x))) / x2,
+        "(-x^2/2 - cos(x) + 1)/x^2": (-x2 / 2 - cos_x + 1) / x2,
+        "(x^2/2 + cos(x) - 1)/x^4": (x2 / 2 + cos_x - 1) / x4,
+        "1/x^2": 1 / x2,
+        "(2 - x cos(x))/(2 x^2)": (2 - x * cos_x) / (2 * x2),
+        "1/x^2 + sin(x)/(2 x (cos(x) - 1))": 1 / x2 + sin_x / (2 * x * (cos_x - 1)),
+        "(x^2 + 2 cos(x) - 2)/(2 x^4)": (x2 + 2 * cos_x - 2) / (2 * x4),
+        "(x cos(x) + 2 x - 3 sin(x))/(2 x^5)": (x * cos_x + 2 * x - 3 * sin_x)
+        / (2 * x5),
+        "(x^2 + x sin(x) + 4 cos(x) - 4)/(2 x^6)": (x2 + x * sin_x + 4 * cos_x - 4)
+        / (2 * x6),
+        "(2 - 2 cos(x) - x sin(x))/(2 x^4))": (2 - 2 * cos_x - x * sin_x) / (2 * x4),
+        "tan(x/4)/x": tan(x / 4) / x,
+        "4 atan(x)/x": 4 * atan(x) / x,
     }
 
 
-SERIES = derive_series(input_squared=False)
-SQUARED_SERIES = derive_series(input_squared=True)
+def derive_series(input_squared=False):
+    """
+    Derives taylor series near zero, useful for Lie Groups.
+
+    If use_sqrt is passed as True, will take the sqrt of the argument x before passing
+    it to the function. This is useful as many series in Lie groups depend on theta, and
+    to find theta we take the sqrt(dot(v, v)), which results in a nan for the jacobian at
+    zero. By making the series in terms of sqrt(x), we can avoid this issue.
+    """
+    u, functions = series_functions(input_squared)
+    return {k: taylor_series_near_zero(u, f) for k, f in functions.items()}
+
+
+class LazySeries(Mapping):
+    """
+    Dict of the series of derive_series, each series is derived the first
+    time it is used, so importing the lie groups does not expand them all.
+    """
+
+    def __init__(self, input_squared=False):
+        self.input_squared = input_squared
+        self._functions = None
+        self._series = {}
+
+    def _get_functions(self):
+        if self._functions is None:
+            self._functions = series_functions(self.input_squared)
+        return self._functions
+
+    def __getitem__(self, key):
+        if key not in self._series:
+            u, functions = self._get_functions()
+            self._series[key] = taylor_series_near_zero(u, functions[key])
+        return self._series[key]
+
+    def __iter__(self):
+        return iter(self._get_functions()[1])
+
+    def __len__(self):
+        return len(self._get_functions()[1])
+
+
+SERIES = LazySeries(input_squared=False)
+SQUARED_SERIES = LazySeries(input_squared=True)
@@ -1,8 +1,9 @@
 from beartype import beartype
-from beartype.typing import Tuple, Union, Callable
+from beartype.typing import Tuple, Union, Callable, Dict
 
 
 import casadi as ca
+import numpy as np
 
 
 @beartype
@@ -138,9 +139,82 @@ def udu_symmetric_decomposition(P: ca.SX) -> Tuple[ca.SX, ca.SX]:
     return U, D
 
 
+@beartype
+def pack_function(f: ca.Function) -> Tuple[ca.Function, dict, dict]:
+    """
+    Version of f taking all inputs stacked in one vector and returning all
+    outputs stacked in another, matrices are stacked column-major
+
+    Calls from python convert each argument to and from DM, so a function
+    with many small arguments is much cheaper to call packed.
+
+    :return: the packed function and dicts of the slices of each named
+        input and output in the packed vectors
+    """
+
+    def slices(names, sparsity):
+        d = {}
+        n = 0
+        for name, sp in zip(names, sparsity):
+            d[name] = slice(n, n + sp.numel())
+            n += sp.numel()
+        return d, n
+
+    sp_in = [f.sparsity_in(i) for i in range(f.n_in())]
+    s_in, n_in = slices(f.name_in(), sp_in)
+    x = ca.SX.sym("x", n_in)
+    X = [
+        ca.reshape(x[s_in[name]], sp.size1(), sp.size2())
+        for name, sp in zip(f.name_in(), sp_in)
+    ]
+    Y = f.call(X)
+    s_out, n_out = slices(f.name_out(), Y)
+    f_packed = ca.Function(
+        f.name() + "_packed",
+        [x],
+        [ca.vertcat(*[ca.vec(ca.densify(y)) for y in Y])],
+        ["x"],
+        ["y"],
+    )
+    return f_packed, s_in, s_out
+
+
+@beartype
+def structured_dtype(index: Dict[str, int]) -> np.dtype:
+    """
+    Structured dtype laying out a vector with the given element indices
+
+    Elements named name_0 ... name_n stored in order become one subarray
+    field, all others scalar fields, so a float vector v viewed with
+    v.view(dtype=..., type=np.recarray)[0] exposes the named states without
+    copying, e.g. state.quaternion_wb or state.m.
+
+    :param index: dict of element name to index, e.g. model["x_index"]
+    :return: the dtype, with itemsize of the whole vector
+    """
+    names = sorted(index, key=index.get)
+    if [index[name] for name in names] != list(range(len(names))):
+        raise ValueError("indices must be 0 to n-1")
+    fields = []
+    i = 0
+    while i < len(names):
+        base, _, num = names[i].rpartition("_")
+        n = 1
+        if base and num == "0":
+            while i + n < len(names) and names[i + n] == "{:s}_{:d}".format(base, n):
+                n += 1
+        if n > 1:
+            fields.append((base, "f8", n))
+        else:
+            fields.append((names[i], "f8"))
+        i += n
+    return np.dtype(fields)
+
+
 def count_ops(s, ops=None, dep=None, invdep=None):
     """
-    count ops in expression
+    count ops in expression, for a ca.Function codegen.count_instructions
+    is much faster
     """
     import casadi
     import casadi.tools
@@ -77,6 +77,11 @@ class Simulator(Node):
         self.p = np.array(list(self.p_dict.values()), dtype=float)
         self.u = np.zeros(4, dtype=float)
 
+        # named view sharing memory with state, which is updated in place
+        self.named_state = self.state.view(
+            dtype=self.model["x_dtype"], type=np.recarray
+        )[0]
+
         # start main loop on timer
         self.system_clock = rclpy.clock.Clock(
             clock_type=rclpy.clock.ClockType.SYSTEM_TIME
@@ -169,7 +174,7 @@ class Simulator(Node):
         # ---------------------------------------------------------------------
         # store states and measurements
         # ---------------------------------------------------------------------
-        self.state = np.array(res["xf"]).reshape(-1)
+        self.state[:] = x1
 
         self.publish_state()
 
@@ -178,26 +183,11 @@ class Simulator(Node):
         self.integrate_simulation()  # Integrator
         self.publish_state()
 
-    def get_state_by_name(self, name):
-        return self.state[self.model["x_index"][name]]
-
     def publish_state(self):
-        x = self.get_state_by_name("position_w_0")
-        y = self.get_state_by_name("position_w_1")
-        z = self.get_state_by_name("position_w_2")
-
-        wx = self.get_state_by_name("omega_wb_b_0")
-        wy = self.get_state_by_name("omega_wb_b_1")
-        wz = self.get_state_by_name("omega_wb_b_2")
-
-        vx = self.get_state_by_name("velocity_b_0")
-        vy = self.get_state_by_name("velocity_b_1")
-        vz = self.get_state_by_name("velocity_b_2")
-
-        qw = self.get_state_by_name("quat_wb_0")
-        qx = self.get_state_by_name("quat_wb_1")
-        qy = self.get_state_by_name("quat_wb_2")
-        qz = self.get_state_by_name("quat_wb_3")
+        x, y, z = self.named_state.position_w
+        wx, wy, wz = self.named_state.omega_wb_b
+        vx, vy, vz = self.named_state.velocity_b
+        qw, qx, qy, qz = self.named_state.quat_wb
 
         # ------------------------------------
         # publish simulation clock
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
+from cyecca import codegen, util
 from cyecca.models import quadrotor
 from cyecca.models import rdd2, rdd2_loglinear, mr_ref_traj, bezier
+from cyecca.sim.window import MessageWindow
 
 import casadi as ca
 import numpy as np
@@ -21,7 +23,7 @@ from tf2_ros import TransformBroadcaster, StaticTransformBroadcaster
 
 
 class Simulator(Node):
-    def __init__(self, x0=None, p=None):
+    def __init__(self, x0=None, p=None, jit=False, bindings=False):
         # ----------------------------------------------
         # ROS2 node setup
         # ----------------------------------------------
@@ -76,6 +78,10 @@ class Simulator(Node):
         self.p = np.array(list(self.p_dict.values()), dtype=float)
         self.u = np.zeros(4, dtype=float)
 
+        # named views sharing memory with x and p, x is updated in place
+        self.state = self.x.view(dtype=self.model["x_dtype"], type=np.recarray)[0]
+        self.param = self.p.view(dtype=self.model["p_dtype"], type=np.recarray)[0]
+
         # ----------------------------------------------
         # casadi control/ estimation algorithms
         # ----------------------------------------------
@@ -99,17 +105,39 @@ class Simulator(Node):
         self.eqs.update(bezier.derive_ref())
         self.eqs.update(bezier.derive_eulerB321_to_quat())
 
+        # control stack of each mode fused into one function, taking and
+        # returning a single vector to keep the per-tick call cheap
+        for name, f in rdd2.derive_controllers().items():
+            self.eqs[name], self.control_in, self.control_out = util.pack_function(f)
+        n_in = max(sl.stop for sl in self.control_in.values())
+        self.control_input = np.zeros(n_in, dtype=float)
+        if bindings:
+            # compiled C called on preallocated buffers, no DM conversions
+            self.eqs = codegen.load_bindings(self.eqs, "rdd2_sim")
+        elif jit:
+            # compiled C instead of the casadi virtual machine
+            self.eqs = codegen.compile_and_load(self.eqs, "rdd2_sim")
+
         # ----------------------------------------------
         # sim state data
         # ----------------------------------------------
-        self.path_len = 30
         self.t = 0.0
         self.dt = 1.0 / 100
         self.real_time_factor = 1.0
 
-        self.pose_list = []
         self.motor_pose = np.zeros(4, dtype=float)
+
+        # path of previous poses, a fixed set of messages reused oldest first
+        self.declare_parameter("path_len", 30)
+        self.declare_parameter("path_decimation", 1)  # keep every n-th pose
         self.msg_path = Path()
+        self.msg_path.header.frame_id = "map"
+        self.path = MessageWindow(
+            PoseStamped,
+            self.get_parameter("path_len").value,
+            self.get_parameter("path_decimation").value,
+            self.msg_path.poses,
+        )
         self.input_aetr = np.zeros(4, dtype=float)
         self.input_mode = "velocity"
         self.control_mode = "mellinger"
@@ -159,7 +187,7 @@ class Simulator(Node):
         )
 
         # bezier
-        self.bezier_msg = None
+        self.bezier = bezier.TrajectoryBuffer()
         self.PX = np.zeros(8)
         self.PY = np.zeros(8)
         self.PZ = np.zeros(8)
@@ -170,7 +198,7 @@ class Simulator(Node):
         Update the estimator
         """
         res = self.eqs["strapdown_ins_propagate"](
-            self.est_x, self.y_accel, self.y_gyro, self.get_param_by_name("g"), self.dt
+            self.est_x, self.y_accel, self.y_gyro, self.param.g, self.dt
         )
         self.est_x = np.array(res, dtype=float).reshape(-1)
 
@@ -227,212 +255,89 @@ class Simulator(Node):
         # ------------------------------------
         # control constants
         # ------------------------------------
-        m = self.get_param_by_name("m")
-        g = self.get_param_by_name("g")
-        thrust_delta = 0.5 * m * g
-        thrust_trim = m * g
+        m = self.param.m
+        g = self.param.g
+        v = self.control_input
+        s = self.control_in
+        v[s["thrust_delta"]] = 0.5 * m * g
+        v[s["thrust_trim"]] = m * g
         # TODO move to constant section
-        F_max = 20
-        l = self.get_param_by_name("l_motor_0")  # assuming all the same
-        CM = self.get_param_by_name("CM")
-        CT = self.get_param_by_name("CT")
-
-        k_p_att = np.array([5, 5, 2], dtype=float)
+        v[s["F_max"]] = 20
+        v[s["l"]] = self.param.l_motor[0]  # assuming all the same
+        v[s["CM"]] = self.param.CM
+        v[s["CT"]] = self.param.CT
+        v[s["k_p_att"]] = [5, 5, 2]
 
         # attitude rate
-        kp = np.array([0.3, 0.3, 0.05], dtype=float)
-        ki = np.array([0, 0, 0], dtype=float)
-        kd = np.array([0.1, 0.1, 0], dtype=float)
-        f_cut = 10.0
-        i_max = np.array([0, 0, 0], dtype=float)
-
-        # ---------------------------------------------------------------------
-        # differential flatness (reference trajectory -> reference signals)
-        # ---------------------------------------------------------------------
-        # [psi, psi_dot, psi_ddot, v_e, a_e, j_e, s_e, m, g, J_xx, J_yy, J_zz, J_xz],
-        # [v_b, C_be, omega_eb_b, omega_dot_eb_b, M_b, T],
-        self.eqs["mr_ref_traj"](
-            self.psi_sp,
-            self.psi_vel_sp,
-            self.psi_acc_sp,
-            self.vw_sp,
-            self.aw_sp,
-            self.jw_sp,
-            self.sw_sp,
-            m,
-            g,
-            self.get_param_by_name("Jx"),
-            self.get_param_by_name("Jy"),
-            self.get_param_by_name("Jz"),
-            0,
-        )
+        v[s["kp"]] = [0.3, 0.3, 0.05]
+        v[s["ki"]] = [0, 0, 0]
+        v[s["kd"]] = [0.1, 0.1, 0]
+        v[s["f_cut"]] = 10.0
+        v[s["i_max"]] = [0, 0, 0]
+        v[s["dt"]] = self.dt
 
         # ---------------------------------------------------------------------
-        # mode handling
+        # bezier curve at current time
         # ---------------------------------------------------------------------
-        if self.input_mode == "acro":
-            [omega_sp, thrust] = self.eqs["input_acro"](
-                thrust_trim, thrust_delta, self.input_aetr
-            )
-
-        elif self.input_mode == "auto_level":
-            [self.q_sp, thrust] = self.eqs["input_auto_level"](
-                thrust_trim,
-                thrust_delta,
-                self.input_aetr,
-                self.q,
-            )
-            omega_sp = self.eqs["attitude_control"](k_p_att, self.q, self.q_sp)
-
-        elif self.input_mode == "velocity":
-            reset_position = False
-            [
-                self.psi_sp,
-                self.psi_vel_sp,
-                self.pw_sp,
-                self.vw_sp,
-                self.aw_sp,
-                self.qc_sp,
-            ] = self.eqs["input_velocity"](
-                self.dt,
-                self.psi_sp,
-                self.pw_sp,
-                self.pw,
-                self.input_aetr,
-                reset_position,
-            )
-            if self.control_mode == "mellinger":
-                [thrust, self.q_sp, self.z_i] = self.eqs["position_control"](
-                    thrust_trim,
-                    self.pw_sp,
-                    self.vw_sp,
-                    self.aw_sp,
-                    self.qc_sp,
-                    self.pw,
-                    self.vw,
-                    self.z_i,
-                    self.dt,
+        if self.input_mode == "bezier":
+            sec, nanosec = self.get_clock().now().seconds_nanoseconds()
+            seg = self.bezier.segment(sec + 1e-9 * nanosec)
+            if seg is None:
+                self.get_logger().warn(
+                    "no bezier trajectory received, holding position setpoint",
+                    throttle_duration_sec=1.0,
                 )
-                omega_sp = self.eqs["attitude_control"](k_p_att, self.q, self.q_sp)
-            elif self.control_mode == "loglinear":
-                zeta = self.eqs["se23_error"](
-                    self.pw,
-                    self.vw,
-                    self.q,
-                    self.pw_sp,
-                    self.vw_sp,
-                    self.qc_sp,
-                )
-                # position control: world frame
-                [thrust, self.q_sp, self.z_i] = self.eqs["se23_position_control"](
-                    thrust_trim,
-                    k_p_att,
-                    zeta,
-                    self.aw_sp,
-                    self.qc_sp,
-                    self.z_i,
-                    self.dt,
-                )
-                # attitude control: q_br
-                omega_sp = self.eqs["so3_attitude_control"](k_p_att, self.q, self.q_sp)
-        elif self.input_mode == "bezier":
-            time_start_nsec = (
-                self.bezier_msg.time_start.sec * 1e9
-                + self.bezier_msg.time_start.nanosec
-            )
-            time_stop_nsec = time_start_nsec
-            now = self.get_clock().now()
-            sec, nanosec = now.seconds_nanoseconds()
-            time_nsec = sec * 1e9 + nanosec
-            curve_idx = 0
-
-            while True:
-                curve = self.bezier_msg.curves[curve_idx]
-                curve_prev = self.bezier_msg.curves[curve_idx - 1]
-                curve_stop_nsec = curve.time_stop.sec * 1e9 + curve.time_stop.nanosec
-                curve_prev_stop_nsec = (
-                    curve_prev.time_stop.sec * 1e9 + curve_prev.time_stop.nanosec
-                )
-                if time_nsec < curve_stop_nsec:
-                    time_stop_nsec = curve_stop_nsec
-                    if curve_idx > 0:
-                        time_start_nsec = curve_prev_stop_nsec
-                    break
-                curve_idx += 1
-            if curve_idx < len(self.bezier_msg.curves):
-                T = (time_stop_nsec - time_start_nsec) * 1e-9
-                t = (time_nsec - time_start_nsec) * 1e-9
-                for i in range(8):
-                    self.PX[i] = self.bezier_msg.curves[curve_idx].x[i]
-                    self.PY[i] = self.bezier_msg.curves[curve_idx].y[i]
-                    self.PZ[i] = self.bezier_msg.curves[curve_idx].z[i]
-                for i in range(4):
-                    self.Ppsi[i] = self.bezier_msg.curves[curve_idx].yaw[i]
-                [x, y, z, psi, dpsi, ddpsi, self.vw_sp, a, j, s] = self.eqs[
-                    "bezier_multirotor"
-                ](t, T, self.PX, self.PY, self.PZ, self.Ppsi)
-                [_, q_att, self.omega, _, M, _] = self.eqs["f_ref"](
-                    psi, dpsi, ddpsi, self.vw_sp, a, j, s
-                )
-                self.qc_sp = self.eqs["eulerB321_to_quat"](psi, 0, 0)
-                self.pw_sp = np.array([x, y, z]).reshape(-1)
-                print(
-                    thrust_trim,
-                    self.pw_sp,
-                    self.vw_sp,
-                    self.aw_sp,
-                    self.qc_sp,
-                    self.pw,
-                    self.vw,
-                    self.z_i,
-                    self.dt,
-                )
-                [thrust, self.q_sp, self.z_i] = self.eqs["position_control"](
-                    thrust_trim,
-                    self.pw_sp,
-                    self.vw_sp,
-                    self.aw_sp,
-                    self.qc_sp,
-                    self.pw,
-                    self.vw,
-                    self.z_i,
-                    self.dt,
-                )
-                omega_sp = self.eqs["attitude_control"](k_p_att, self.q, self.q_sp)
-
-        else:
-            self.get_logger().info("unhandled mode: %s" % self.input_mode)
-            omega_sp = np.zeros(3, dtype=float)
-            thrust = 0
+                seg = self.bezier.hold(self.pw_sp, self.psi_sp)
+            t, T, P = seg
+            v[s["t"]] = t
+            v[s["T"]] = T
+            self.PX[:] = P[0:8]
+            self.PY[:] = P[8:16]
+            self.PZ[:] = P[16:24]
+            self.Ppsi[:] = P[24:28]
+            v[s["PX"]] = self.PX
+            v[s["PY"]] = self.PY
+            v[s["PZ"]] = self.PZ
+            v[s["Ppsi"]] = self.Ppsi
 
         # ---------------------------------------------------------------------
-        # attitude rate control
+        # fused mode handling, position, attitude, rate control and allocation
         # ---------------------------------------------------------------------
-        # print(omega_sp, self.i0, self.e0, self.de0)
-        M, i1, e1, de1, alpha = self.eqs["attitude_rate_control"](
-            kp,
-            ki,
-            kd,
-            f_cut,
-            i_max,
-            self.omega,
-            omega_sp,
-            self.i0,
-            self.e0,
-            self.de0,
-            self.dt,
-        )
-        self.i0 = i1
-        # self.get_logger().info('i0: %s' % self.i0)
-        # self.get_logger().info('e0: %s' % self.e0)
-        # self.get_logger().info('de0: %s' % self.de0)
-        self.e0 = e1
-        self.de0 = de1
-
-        # ---------------------------------------------------------------------
-        # control allocation
-        # ---------------------------------------------------------------------
-        self.u, Fp, Fm, Ft, Msat = self.eqs["f_alloc"](F_max, l, CM, CT, thrust, M)
+        v[s["input_aetr"]] = np.reshape(self.input_aetr, -1)
+        v[s["reset_position"]] = False
+        v[s["q"]] = self.q
+        v[s["pw"]] = self.pw
+        v[s["vw"]] = self.vw
+        v[s["omega"]] = np.reshape(self.omega, -1)
+        v[s["psi_sp"]] = self.psi_sp
+        v[s["psi_vel_sp"]] = self.psi_vel_sp
+        v[s["pw_sp"]] = np.reshape(self.pw_sp, -1)
+        v[s["vw_sp"]] = np.reshape(self.vw_sp, -1)
+        v[s["aw_sp"]] = np.reshape(self.aw_sp, -1)
+        v[s["qc_sp"]] = np.reshape(self.qc_sp, -1)
+        v[s["q_sp"]] = np.reshape(self.q_sp, -1)
+        v[s["z_i"]] = self.z_i
+        v[s["i0"]] = self.i0
+        v[s["e0"]] = self.e0
+        v[s["de0"]] = self.de0
+        name = "controller_" + self.input_mode
+        if self.input_mode == "velocity":
+            name += "_" + self.control_mode
+        y = np.array(self.eqs[name](v), dtype=float).reshape(-1)
+
+        s = self.control_out
+        self.psi_sp = y[s["psi_sp1"]][0]
+        self.psi_vel_sp = y[s["psi_vel_sp1"]][0]
+        self.pw_sp = y[s["pw_sp1"]]
+        self.vw_sp = y[s["vw_sp1"]]
+        self.aw_sp = y[s["aw_sp1"]]
+        self.qc_sp = y[s["qc_sp1"]]
+        self.q_sp = y[s["q_sp1"]]
+        self.z_i = y[s["z_i1"]][0]
+        self.i0 = y[s["i1"]]
+        self.e0 = y[s["e1"]]
+        self.de0 = y[s["de1"]]
+        self.u = y[s["u"]]
         self.get_logger().info("Ct: %s" % self.u)
         # self.get_logger().info('u: %s' % self.u)
 
@@ -471,7 +376,14 @@ class Simulator(Node):
             self.control_mode = new_control_mode
 
     def bezier_callback(self, msg: BezierTrajectory):
-        self.bezier_msg = msg
+        self.bezier.extend(
+            msg.time_start.sec + 1e-9 * msg.time_start.nanosec,
+            [c.time_stop.sec + 1e-9 * c.time_stop.nanosec for c in msg.curves],
+            [c.x for c in msg.curves],
+            [c.y for c in msg.curves],
+            [c.z for c in msg.curves],
+            [c.yaw for c in msg.curves],
+        )
 
     def publish_static_transforms(self):
         msg_clock = self.clock_as_msg()
@@ -558,7 +470,7 @@ class Simulator(Node):
         # ---------------------------------------------------------------------
         # store states and measurements
         # ---------------------------------------------------------------------
-        self.x = np.array(res["xf"]).reshape(-1)
+        self.x[:] = x1
         res["yf_gyro"] = self.model["g_gyro"](
             res["xf"], self.u, self.p, np.random.randn(3), self.dt
         )
@@ -579,38 +491,10 @@ class Simulator(Node):
 
     def update_fake_estimator(self):
         # if not using estimator, use true states from sim
-        self.q = np.array(
-            [
-                self.get_state_by_name("quaternion_wb_0"),
-                self.get_state_by_name("quaternion_wb_1"),
-                self.get_state_by_name("quaternion_wb_2"),
-                self.get_state_by_name("quaternion_wb_3"),
-            ]
-        )
-        self.omega = np.array(
-            [
-                self.get_state_by_name("omega_wb_b_0"),
-                self.get_state_by_name("omega_wb_b_1"),
-                self.get_state_by_name("omega_wb_b_2"),
-            ],
-            dtype=float,
-        )
-        self.pw = np.array(
-            [
-                self.get_state_by_name("position_op_w_0"),
-                self.get_state_by_name("position_op_w_1"),
-                self.get_state_by_name("position_op_w_2"),
-            ],
-            dtype=float,
-        )
-        self.vb = np.array(
-            [
-                self.get_state_by_name("velocity_w_p_b_0"),
-                self.get_state_by_name("velocity_w_p_b_1"),
-                self.get_state_by_name("velocity_w_p_b_2"),
-            ],
-            dtype=float,
-        )
+        self.q = self.state.quaternion_wb
+        self.omega = self.state.omega_wb_b
+        self.pw = self.state.position_op_w
+        self.vb = self.state.velocity_w_p_b
         self.vw = self.eqs["rotate_vector_b_to_w"](self.q, self.vb)
 
     def timer_callback(self):
@@ -624,35 +508,12 @@ class Simulator(Node):
             # print("wrong")
         self.update_controller()
 
-    def get_state_by_name(self, name):
-        return self.x[self.model["x_index"][name]]
-
-    def get_param_by_name(self, name):
-        return self.p[self.model["p_index"][name]]
-
     def publish_state(self):
-        x = self.get_state_by_name("position_op_w_0")
-        y = self.get_state_by_name("position_op_w_1")
-        z = self.get_state_by_name("position_op_w_2")
-
-        wx = self.get_state_by_name("omega_wb_b_0")
-        wy = self.get_state_by_name("omega_wb_b_1")
-        wz = self.get_state_by_name("omega_wb_b_2")
-
-        vx = self.get_state_by_name("velocity_w_p_b_0")
-        vy = self.get_state_by_name("velocity_w_p_b_1")
-        vz = self.get_state_by_name("velocity_w_p_b_2")
-
-        qw = self.get_state_by_name("quaternion_wb_0")
-        qx = self.get_state_by_name("quaternion_wb_1")
-        qy = self.get_state_by_name("quaternion_wb_2")
-        qz = self.get_state_by_name("quaternion_wb_3")
-
-        m0 = self.get_state_by_name("omega_motor_0")
-        m1 = self.get_state_by_name("omega_motor_1")
-        m2 = self.get_state_by_name("omega_motor_2")
-        m3 = self.get_state_by_name("omega_motor_3")
-        motors = np.array([m0, m1, m2, m3])
+        x, y, z = self.state.position_op_w
+        wx, wy, wz = self.state.omega_wb_b
+        vx, vy, vz = self.state.velocity_w_p_b
+        qw, qx, qy, qz = self.state.quaternion_wb
+        motors = self.state.omega_motor
 
         P_full = np.array(
             [
@@ -690,9 +551,9 @@ class Simulator(Node):
 
         # publish motor tf2 transforms to see spin
         for i in range(self.model["n_motor"]):
-            theta = self.get_param_by_name("theta_motor_" + str(i))
-            r = self.get_param_by_name("l_motor_" + str(i))
-            dir = self.get_param_by_name("dir_motor_" + str(i))
+            theta = self.param.theta_motor[i]
+            r = self.param.l_motor[i]
+            dir = self.param.dir_motor[i]
             tf = TransformStamped()
             tf.header.frame_id = "base_link"
             tf.child_frame_id = "motor_{:d}".format(i)
@@ -758,13 +619,15 @@ class Simulator(Node):
         msg_pose_sp = PoseStamped()
         msg_pose_sp.header.stamp = msg_clock.clock
         msg_pose_sp.header.frame_id = "map"
-        msg_pose_sp.pose.position.x = float(self.pw_sp[0])
-        msg_pose_sp.pose.position.y = float(self.pw_sp[1])
-        msg_pose_sp.pose.position.z = float(self.pw_sp[2])
-        msg_pose_sp.pose.orientation.w = float(self.qc_sp[0])
-        msg_pose_sp.pose.orientation.x = float(self.qc_sp[1])
-        msg_pose_sp.pose.orientation.y = float(self.qc_sp[2])
-        msg_pose_sp.pose.orientation.z = float(self.qc_sp[3])
+        pw_sp = np.array(self.pw_sp, dtype=float).reshape(-1)
+        qc_sp = np.array(self.qc_sp, dtype=float).reshape(-1)
+        msg_pose_sp.pose.position.x = pw_sp[0]
+        msg_pose_sp.pose.position.y = pw_sp[1]
+        msg_pose_sp.pose.position.z = pw_sp[2]
+        msg_pose_sp.pose.orientation.w = qc_sp[0]
+        msg_pose_sp.pose.orientation.x = qc_sp[1]
+        msg_pose_sp.pose.orientation.y = qc_sp[2]
+        msg_pose_sp.pose.orientation.z = qc_sp[3]
         self.pub_pose_sp.publish(msg_pose_sp)
 
         # ------------------------------------
@@ -824,14 +687,19 @@ class Simulator(Node):
         # ------------------------------------
         # publish path message of previous poses
         # ------------------------------------
+        pose = self.path.next()
+        if pose is None:
+            return
+        pose.header.stamp = msg_clock.clock
+        pose.header.frame_id = "map"
+        pose.pose.position.x = x
+        pose.pose.position.y = y
+        pose.pose.position.z = z
+        pose.pose.orientation.w = qw
+        pose.pose.orientation.x = qx
+        pose.pose.orientation.y = qy
+        pose.pose.orientation.z = qz
         self.msg_path.header.stamp = msg_clock.clock
-        self.msg_path.header.frame_id = "map"
-        pose = PoseStamped()
-        pose.pose = msg_pose.pose.pose
-        pose.header = msg_pose.header
-        self.msg_path.poses.append(pose)
-        while len(self.msg_path.poses) > self.path_len:
-            self.msg_path.poses.pop(0)
         self.pub_path.publish(self.msg_path)
 
 
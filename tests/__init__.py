@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# derivations cached during the tests go to a directory removed at exit,
+# not the user's cache, set before cyecca.cache reads it
+_cache_dir = tempfile.TemporaryDirectory(prefix="cyecca_test_cache_")
+os.environ["CYECCA_CACHE_DIR"] = _cache_dir.name
@@ -2,9 +2,11 @@ from beartype import beartype
 
 import os
 import pickle
+import tempfile
 import numpy as np
 import time
 
+from cyecca import cache
 from cyecca.estimate.attitude import algorithms, launch
 from cyecca.estimate.attitude.plot import plot
 from tests.common import ProfiledTestCase
@@ -41,6 +43,10 @@ class Test_Attitude(ProfiledTestCase):
 
     def test_derive(self):
         eqs = algorithms.eqs(results_dir=self.results_dir)
+        self.assertEqual(eqs.derived(), [])
+        for name in eqs:
+            eqs[name]
+        self.assertEqual(eqs.derived(), list(algorithms.registry.keys()))
 
     def test_sim(self):
         params = {
@@ -105,6 +111,113 @@ class Test_Attitude(ProfiledTestCase):
             show=False,
         )
 
+    def test_monte_carlo_cache(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        params = {
+            "n_monte_carlo": 3,
+            "tf": 0.2,
+            "initialize": False,
+            "estimators": ["mrp"],
+            "x0": np.array([0.1, 0.2, 0.3, 0.07, 0.02, -0.07]),
+            "seed": 1234,
+            "cache_dir": tmp.name,
+        }
+        data = launch.launch_monte_carlo_sim(params)
+        self.assertEqual(len(os.listdir(params["cache_dir"])), 3)
+        # one sample per logger tick in [0, tf)
+        self.assertEqual(data.shape, (3, 40))
+
+        # trials are reproducible and cached trials are reused
+        params["n_monte_carlo"] = 4
+        data2 = launch.launch_monte_carlo_sim(params)
+        self.assertEqual(len(os.listdir(params["cache_dir"])), 4)
+        np.testing.assert_array_equal(data["imu"]["gyro"], data2[:3]["imu"]["gyro"])
+        params["cache_dir"] = None
+        data3 = launch.launch_monte_carlo_sim(params)
+        np.testing.assert_array_equal(data2["imu"]["gyro"], data3["imu"]["gyro"])
+        self.assertFalse(
+            np.array_equal(data3[0]["imu"]["gyro"], data3[1]["imu"]["gyro"])
+        )
+
+    def test_params_hash(self):
+        p = launch.init_params({"tf": 0.2})
+        key = launch.params_hash(p)
+        self.assertEqual(launch.params_hash(dict(p, seed=3)), key)
+        self.assertNotEqual(launch.params_hash(dict(p, tf=0.3)), key)
+        # a change to the code invalidates cached trials
+        source_hash = cache._source_hash
+        cache._source_hash = "edited"
+        try:
+            self.assertNotEqual(launch.params_hash(p), key)
+        finally:
+            cache._source_hash = source_hash
+
+    def test_sim_block_size(self):
+        params = {
+            "tf": 0.5,
+            "x0": np.array([0.1, 0.2, 0.3, 0.07, 0.02, -0.07]),
+            "seed": 42,
+        }
+        data = []
+        for block_size in [1, 7, 400]:
+            params["params"] = {"sim/block_size": block_size}
+            data.append(launch.launch_sim(params))
+        for d in data[1:]:
+            for topic in ["sim_attitude", "imu", "mag"]:
+                for field in d[topic].dtype.names:
+                    np.testing.assert_allclose(
+                        d[topic][field], data[0][topic][field], atol=1e-12
+                    )
+
+    def test_sim_set_param(self):
+        # params changed between ticks apply from the next tick, whether or
+        # not the tick is in a block that was already simulated
+        data = []
+        for block_size in [1, 400]:
+            p = launch.init_params(
+                {"seed": 7, "params": {"sim/block_size": block_size}}
+            )
+            core, logger = launch.setup_sim(p)
+
+            def change():
+                yield core.timeout(0.1012)
+                core.set_param("sim/g", 3.0)
+                core.set_param("sim/std_gyro", 0.1)
+                yield core.timeout(0.2)
+                core.set_param("sim/enable_noise", False)
+
+            core.process(change())
+            core.run(until=0.5)
+            data.append(logger.get_log_as_array())
+        for topic in ["sim_attitude", "imu", "mag"]:
+            for field in data[0][topic].dtype.names:
+                np.testing.assert_allclose(
+                    data[1][topic][field], data[0][topic][field], atol=1e-12
+                )
+        # the change took effect within the first block
+        t = data[1]["time"]
+        g = np.linalg.norm(data[1]["imu"]["accel"], axis=1)
+        self.assertGreater(g[t < 0.1].min(), 2 * g[(t > 0.11) & (t < 0.3)].max())
+
+    def test_bindings(self):
+        params = {
+            "tf": 1,
+            "initialize": False,
+            "estimators": ["mrp"],
+            "x0": np.array([0.1, 0.2, 0.3, 0.07, 0.02, -0.07]),
+            "seed": 7,
+        }
+        data = launch.launch_sim(params)
+        params["bindings"] = True
+        data_bind = launch.launch_sim(params)
+        for topic in ["mrp_attitude", "mrp_status"]:
+            for field in ["q", "x", "W", "beta_mag", "beta_accel"]:
+                if field in data[topic].dtype.names:
+                    np.testing.assert_allclose(
+                        data_bind[topic][field], data[topic][field], atol=1e-12
+                    )
+
     def test_generate_code(self):
         eqs = algorithms.eqs()
         algorithms.generate_code(eqs, os.path.join(self.results_dir, "code"))
@@ -0,0 +1,161 @@
+import time
+
+import numpy as np
+
+from cyecca.models import bezier, planner
+from ..common import ProfiledTestCase
+
+
+class Test_Bezier(ProfiledTestCase):
+    def test_grid(self):
+        rng = np.random.default_rng(0)
+        beta = np.linspace(0, 1, 30)
+        for n, m, eqs in [
+            (7, 4, bezier.derive_bezier7()),
+            (3, 2, bezier.derive_bezier3()),
+        ]:
+            f = eqs["bezier{:d}_traj".format(n)]
+            grid = bezier.BezierGrid(n, beta, m)
+            P = rng.uniform(-1, 1, (5, n + 1))
+            T = rng.uniform(0.5, 2, 5)
+            R = grid.eval(P, T)
+            self.assertEqual(R.shape, (5, m + 1, 30))
+
+            # symbolic batch over the same grid with map
+            f_map = f.map(beta.shape[0])
+            for i in range(5):
+                r = np.array(f_map(beta * T[i], T[i], P[i : i + 1]))
+                np.testing.assert_allclose(R[i], r, atol=1e-9)
+
+        # derivatives above the degree vanish
+        np.testing.assert_equal(bezier.bernstein_matrix(3, beta, 4), 0)
+
+    def test_grid_speed(self):
+        f = bezier.derive_bezier7()["bezier7_traj"]
+        beta = np.linspace(0, 1, 30)
+        P = np.random.default_rng(1).uniform(-1, 1, (3, 8))
+        start = time.perf_counter()
+        for i in range(3):
+            for b in beta:
+                f(b * 2.0, 2.0, P[i : i + 1])
+        scalar = time.perf_counter() - start
+        grid = bezier.BezierGrid(7, beta, 4)
+        start = time.perf_counter()
+        grid.eval(P, 2.0)
+        batched = time.perf_counter() - start
+        print(
+            "grid {:.3f} ms, point by point {:.3f} ms".format(
+                batched * 1e3, scalar * 1e3
+            )
+        )
+        self.assertLess(batched, scalar)
+
+    def test_flatness_table(self):
+        rng = np.random.default_rng(2)
+        n = 3
+        P = planner.MinSnapPlanner(n).plan(
+            np.cumsum(rng.uniform(-1, 1, (n + 1, 3)), axis=0), np.ones(n)
+        )
+        T = np.ones(n)
+        Ppsi = np.tile(np.linspace(0, 0.5, 4), (n, 1))
+        table = bezier.FlatnessTable(T, P[:, 0], P[:, 1], P[:, 2], Ppsi, 0.01)
+        eqs = bezier.derive_ref_table()
+        for t in [0, 0.123, 1.5, 2.999]:
+            s = int(t)
+            ref = eqs["bezier_ref"](
+                t - s, T[s], P[s, 0:1], P[s, 1:2], P[s, 2:3], Ppsi[s : s + 1]
+            )
+            for y, y_ref in zip(table.lookup(t), ref):
+                np.testing.assert_allclose(
+                    y, np.reshape(y_ref, -1), rtol=1e-3, atol=1e-3
+                )
+
+        # between grid points the attitude is quat_interp from the row below
+        for i, alpha in zip(rng.integers(0, len(table.t) - 1, 5), rng.uniform(0, 1, 5)):
+            q = table.lookup((i + alpha) * table.dt)[0]
+            q_ref = eqs["quat_interp"](table.quat[i], table.xi[i], alpha)
+            np.testing.assert_allclose(q, np.reshape(q_ref, -1), atol=1e-12)
+            self.assertAlmostEqual(np.linalg.norm(q), 1)
+
+        # the casadi call overhead dominates the lookup, time it compiled
+        table = bezier.FlatnessTable(
+            T, P[:, 0], P[:, 1], P[:, 2], Ppsi, 0.01, bindings=True
+        )
+        q = table.lookup((10 + 0.3) * table.dt)[0]
+        q_ref = eqs["quat_interp"](table.quat[10], table.xi[10], 0.3)
+        np.testing.assert_allclose(q, np.reshape(q_ref, -1), atol=1e-12)
+        start = time.perf_counter()
+        for k in range(100):
+            table.lookup(1.234)
+        lookup = (time.perf_counter() - start) / 100
+        start = time.perf_counter()
+        for k in range(100):
+            eqs["bezier_ref"](0.234, 1, P[1, 0:1], P[1, 1:2], P[1, 2:3], Ppsi[1:2])
+        direct = (time.perf_counter() - start) / 100
+        print(
+            "lookup {:.1f} us, flatness map {:.1f} us".format(
+                lookup * 1e6, direct * 1e6
+            )
+        )
+        self.assertLess(lookup, direct)
+
+    def test_trajectory_buffer(self):
+        rng = np.random.default_rng(3)
+        n = 2000
+        t_stop = 100 + np.cumsum(rng.uniform(0.5, 1, n))
+        PX, PY, PZ = rng.uniform(-1, 1, (3, n, 8))
+        Ppsi = rng.uniform(-1, 1, (n, 4))
+        buf = bezier.TrajectoryBuffer(capacity=16)
+        buf.extend(100, t_stop[:10], PX[:10], PY[:10], PZ[:10], Ppsi[:10])
+        buf.extend(100, t_stop, PX, PY, PZ, Ppsi)  # replaces the first message
+        self.assertEqual(len(buf), n)
+        self.assertIsNone(bezier.TrajectoryBuffer().segment(0))
+
+        f = bezier.derive_multirotor()["bezier_multirotor"]
+        for k, t in [(0, 100.1), (5, t_stop[4] + 0.1), (1000, t_stop[999] + 0.2)]:
+            T = t_stop[k] - (t_stop[k - 1] if k > 0 else 100)
+            t_seg, T_seg, P = buf.segment(t)
+            self.assertAlmostEqual(T_seg, T)
+            self.assertAlmostEqual(t_seg, t - t_stop[k] + T)
+            np.testing.assert_equal(P, np.hstack([PX[k], PY[k], PZ[k], Ppsi[k]]))
+            ref = f(
+                t_seg, T, PX[k : k + 1], PY[k : k + 1], PZ[k : k + 1], Ppsi[k : k + 1]
+            )
+            for y, y_ref in zip(buf.eval(t), ref):
+                np.testing.assert_allclose(np.array(y), np.array(y_ref))
+        # expired segments were dropped
+        self.assertEqual(len(buf), n - 1000)
+
+        # a later message replaces the tail and wraps around the ring
+        t_new = t_stop[1499] + np.cumsum(rng.uniform(0.5, 1, 1000))
+        buf.extend(t_stop[1499], t_new, PX[:1000], PY[:1000], PZ[:1000], Ppsi[:1000])
+        self.assertEqual(len(buf), 1500)
+        t_seg, T_seg, P = buf.segment(t_new[701] - 0.1)
+        self.assertAlmostEqual(T_seg, t_new[701] - t_new[700])
+        np.testing.assert_equal(P[:8], PX[701])
+
+        # the last segment is held
+        t_seg, T_seg, P = buf.segment(1e6)
+        self.assertEqual(len(buf), 1)
+        self.assertEqual(t_seg, T_seg)
+
+    def test_trajectory_buffer_empty(self):
+        buf = bezier.TrajectoryBuffer()
+        self.assertIsNone(buf.segment(1.0))
+        self.assertIsNone(buf.eval(1.0))
+
+        # the hold segment keeps the last setpoint at rest
+        t, T, P = buf.hold([1.0, 2.0, 3.0], 0.5)
+        f = bezier.derive_multirotor()["bezier_multirotor"]
+        ref = f(t, T, P[None, 0:8], P[None, 8:16], P[None, 16:24], P[None, 24:28])
+        np.testing.assert_allclose([float(y) for y in ref[0:4]], [1, 2, 3, 0.5])
+        np.testing.assert_allclose(np.reshape(ref[6], -1), 0, atol=1e-12)
+
+    def test_trajectory_buffer_bindings(self):
+        buf = bezier.TrajectoryBuffer(bindings=True)
+        P = np.arange(28.0).reshape(1, -1) / 28
+        buf.extend(0, [2], P[:, 0:8], P[:, 8:16], P[:, 16:24], P[:, 24:28])
+        f = bezier.derive_multirotor()["bezier_multirotor"]
+        ref = f(0.5, 2, P[:, 0:8], P[:, 8:16], P[:, 16:24], P[:, 24:28])
+        for y, y_ref in zip(buf.eval(0.5), ref):
+            np.testing.assert_allclose(np.reshape(y, -1), np.reshape(y_ref, -1))
@@ -0,0 +1,52 @@
+import time
+
+import numpy as np
+
+from cyecca.models import bezier, planner
+from ..common import ProfiledTestCase
+
+
+class Test_Planner(ProfiledTestCase):
+    def test_min_snap(self):
+        rng = np.random.default_rng(0)
+        n = 4
+        p = planner.MinSnapPlanner(n)
+        wp = np.cumsum(rng.uniform(-1, 1, (n + 1, 3)), axis=0)
+        T = rng.uniform(0.5, 2, n)
+        start = rng.uniform(-1, 1, (3, 3))
+        P = p.plan(wp, T, start=start)
+        self.assertEqual(P.shape, (n, 3, 8))
+
+        # waypoints, boundary conditions and continuity up to snap
+        grid = bezier.BezierGrid(7, [0, 1], 4)
+        R = np.stack([grid.eval(P[s], T[s]) for s in range(n)])
+        np.testing.assert_allclose(R[:, :, 0, 0], wp[:-1], atol=1e-8)
+        np.testing.assert_allclose(R[:, :, 0, 1], wp[1:], atol=1e-8)
+        np.testing.assert_allclose(R[0, :, 1:4, 0], start.T, atol=1e-8)
+        np.testing.assert_allclose(R[-1, :, 1:4, 1], 0, atol=1e-8)
+        np.testing.assert_allclose(R[1:, :, 1:, 0], R[:-1, :, 1:, 1], atol=1e-6)
+
+        # same solution as the dense KKT system
+        H, A = [np.array(M) for M in p.qp_matrices(T)]
+        b = A @ p.x
+        K = np.block([[H, A.T], [A, np.zeros((A.shape[0], A.shape[0]))]])
+        x = np.linalg.lstsq(K, np.hstack([np.zeros(H.shape[0]), b]), rcond=None)[0]
+        cost = lambda x: x @ H @ x
+        self.assertAlmostEqual(cost(p.x) / cost(x[: H.shape[0]]), 1, places=6)
+
+        with self.assertRaises(ValueError):
+            p.plan(wp[:-1], T)
+
+    def test_replan_speed(self):
+        rng = np.random.default_rng(1)
+        n = 50
+        p = planner.MinSnapPlanner(n)
+        wp = np.cumsum(rng.uniform(-1, 1, (n + 1, 3)), axis=0)
+        T = rng.uniform(0.5, 2, n)
+        p.plan(wp, T)
+        start = time.perf_counter()
+        for i in range(10):
+            p.plan(wp, T * (1 + 0.01 * i))
+        elapsed = (time.perf_counter() - start) / 10
+        print("replan {:d} segments: {:.2f} ms".format(n, elapsed * 1e3))
+        self.assertLess(elapsed, 0.1)
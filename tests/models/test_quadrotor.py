@@ -0,0 +1,38 @@
+import numpy as np
+
+from cyecca import util
+from cyecca.models import fixedwing, quadrotor
+from ..common import ProfiledTestCase
+
+
+class Test_Quadrotor(ProfiledTestCase):
+    def test_state_view(self):
+        for dynamics in [quadrotor, fixedwing]:
+            model = dynamics.derive_model()
+            for k in ["x", "u", "p"]:
+                index = model[k + "_index"]
+                dtype = model[k + "_dtype"]
+                self.assertEqual(dtype.itemsize, 8 * len(index))
+                v = np.arange(len(index), dtype=float)
+                view = v.view(dtype=dtype, type=np.recarray)[0]
+                for name, i in index.items():
+                    base, _, num = name.rpartition("_")
+                    if name in dtype.names:
+                        self.assertEqual(view[name], i)
+                    else:
+                        self.assertEqual(view[base][int(num)], i)
+
+        # views share memory with the vector, writes go both ways
+        model = quadrotor.derive_model()
+        x = np.zeros(len(model["x_index"]))
+        state = x.view(dtype=model["x_dtype"], type=np.recarray)[0]
+        x[:] = np.arange(x.shape[0])
+        np.testing.assert_equal(state.quaternion_wb, [6, 7, 8, 9])
+        state.omega_wb_b[:] = 1
+        self.assertEqual(x[model["x_index"]["omega_wb_b_2"]], 1)
+
+    def test_structured_dtype(self):
+        dtype = util.structured_dtype({"a_0": 0, "a_1": 1, "b_0": 2, "c": 3})
+        self.assertEqual(dtype, np.dtype([("a", "f8", 2), ("b_0", "f8"), ("c", "f8")]))
+        with self.assertRaises(ValueError):
+            util.structured_dtype({"a": 1})
@@ -0,0 +1,148 @@
+import time
+
+import casadi as ca
+import numpy as np
+
+from cyecca import util
+from cyecca.models import bezier, rdd2, rdd2_loglinear
+from ..common import ProfiledTestCase
+
+
+def control_chain(eqs, input_mode, control_mode, v):
+    """
+    The separate calls of rdd2_sim.Simulator.update_controller
+    """
+    v = dict(v)
+    if input_mode == "acro":
+        omega_sp, thrust = eqs["input_acro"](
+            v["thrust_trim"], v["thrust_delta"], v["input_aetr"]
+        )
+    elif input_mode == "auto_level":
+        q_sp, thrust = eqs["input_auto_level"](
+            v["thrust_trim"], v["thrust_delta"], v["input_aetr"], v["q"]
+        )
+        omega_sp = eqs["attitude_control"](v["k_p_att"], v["q"], q_sp)
+    elif input_mode == "velocity":
+        psi_sp, psi_vel_sp, pw_sp, vw_sp, aw_sp, qc_sp = eqs["input_velocity"](
+            v["dt"], v["psi_sp"], v["pw_sp"], v["pw"], v["input_aetr"], 0
+        )
+        if control_mode == "mellinger":
+            thrust, q_sp, z_i = eqs["position_control"](
+                v["thrust_trim"],
+                pw_sp,
+                vw_sp,
+                aw_sp,
+                qc_sp,
+                v["pw"],
+                v["vw"],
+                v["z_i"],
+                v["dt"],
+            )
+            omega_sp = eqs["attitude_control"](v["k_p_att"], v["q"], q_sp)
+        else:
+            zeta = eqs["se23_error"](v["pw"], v["vw"], v["q"], pw_sp, vw_sp, qc_sp)
+            thrust, q_sp, z_i = eqs["se23_position_control"](
+                v["thrust_trim"], v["k_p_att"], zeta, aw_sp, qc_sp, v["z_i"], v["dt"]
+            )
+            omega_sp = eqs["so3_attitude_control"](v["k_p_att"], v["q"], q_sp)
+    elif input_mode == "bezier":
+        x, y, z, psi, dpsi, ddpsi, vw_sp, a, j, s = eqs["bezier_multirotor"](
+            v["t"], v["T"], v["PX"], v["PY"], v["PZ"], v["Ppsi"]
+        )
+        _, q_att, v["omega"], _, M, _ = eqs["f_ref"](psi, dpsi, ddpsi, vw_sp, a, j, s)
+        qc_sp = eqs["eulerB321_to_quat"](psi, 0, 0)
+        pw_sp = np.array([x, y, z]).reshape(-1)
+        thrust, q_sp, z_i = eqs["position_control"](
+            v["thrust_trim"],
+            pw_sp,
+            vw_sp,
+            v["aw_sp"],
+            qc_sp,
+            v["pw"],
+            v["vw"],
+            v["z_i"],
+            v["dt"],
+        )
+        omega_sp = eqs["attitude_control"](v["k_p_att"], v["q"], q_sp)
+    M, i1, e1, de1, alpha = eqs["attitude_rate_control"](
+        v["kp"],
+        v["ki"],
+        v["kd"],
+        v["f_cut"],
+        v["i_max"],
+        v["omega"],
+        omega_sp,
+        v["i0"],
+        v["e0"],
+        v["de0"],
+        v["dt"],
+    )
+    u, Fp, Fm, Ft, Msat = eqs["f_alloc"](
+        v["F_max"], v["l"], v["CM"], v["CT"], thrust, M
+    )
+    return {"u": u, "M": M, "omega_sp": omega_sp, "i1": i1}
+
+
+class Test_Rdd2(ProfiledTestCase):
+    def test_fused_controller(self):
+        eqs = {}
+        eqs.update(rdd2.derive_input_acro())
+        eqs.update(rdd2.derive_input_auto_level())
+        eqs.update(rdd2.derive_input_velocity())
+        eqs.update(rdd2.derive_position_control())
+        eqs.update(rdd2.derive_attitude_control())
+        eqs.update(rdd2.derive_attitude_rate_control())
+        eqs.update(rdd2.derive_control_allocation())
+        eqs.update(rdd2_loglinear.derive_se23_error())
+        eqs.update(rdd2_loglinear.derive_so3_attitude_control())
+        eqs.update(rdd2_loglinear.derive_outerloop_control())
+        eqs.update(bezier.derive_multirotor())
+        eqs.update(bezier.derive_ref())
+        eqs.update(bezier.derive_eulerB321_to_quat())
+
+        controllers = rdd2.derive_controllers()
+        self.assertEqual(len(controllers), 5)
+        rng = np.random.default_rng(0)
+        for name, f in controllers.items():
+            # all modes share one signature
+            self.assertEqual(f.name_in(), controllers["controller_acro"].name_in())
+            v = {
+                k: rng.uniform(0.1, 1, f.sparsity_in(i).shape)
+                for i, k in enumerate(f.name_in())
+            }
+            v["q"] = v["q"] / np.linalg.norm(v["q"])
+            v["qc_sp"] = v["qc_sp"] / np.linalg.norm(v["qc_sp"])
+            v["T"] = 2.0
+            v["reset_position"] = 0
+            mode = name.split("_", 1)[1]
+            input_mode, control_mode = mode, "mellinger"
+            if mode.startswith("velocity"):
+                input_mode, control_mode = mode.split("_")
+            res = f(**v)
+            expected = control_chain(eqs, input_mode, control_mode, v)
+            for k, y in expected.items():
+                np.testing.assert_allclose(res[k], y, atol=1e-9, err_msg=name)
+
+        # one call of a single packed vector instead of a chain of calls
+        f = controllers["controller_velocity_mellinger"]
+        f_packed, s_in, s_out = util.pack_function(f)
+        x = np.zeros(f_packed.size1_in(0))
+        for k, s in s_in.items():
+            x[s] = np.reshape(v[k], -1, order="F")
+        y = np.array(f_packed(x)).reshape(-1)
+        res = f(**v)
+        for k, s in s_out.items():
+            np.testing.assert_allclose(y[s], np.reshape(res[k], -1, order="F"))
+        start = time.perf_counter()
+        for i in range(100):
+            f_packed(x)
+        fused = (time.perf_counter() - start) / 100
+        start = time.perf_counter()
+        for i in range(100):
+            control_chain(eqs, "velocity", "mellinger", v)
+        chain = (time.perf_counter() - start) / 100
+        print("\nchain {:.3g} ms, fused {:.3g} ms".format(1e3 * chain, 1e3 * fused))
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            rdd2.derive_controller("hover")
@@ -0,0 +1,239 @@
+import copy
+import multiprocessing as mp
+import os
+import tempfile
+import time
+
+import numpy as np
+import simpy
+
+from cyecca.sim import msgs, uros
+from cyecca.sim.log import LogBuffer, LogReader, LogSpec, LogWriter, SharedArray
+from ..common import ProfiledTestCase
+
+
+def make_core():
+    core = uros.Core()
+    uros.Publisher(core, "imu", msgs.Imu)
+    uros.Publisher(core, "mag", msgs.Mag)
+    uros.Publisher(core, "est_status", msgs.EstimatorStatus)
+    return core
+
+
+class Test_LogBuffer(ProfiledTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dtype = msgs.Log(make_core()).dtype
+
+    def test_append_chunks(self):
+        buf = LogBuffer(self.dtype, chunk_size=7)
+        rec = msgs.init_data(self.dtype)
+        for i in range(20):
+            rec["time"] = i
+            buf.append(rec)
+        data = buf.array()
+        self.assertEqual(len(buf.chunks), 3)
+        self.assertEqual(data.shape, (20,))
+        self.assertTrue(np.all(data["time"] == np.arange(20)))
+
+    def test_next_record(self):
+        buf = LogBuffer(self.dtype, chunk_size=4)
+        for i in range(5):
+            rec = buf.next_record()
+            rec["time"] = i
+            rec["imu"]["gyro"] = [i, 2 * i, 3 * i]
+        data = buf.array()
+        self.assertTrue(np.all(data["imu"]["gyro"][:, 1] == 2 * np.arange(5)))
+
+    def test_memmap(self):
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, "log.bin")
+            buf = LogBuffer(self.dtype, chunk_size=3, filename=filename)
+            rec = msgs.init_data(self.dtype)
+            for i in range(10):
+                rec["time"] = i
+                buf.append(rec)
+            data = buf.array()
+            self.assertIsInstance(data, np.memmap)
+            self.assertTrue(np.all(data["time"] == np.arange(10)))
+            del data, buf
+
+    def test_logger(self):
+        core = make_core()
+        logger = uros.Logger(core, chunk_size=16)
+        core.init_params()
+        core.run(until=1)
+        data = logger.get_log_as_array()
+        self.assertEqual(data.shape, (200,))
+        self.assertTrue(np.allclose(np.diff(data["time"]), 1.0 / 200))
+
+    def test_benchmark(self):
+        n = 10**6
+        rec = msgs.init_data(self.dtype)
+
+        buf = LogBuffer(self.dtype, chunk_size=2**16)
+        start = time.perf_counter()
+        for i in range(n):
+            rec["time"] = i
+            buf.append(rec)
+        data = buf.array()
+        elapsed_buffer = time.perf_counter() - start
+        self.assertEqual(data.shape, (n,))
+
+        n_list = n // 10
+        data_list = []
+        start = time.perf_counter()
+        for i in range(n_list):
+            rec["time"] = i
+            data_list.append(copy.deepcopy(rec))
+        np.array(data_list, dtype=self.dtype)
+        elapsed_list = (time.perf_counter() - start) * n / n_list
+
+        print("\n\nlog buffer benchmark")
+        print("-" * 30)
+        print("ticks\t\t\t:", n)
+        print("record bytes\t:", self.dtype.itemsize)
+        print("buffer, sec\t\t:", np.round(elapsed_buffer, 3))
+        print("list, sec\t\t:", np.round(elapsed_list, 3), "(extrapolated)")
+
+
+class Test_LogWriter(ProfiledTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dtype = msgs.Log(make_core()).dtype
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log_dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        super().tearDown()
+
+    def write(self, n, chunk_size):
+        writer = LogWriter(self.dtype, self.log_dir, chunk_size=chunk_size)
+        rec = msgs.init_data(self.dtype)
+        for i in range(n):
+            rec["time"] = i
+            rec["imu"]["gyro"] = [i, -i, 2 * i]
+            writer.append(rec)
+        return writer
+
+    def test_bounded_chunks(self):
+        writer = self.write(25, chunk_size=10)
+        self.assertEqual(writer.chunk_rows, [10, 10])
+        self.assertEqual(writer._chunk.shape, (10,))
+        reader = writer.array()
+        self.assertEqual(reader.chunk_rows, [10, 10, 5])
+        self.assertEqual(len(reader), 25)
+
+    def test_reader(self):
+        reader = self.write(25, chunk_size=10).array()
+        self.assertTrue(np.all(reader["time"] == np.arange(25)))
+        window = reader[5:-3]
+        self.assertEqual(len(window), 17)
+        self.assertTrue(np.all(window["imu"]["gyro"][:, 2] == 2 * np.arange(5, 22)))
+        self.assertTrue(np.all(reader[12:18]["time"] == np.arange(12, 18)))
+        self.assertIsInstance(reader[12:18]["time"], np.memmap)
+        self.assertEqual(reader[-1]["time"], 24)
+        data = reader.to_array()
+        self.assertEqual(data.dtype, self.dtype)
+        self.assertTrue(np.all(data["imu"]["gyro"][:, 1] == -np.arange(25)))
+        with self.assertRaises(KeyError):
+            reader["not_a_topic"]
+
+    def test_logger(self):
+        core = make_core()
+        logger = uros.Logger(core, chunk_size=64, log_dir=self.log_dir)
+        core.init_params()
+        core.run(until=1)
+        data = logger.get_log_as_array()
+        self.assertIsInstance(data, LogReader)
+        self.assertEqual(len(data), 200)
+        self.assertEqual(len(LogReader(self.log_dir)["time"]), 200)
+
+
+def publish_imu(core, dt):
+    pub = core._publishers["imu"]
+    msg = msgs.Imu()
+    while True:
+        msg.data["time"] = core.now
+        msg.data["gyro"] = [core.now, 0, 0]
+        pub.publish(msg)
+        yield simpy.Timeout(core, dt)
+
+
+class Test_LogSpec(ProfiledTestCase):
+    def run_logger(self, spec):
+        core = make_core()
+        logger = uros.Logger(core, spec=spec)
+        simpy.Process(core, publish_imu(core, 0.01))
+        core.init_params()
+        core.run(until=1)
+        return logger
+
+    def test_select(self):
+        logger = self.run_logger(LogSpec(topics=["imu", "mag"], exclude=["mag"]))
+        data = logger.get_log_as_array()
+        self.assertEqual(data.dtype.names, ("time", "imu"))
+        self.assertNotIn("mag", logger.subs)
+        self.assertIn("params", logger.subs)
+
+    def test_fields(self):
+        spec = LogSpec(fields={"imu": ["gyro"], "est_status": ["time", "beta_mag"]})
+        data = self.run_logger(spec).get_log_as_array()
+        self.assertEqual(data.dtype["imu"].names, ("gyro",))
+        self.assertEqual(data.dtype["est_status"].names, ("time", "beta_mag"))
+        self.assertLess(data.dtype.itemsize, msgs.Log(make_core()).dtype.itemsize)
+        self.assertAlmostEqual(data["imu"]["gyro"][-1, 0], 0.99)
+
+    def test_rates(self):
+        logger = self.run_logger(LogSpec(rates={"imu": 0.125}))
+        self.assertNotIn("imu", logger.get_log_as_array().dtype.names)
+        data = logger.get_topic_log_as_array("imu")
+        self.assertEqual(data.shape, (8,))
+        self.assertTrue(
+            np.all(np.abs(data["imu"]["gyro"][1:, 0] - data["time"][1:]) < 0.011)
+        )
+
+    def test_triggers(self):
+        spec = LogSpec(triggers={"imu": lambda msg: msg.data["gyro"][0] > 0.895})
+        data = self.run_logger(spec).get_event_log_as_array()
+        self.assertEqual(data.shape, (10,))
+        self.assertTrue(np.all(data["imu"]["gyro"][:, 0] > 0.895))
+
+    def test_bad_spec(self):
+        with self.assertRaises(KeyError):
+            self.run_logger(LogSpec(topics=["not_a_topic"]))
+        with self.assertRaises(ValueError):
+            LogSpec(rates={"imu": 0})
+        with self.assertRaises(ValueError):
+            self.run_logger(LogSpec(exclude=["imu"], triggers={"imu": lambda m: True}))
+
+
+def fill_row(args):
+    name, shape, dtype, i = args
+    shm, data = SharedArray.attach(name, shape, dtype)
+    data[i]["time"] = i
+    del data
+    shm.close()
+    return i
+
+
+class Test_SharedArray(ProfiledTestCase):
+    def test_pool(self):
+        dtype = msgs.Imu.dtype
+        shape = (4, 10)
+        data = SharedArray.create(shape, dtype)
+        args = [(data.shm_name, shape, dtype, i) for i in range(shape[0])]
+        with mp.Pool(2) as pool:
+            pool.map(fill_row, args)
+        data.unlink()
+        np.testing.assert_equal(data["time"][:, 0], np.arange(4))
+        self.assertEqual(np.sum(data["gyro"]), 0)
+
+    def test_view_lifetime(self):
+        data = SharedArray.create((1000,), "f8")
+        data[:] = 2
+        view = data[10:].view(np.ndarray)
+        data.unlink()
+        del data
+        self.assertEqual(np.sum(view), 2 * 990)
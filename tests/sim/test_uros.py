@@ -0,0 +1,230 @@
+import time
+
+import casadi as ca
+import numpy as np
+
+from cyecca.sim import msgs, uros
+from ..common import ProfiledTestCase
+
+
+class Test_Dispatch(ProfiledTestCase):
+    def setUp(self):
+        super().setUp()
+        self.received = []
+
+    def make_core(self, **kwargs):
+        core = uros.Core(**kwargs)
+        pub = uros.Publisher(core, "imu", msgs.Imu)
+        uros.Subscriber(core, "imu", msgs.Imu, self.received.append)
+        uros.Subscriber(core, "imu", msgs.Imu, lambda msg: None)
+        return core, pub
+
+    def test_compile(self):
+        core, pub = self.make_core()
+        self.assertIsNone(pub._callbacks)
+        pub.publish(msgs.Imu())
+        core.pub_sub_locked = True
+        self.assertEqual(len(pub._callbacks), 2)
+        self.assertEqual(core.pub_params._callbacks, ())
+        pub.publish(msgs.Imu())
+        self.assertEqual(len(self.received), 2)
+        with self.assertRaises(AssertionError):
+            uros.Subscriber(core, "imu", msgs.Imu, lambda msg: None)
+
+    def test_type_check(self):
+        core, pub = self.make_core()
+        core.pub_sub_locked = True
+        with self.assertRaises(ValueError):
+            pub.publish(msgs.Mag())
+        core.type_check = False
+        pub.publish(msgs.Mag())
+        self.assertEqual(len(self.received), 1)
+
+    def test_publish_batch(self):
+        core, pub = self.make_core()
+        core.pub_sub_locked = True
+        batch = [msgs.Imu() for i in range(5)]
+        pub.publish_batch(batch)
+        self.assertEqual(self.received, batch)
+        with self.assertRaises(ValueError):
+            pub.publish_batch([msgs.Imu(), msgs.Mag()])
+
+    def test_benchmark(self):
+        n = 10**5
+        msg = msgs.Imu()
+        batch = [msg] * n
+        print("\n\ndispatch benchmark, messages per second")
+        print("-" * 30)
+        for label, kwargs, locked in [
+            ("uncompiled", {}, False),
+            ("compiled", {}, True),
+            ("no type check", {"type_check": False}, True),
+        ]:
+            core, pub = self.make_core(**kwargs)
+            core.pub_sub_locked = locked
+            start = time.perf_counter()
+            for i in range(n):
+                pub.publish(msg)
+            elapsed = time.perf_counter() - start
+            print("{:s}\t\t: {:.3g}".format(label, n / elapsed))
+        start = time.perf_counter()
+        pub.publish_batch(batch)
+        elapsed = time.perf_counter() - start
+        print("batch\t\t\t: {:.3g}".format(n / elapsed))
+        self.assertEqual(len(self.received), 4 * n)
+
+
+class Test_NanGuard(ProfiledTestCase):
+    def make_guard(self, **params):
+        core = uros.Core()
+        guard = uros.NanGuard(core, "est")
+        core.init_params()
+        for k, v in params.items():
+            core.set_param("est/" + k, v)
+        return guard
+
+    def test_raise(self):
+        guard = self.make_guard()
+        self.assertTrue(guard.check("predict", 0.0, ("x",), (ca.DM([1, 2]),)))
+        with self.assertRaises(ValueError):
+            guard.check("predict", 1.0, ("x", "W"), (np.zeros(3), ca.DM([np.inf])))
+        self.assertEqual(guard.n_fail, 1)
+
+    def test_record(self):
+        guard = self.make_guard(nan_check_raise=False)
+        for t in range(3):
+            x = np.array([np.nan if t > 0 else 0.0])
+            guard.check("predict", float(t), ("x",), (x,))
+        self.assertEqual(guard.n_fail, 2)
+        self.assertEqual(guard.t_first_fail, 1.0)
+        self.assertIn("est predict @ 1.000000 sec x", guard.first_fail)
+
+    def test_code(self):
+        guard = self.make_guard(nan_check_raise=False)
+        guard.register("predict", ("x", "W"))
+        self.assertEqual(guard.first_fail_code, 0)
+        guard.check("correct", 0.0, ("y",), (np.array([np.nan]),))
+        guard.check("predict", 1.0, ("x", "W"), (np.zeros(1), np.array([np.nan])))
+        self.assertEqual(guard.quantities, ["predict/x", "predict/W", "correct/y"])
+        self.assertEqual(guard.first_fail_code, 3)
+
+        # logged as floats, like the other status codes
+        msg = msgs.EstimatorStatus()
+        msg.data["nan_count"] = guard.n_fail
+        msg.data["nan_first"] = guard.first_fail_code
+        self.assertEqual(msg.data["nan_first"], 3.0)
+        self.assertEqual(msg.data.dtype["nan_count"], msg.data.dtype["accel_ret"])
+
+    def test_period(self):
+        guard = self.make_guard(nan_check_raise=False, nan_check_period=3)
+        for i in range(9):
+            guard.check("predict", 0.0, ("x",), (np.array([np.nan]),))
+        self.assertEqual(guard.n_fail, 3)
+
+    def test_off(self):
+        guard = self.make_guard(nan_check_period=0)
+        self.assertTrue(guard.check("predict", 0.0, ("x",), (np.array([np.nan]),)))
+        self.assertEqual(guard.n_fail, 0)
+
+
+class Test_Profile(ProfiledTestCase):
+    def test_histogram(self):
+        hist = uros.LatencyHistogram()
+        for dt in np.linspace(1e-6, 1e-3, 1000):
+            hist.record(dt)
+        hist.record(0.0)
+        hist.record(1e3)
+        self.assertEqual(hist.count, 1002)
+        self.assertEqual(hist.max, 1e3)
+        self.assertAlmostEqual(hist.quantile(0.5), 5e-4, delta=1e-4)
+        self.assertEqual(hist.quantile(1.0), 1e3)
+        self.assertTrue(np.isnan(uros.LatencyHistogram().quantile(0.5)))
+
+    def test_core(self):
+        core = uros.Core(profile=True)
+        pub = uros.Publisher(core, "imu", msgs.Imu)
+        uros.Subscriber(core, "imu", msgs.Imu, lambda msg: None)
+
+        def run():
+            for i in range(10):
+                pub.publish(msgs.Imu())
+                yield core.timeout(1)
+
+        core.process(run(), "imu_pub")
+        core.pub_sub_locked = True
+        core.run(until=20)
+        names = list(core.profile_data.keys())
+        self.assertIn("proc imu_pub", names)
+        self.assertIn("sub imu Test_Profile.test_core", names)
+        wall, cpu = core.profile_data["sub imu Test_Profile.test_core"]
+        self.assertEqual(wall.count, 10)
+        self.assertEqual(cpu.count, 10)
+        self.assertEqual(core.profile_data["proc imu_pub"][0].count, 11)
+        print(core.profile_summary())
+
+    def test_disabled(self):
+        core = uros.Core()
+        uros.Logger(core)
+        core.run(until=1)
+        self.assertEqual(core.profile_data, {})
+
+
+class Test_RateGroups(ProfiledTestCase):
+    def test_multi_rate(self):
+        core = uros.Core()
+        dt_imu = uros.Param(core, "dt_imu", 1.0 / 200, "f8")
+        calls = []
+        for name, dt in [("mag", 1.0 / 50), ("imu", dt_imu), ("sim", 1.0 / 400)]:
+            core.add_rate_task(lambda name=name: calls.append((name, core.now)), dt)
+        core.run(until=1 + 1e-6)
+        counts = {
+            n: len([c for c in calls if c[0] == n]) for n in ["sim", "imu", "mag"]
+        }
+        self.assertEqual(counts, {"sim": 401, "imu": 201, "mag": 51})
+        # faster tasks run first within a tick, times are exact multiples
+        self.assertEqual([c[0] for c in calls[:3]], ["sim", "imu", "mag"])
+        t_mag = np.array([t for n, t in calls if n == "mag"])
+        np.testing.assert_allclose(t_mag, np.arange(51) / 50, rtol=0, atol=1e-12)
+
+    def test_task_runs(self):
+        for until in [1, 1 + 1e-6, 0.999, 0.3, 0.1234]:
+            core = uros.Core()
+            tasks = {}
+            for name, dt in [("mag", 1.0 / 50), ("imu", 1.0 / 200), ("sim", 0.0025)]:
+                calls = []
+                tasks[name] = (lambda calls=calls: calls.append(core.now)), calls
+                core.add_rate_task(tasks[name][0], dt)
+            runs = {k: core.rate_task_runs(f, until) for k, (f, c) in tasks.items()}
+            core.run(until=until)
+            self.assertEqual(runs, {k: len(c) for k, (f, c) in tasks.items()})
+        with self.assertRaises(KeyError):
+            core.rate_task_runs(lambda: None, 1)
+
+    def test_param_period(self):
+        core = uros.Core()
+        dt = uros.Param(core, "dt", 0.1, "f8")
+        uros.Subscriber(core, "params", msgs.Params, lambda msg: dt.update())
+        calls = []
+        core.add_rate_task(lambda: calls.append(core.now), dt)
+        core.init_params()
+        core.set_param("dt", 0.25)
+        core.run(until=1.1)
+        self.assertEqual(len(calls), 5)
+
+    def test_errors(self):
+        core = uros.Core()
+        core.add_rate_task(lambda: None, 0.1)
+        core.add_rate_task(lambda: None, 0.15)
+        with self.assertRaises(ValueError):
+            core.run(until=1)
+        core = uros.Core()
+        core.add_rate_task(lambda: None, 0.1)
+        core.run(until=1)
+        with self.assertRaises(RuntimeError):
+            core.add_rate_task(lambda: None, 0.1)
+
+    def test_profile(self):
+        core = uros.Core(profile=True)
+        core.add_rate_task(lambda: None, 0.1, "noop")
+        core.run(until=1.05)
+        self.assertEqual(core.profile_data["task noop"][0].count, 11)
@@ -0,0 +1,25 @@
+from cyecca.sim.window import MessageWindow
+from ..common import ProfiledTestCase
+
+
+class Test_MessageWindow(ProfiledTestCase):
+    def test_reuse(self):
+        items = []
+        window = MessageWindow(dict, 3, items=items)
+        for i in range(7):
+            window.next()["i"] = i
+        self.assertEqual([m["i"] for m in items], [4, 5, 6])
+        # the oldest message is moved to the end, nothing is allocated
+        pool = [id(m) for m in window.pool]
+        self.assertEqual(sorted(id(m) for m in items), sorted(pool))
+        first = items[0]
+        self.assertIs(window.next(), first)
+        self.assertIs(items[-1], first)
+
+    def test_decimation(self):
+        window = MessageWindow(dict, 2, decimation=3)
+        kept = [i for i in range(9) if window.next() is not None]
+        self.assertEqual(kept, [2, 5, 8])
+        self.assertEqual(len(window.items), 2)
+        with self.assertRaises(ValueError):
+            MessageWindow(dict, 2, decimation=0)
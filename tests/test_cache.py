@@ -0,0 +1,88 @@
+import os
+import tempfile
+import time
+
+import casadi as ca
+
+from cyecca import cache
+from cyecca.models import rdd2
+from .common import ProfiledTestCase
+
+gain = 2.0
+calls = []  # a list, module level numbers are part of the key
+
+
+@cache.cached
+def derive_gain(n=1):
+    calls.append(n)
+    x = ca.SX.sym("x", n)
+    return {"f_gain": ca.Function("f_gain", [x], [gain * x])}
+
+
+class Test_Cache(ProfiledTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = cache.cache_dir
+        self.enabled = cache.enabled
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        cache.cache_dir = tmp.name
+        cache.enabled = True
+
+    def tearDown(self):
+        cache.cache_dir = self.cache_dir
+        cache.enabled = self.enabled
+        super().tearDown()
+
+    def test_hit(self):
+        global gain
+        n0 = len(calls)
+        f1 = derive_gain()["f_gain"]
+        f2 = derive_gain()["f_gain"]
+        self.assertEqual(len(calls), n0 + 1)
+        self.assertTrue(os.listdir(cache.cache_dir)[0].endswith(".casadi"))
+        self.assertEqual(float(f1(3)), float(f2(3)))
+
+        # arguments and module constants are part of the key
+        derive_gain(n=2)
+        self.assertEqual(len(calls), n0 + 2)
+        gain = 3.0
+        self.assertEqual(float(derive_gain()["f_gain"](1)), 3.0)
+        gain = 2.0
+        self.assertEqual(len(calls), n0 + 3)
+
+    def test_arguments(self):
+        # a repr with an address would give a new key every run
+        with self.assertRaises(TypeError):
+            derive_gain(n=object())
+        self.assertEqual(os.listdir(cache.cache_dir), [])
+
+    def test_corrupt(self):
+        derive_gain()
+        for f in os.listdir(cache.cache_dir):
+            with open(os.path.join(cache.cache_dir, f), "wb") as fp:
+                fp.write(b"garbage")
+        self.assertEqual(float(derive_gain()["f_gain"](1)), 2.0)
+
+    def test_disabled(self):
+        cache.enabled = False
+        n0 = len(calls)
+        derive_gain()
+        derive_gain()
+        self.assertEqual(len(calls), n0 + 2)
+        self.assertEqual(os.listdir(cache.cache_dir), [])
+
+    def test_rdd2(self):
+        start = time.perf_counter()
+        eqs = rdd2.derive_position_control()
+        derive = time.perf_counter() - start
+        start = time.perf_counter()
+        eqs_cached = rdd2.derive_position_control()
+        load = time.perf_counter() - start
+        print("\nderive {:.3f} s, load {:.3f} s".format(derive, load))
+        f1 = eqs["position_control"]
+        f2 = eqs_cached["position_control"]
+        self.assertEqual(f1.name_in(), f2.name_in())
+        self.assertEqual(f1.name_out(), f2.name_out())
+        cache.clear()
+        self.assertEqual(os.listdir(cache.cache_dir), [])
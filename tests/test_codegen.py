@@ -0,0 +1,399 @@
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import casadi as ca
+import numpy as np
+
+from cyecca import codegen
+from cyecca.estimate.attitude import algorithms
+from cyecca.models import rdd2
+from .common import ProfiledTestCase
+
+
+class Test_CompileAndLoad(ProfiledTestCase):
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache_dir = tmp.name
+
+    def test_drop_in(self):
+        x = ca.SX.sym("x", 3)
+        y = ca.SX.sym("y")
+        eqs = {
+            "norm": ca.Function("f_norm", [x], [ca.norm_2(x)], ["x"], ["n"]),
+            "scale": ca.Function("f_scale", [x, y], [x * y], ["x", "y"], ["z"]),
+        }
+        jit = codegen.compile_and_load(eqs, "test_jit", cache_dir=self.cache_dir)
+        self.assertEqual(jit.keys(), eqs.keys())
+        self.assertEqual(jit["scale"].name_in(), ["x", "y"])
+        np.testing.assert_allclose(jit["norm"]([3, 4, 0]), 5)
+        np.testing.assert_allclose(jit["scale"]([1, 2, 3], 2), [[2], [4], [6]])
+
+        # the library is reused until the functions change
+        codegen.compile_and_load(eqs, "test_jit", cache_dir=self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        eqs["norm"] = ca.Function("f_norm", [x], [ca.norm_1(x)], ["x"], ["n"])
+        codegen.compile_and_load(eqs, "test_jit", cache_dir=self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_benchmark(self):
+        f = algorithms.eqs()["sim"]["simulate"]
+        n = 400
+        f = {"simulate": f.mapaccum("simulate_n", n, [1], [0])}
+        jit = codegen.compile_and_load(f, "test_bench", cache_dir=self.cache_dir)
+        args = [np.linspace(0, 1, n), np.zeros(6), np.ones((3, n)), 1e-5]
+        args += [np.random.randn(3, n), 1.0 / n]
+        np.testing.assert_allclose(
+            jit["simulate"](*args), f["simulate"](*args), atol=1e-12
+        )
+        print("\n\nvm vs compiled, {:d} rk4 steps per call".format(n))
+        print("-" * 30)
+        for label, g in [("vm", f["simulate"]), ("compiled", jit["simulate"])]:
+            start = time.perf_counter()
+            for i in range(20):
+                g(*args)
+            elapsed = (time.perf_counter() - start) / 20
+            print("{:10s}: {:.3g} ms".format(label, 1e3 * elapsed))
+
+
+class Test_GenerateCode(ProfiledTestCase):
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dest_dir = tmp.name
+
+    def test_incremental(self):
+        dest_dir = self.dest_dir
+        eqs = {
+            "rdd2_position": rdd2.derive_position_control(),
+            "rdd2_attitude": rdd2.derive_attitude_control(),
+            "rdd2_common": rdd2.derive_common(),
+        }
+        start = time.perf_counter()
+        manifest = codegen.generate_code(eqs, dest_dir, verbose=False)
+        elapsed = time.perf_counter() - start
+        self.assertEqual(sorted(manifest["changed"]), sorted(eqs.keys()))
+        for unit in manifest["units"].values():
+            for f in unit["files"]:
+                self.assertTrue(os.path.exists(os.path.join(dest_dir, f)))
+
+        # nothing changed
+        start = time.perf_counter()
+        manifest = codegen.generate_code(eqs, dest_dir, verbose=False)
+        elapsed_cached = time.perf_counter() - start
+        self.assertEqual(manifest["changed"], [])
+        print("\ngenerate {:.3f} s, unchanged {:.3f} s".format(elapsed, elapsed_cached))
+
+        # only the changed unit and units with missing files are regenerated
+        x = ca.SX.sym("x")
+        eqs["rdd2_common"] = {"f": ca.Function("f", [x], [x])}
+        os.remove(os.path.join(dest_dir, "rdd2_attitude.c"))
+        manifest = codegen.generate_code(eqs, dest_dir, verbose=False)
+        self.assertEqual(sorted(manifest["changed"]), ["rdd2_attitude", "rdd2_common"])
+
+        # options are part of the hash
+        manifest = codegen.generate_code(eqs, dest_dir, verbose=False, with_mem=True)
+        self.assertEqual(len(manifest["changed"]), 3)
+
+    def test_shared_dir(self):
+        x = ca.SX.sym("x")
+        a = {"a": {"f_a": ca.Function("f_a", [x], [2 * x])}}
+        b = {"b": {"f_b": ca.Function("f_b", [x], [3 * x])}}
+        codegen.generate_code(a, self.dest_dir, verbose=False, benchmark=True)
+        manifest = codegen.generate_code(b, self.dest_dir, verbose=False)
+        self.assertEqual(sorted(manifest["units"].keys()), ["a", "b"])
+        with open(os.path.join(self.dest_dir, codegen.cost_report_file)) as f:
+            self.assertEqual(sorted(json.load(f).keys()), ["a", "b"])
+
+        # the unit of the other call is unchanged, files it no longer
+        # produces are removed
+        manifest = codegen.generate_code(
+            a, self.dest_dir, verbose=False, benchmark=True
+        )
+        self.assertEqual(manifest["changed"], [])
+        self.assertTrue(os.path.exists(os.path.join(self.dest_dir, "a_bench.c")))
+        manifest = codegen.generate_code(a, self.dest_dir, verbose=False)
+        self.assertEqual(manifest["changed"], ["a"])
+        self.assertEqual(manifest["units"]["a"]["files"], ["a.c", "a.h"])
+        self.assertFalse(os.path.exists(os.path.join(self.dest_dir, "a_bench.c")))
+        self.assertIn("b", manifest["units"])
+
+    def test_module(self):
+        dest_dir = self.dest_dir
+        manifest = rdd2.generate_code(
+            rdd2.derive_common(), "rdd2.c", dest_dir, verbose=False
+        )
+        self.assertEqual(manifest["units"]["rdd2"]["files"], ["rdd2.c", "rdd2.h"])
+
+    def test_benchmark(self):
+        dest_dir = self.dest_dir
+        eqs = {
+            "rdd2_attitude": rdd2.derive_attitude_control(),
+            "rdd2_common": rdd2.derive_common(),
+        }
+        manifest = codegen.generate_code(eqs, dest_dir, verbose=False, benchmark=True)
+        self.assertIn(
+            "rdd2_attitude_bench.c", manifest["units"]["rdd2_attitude"]["files"]
+        )
+        print("\n\nnative benchmark")
+        print("-" * 30)
+        for name, eq in eqs.items():
+            results = codegen.run_benchmark(dest_dir, name, n=1000)
+            self.assertEqual(sorted(results.keys()), sorted(eq[k].name() for k in eq))
+            for f_name, r in results.items():
+                self.assertEqual(r["n"], 1000)
+                self.assertGreater(r["ns_per_call"], 0)
+                print("{:25s}: {:8.1f} ns".format(f_name, r["ns_per_call"]))
+
+        # recorded inputs are part of the hash
+        f = eqs["rdd2_attitude"]["attitude_control"]
+        inputs = {f.name(): [np.ones(f.sparsity_in(i).shape) for i in range(f.n_in())]}
+        manifest = codegen.generate_code(
+            eqs, dest_dir, verbose=False, benchmark=True, bench_inputs=inputs
+        )
+        self.assertEqual(manifest["changed"], ["rdd2_attitude"])
+        with open(os.path.join(dest_dir, "rdd2_attitude_bench.c")) as fp:
+            self.assertIn("= {1.0, 1.0", fp.read())
+
+
+class Test_Bindings(ProfiledTestCase):
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache_dir = tmp.name
+
+    def test_drop_in(self):
+        x = ca.SX.sym("x", 3)
+        W = ca.SX.sym("W", ca.Sparsity.lower(3))
+        y = ca.SX.sym("y")
+        eqs = {
+            "scale": ca.Function(
+                "f_scale", [x, y], [x * y, ca.sum1(x)], ["x", "y"], ["z", "s"]
+            ),
+            "tril": ca.Function(
+                "f_tril", [W, x], [W @ x, W * 2], ["W", "x"], ["v", "W2"]
+            ),
+        }
+        bind = codegen.load_bindings(eqs, "test_bind", cache_dir=self.cache_dir)
+        z, s = bind["scale"]([1, 2, 3], 2)
+        np.testing.assert_allclose(z, [[2], [4], [6]])
+        np.testing.assert_allclose(s, [[6]])
+        self.assertEqual(bind["scale"](x=np.ones((3, 1)), y=3)["z"].shape, (3, 1))
+
+        # sparse inputs take a dense matrix or the nonzeros, sparse outputs
+        # are dense matrices
+        A = np.tril(np.arange(1.0, 10.0).reshape(3, 3))
+        v, W2 = bind["tril"](A, [1, 1, 1])
+        v_vm, W2_vm = eqs["tril"](A, [1, 1, 1])
+        np.testing.assert_allclose(v, v_vm)
+        np.testing.assert_allclose(W2, W2_vm)
+        v, W2_nz = bind["tril"](A.T[np.triu_indices(3)], [1, 1, 1])
+        np.testing.assert_allclose(W2_nz, W2_vm)
+
+        # outputs are the preallocated buffers
+        z1, s1 = bind["scale"]([1, 1, 1], 1)
+        self.assertIs(z1, z)
+        np.testing.assert_allclose(z, np.ones((3, 1)))
+
+    def test_shapes(self):
+        x = ca.SX.sym("x", 3)
+        A = ca.SX.sym("A", 2, 3)
+        W = ca.SX.sym("W", ca.Sparsity.lower(3))
+        eqs = {
+            "f": ca.Function(
+                "f_shapes", [x, A, W], [A @ x, W @ x], ["x", "A", "W"], ["y", "w"]
+            ),
+        }
+        bind = codegen.load_bindings(eqs, "test_shapes", cache_dir=self.cache_dir)
+        f, g = eqs["f"], bind["f"]
+        rng = np.random.default_rng(0)
+        A = rng.uniform(-1, 1, (2, 3))
+        W = np.tril(rng.uniform(-1, 1, (3, 3)))
+
+        # row and column vectors, as casadi accepts either for a vector input
+        for x in [np.array([[1.0, 2.0, 3.0]]), np.array([[1.0], [2.0], [3.0]])]:
+            for y, y_vm in zip(g(x, A, W), f(x, A, W)):
+                np.testing.assert_allclose(y, y_vm)
+
+        # a 1 x 1 arg fills the input
+        for y, y_vm in zip(g(np.ones((1, 1)), 2 * np.ones((1, 1)), W), f(1, 2, W)):
+            np.testing.assert_allclose(y, y_vm)
+
+        # a matrix is not reshaped
+        with self.assertRaises(ValueError):
+            g([1, 2, 3], A.T, W)
+
+    def test_speed(self):
+        eqs = rdd2.derive_position_control()
+        bind = codegen.load_bindings(eqs, "test_rdd2", cache_dir=self.cache_dir)
+        f = eqs["position_control"]
+        rng = np.random.default_rng(0)
+        args = [rng.uniform(-1, 1, f.sparsity_in(i).shape) for i in range(f.n_in())]
+        for y, y_vm in zip(bind["position_control"](*args), f(*args)):
+            np.testing.assert_allclose(y, y_vm, atol=1e-12)
+        print("\n\nvm vs bindings, position_control")
+        print("-" * 30)
+        for label, g in [("vm", f), ("bindings", bind["position_control"])]:
+            start = time.perf_counter()
+            for i in range(1000):
+                g(*args)
+            elapsed = (time.perf_counter() - start) / 1000
+            print("{:10s}: {:.3g} us".format(label, 1e6 * elapsed))
+
+
+class Test_CostReport(ProfiledTestCase):
+    def test_count(self):
+        x = ca.SX.sym("x", 2)
+        f = ca.Function("f", [x], [ca.sin(x[0]) * ca.sqrt(x[1]) + ca.cos(x[1])])
+        cost = codegen.function_cost(f)
+        self.assertEqual(cost["ops"]["sin"], 1)
+        self.assertEqual(cost["trig"], 2)
+        self.assertEqual(cost["sqrt"], 1)
+        self.assertEqual(cost["flops"], 5)
+        self.assertEqual(cost["sz_w"], f.sz_w())
+        self.assertEqual(cost["stack"], 8 * f.sz_w())
+        self.assertEqual(cost["stack_avoid_stack"], 0)
+
+        # the estimate follows the locals declared by the generated code
+        for avoid_stack in [False, True]:
+            gen = ca.CodeGenerator("f.c", {"avoid_stack": avoid_stack})
+            gen.add(f)
+            with tempfile.TemporaryDirectory() as dest_dir:
+                gen.generate(dest_dir + os.sep)
+                with open(os.path.join(dest_dir, "f.c")) as fp:
+                    source = fp.read()
+            body = source[source.index("static int casadi_f0") :]
+            body = body[: body.index("return 0;")]
+            n_locals = sum(
+                line.count(",") + 1
+                for line in body.splitlines()
+                if line.strip().startswith("casadi_real a")
+            )
+            key = "stack_avoid_stack" if avoid_stack else "stack"
+            self.assertEqual(8 * n_locals, cost[key])
+
+        # mx functions are expanded
+        y = ca.MX.sym("y", 2)
+        g = ca.Function("g", [y], [f(y) * 2])
+        self.assertEqual(codegen.function_cost(g)["flops"], 6)
+
+    def test_stack_call(self):
+        x = ca.SX.sym("x", 2)
+        f = ca.Function("f", [x], [ca.sin(x[0]) * ca.sqrt(x[1]) + ca.cos(x[1])])
+        y = ca.MX.sym("y", 2)
+        h = ca.Function("h", [y], [f(y) * 2 + f(2 * y)])
+        cost = codegen.function_cost(h)
+        # h declares a loop counter, 2 scalars and 5 pointers, the frame of
+        # the call to f adds its 3 locals unless avoid_stack
+        self.assertEqual(cost["stack_avoid_stack"], 8 + 2 * 8 + 5 * 8)
+        self.assertEqual(cost["stack"], cost["stack_avoid_stack"] + 3 * 8)
+        cost = codegen.function_cost(h, real_size=4)
+        self.assertEqual(cost["stack"], 8 + 2 * 4 + 5 * 8 + 3 * 4)
+
+    def test_baseline(self):
+        with tempfile.TemporaryDirectory() as dest_dir:
+            x = ca.SX.sym("x")
+            eqs = {"unit": {"f": ca.Function("f", [x], [ca.sin(x)])}}
+            codegen.generate_code(eqs, dest_dir, verbose=False)
+            baseline = os.path.join(dest_dir, "baseline.json")
+            os.rename(os.path.join(dest_dir, codegen.cost_report_file), baseline)
+            eqs = {"unit": {"f": ca.Function("f", [x], [ca.sin(x) + ca.cos(x)])}}
+            manifest = codegen.generate_code(
+                eqs, dest_dir, verbose=False, baseline=baseline
+            )
+            metrics = [r[2] for r in manifest["regressions"]]
+            self.assertIn("trig", metrics)
+            self.assertIn("flops", metrics)
+            self.assertNotIn("sqrt", metrics)
+
+
+class Test_Float32(ProfiledTestCase):
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache_dir = tmp.name
+
+    def test_generate(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        dest_dir = tmp.name
+        eqs = {"rdd2_attitude": rdd2.derive_attitude_control()}
+        manifest = codegen.generate_code(
+            eqs, dest_dir, verbose=False, casadi_real="float"
+        )
+        self.assertEqual(manifest["options"]["casadi_real"], "float")
+        with open(os.path.join(dest_dir, "rdd2_attitude.c")) as f:
+            source = f.read()
+        self.assertIn("#define casadi_real float", source)
+        self.assertIn("#include <tgmath.h>", source)
+        with open(os.path.join(dest_dir, codegen.cost_report_file)) as f:
+            report = json.load(f)["rdd2_attitude"]
+        for f_name, cost in report.items():
+            f = eqs["rdd2_attitude"][f_name]
+            self.assertEqual(cost["stack"], codegen.stack_estimate(f, False, 4))
+            self.assertLess(cost["stack"], codegen.stack_estimate(f, False, 8))
+        subprocess.run(
+            ["gcc", "-c", "-Wall", "-Werror", "rdd2_attitude.c", "-o", "a.o"],
+            cwd=dest_dir,
+            check=True,
+        )
+
+    def test_controller(self):
+        eqs = rdd2.derive_attitude_control()
+        rng = np.random.default_rng(0)
+        samples = {}
+        for k, f in eqs.items():
+            samples[k] = [
+                tuple(
+                    rng.uniform(-1, 1, f.sparsity_in(i).shape) for i in range(f.n_in())
+                )
+                for j in range(20)
+            ]
+        report = codegen.float32_divergence(eqs, samples, cache_dir=self.cache_dir)
+        self.assertEqual(report.keys(), eqs.keys())
+        for k, outputs in report.items():
+            for name, err in outputs.items():
+                self.assertLessEqual(err["rms"], err["max"])
+                self.assertLess(err["max"], 1e-3, (k, name))
+
+    def test_estimator(self):
+        from cyecca.estimate.attitude.estimator import AttitudeEstimator
+        from cyecca.estimate.attitude.simulator import Simulator
+        from cyecca.sim import uros
+
+        eqs = algorithms.eqs(["sim", "mrp"])
+        mrp, samples = codegen.record_inputs(eqs["mrp"])
+        core = uros.Core()
+        Simulator(core, {"sim": eqs["sim"]}, [0.1, 0.2, 0.3, 0, 0, 0], seed=0)
+        AttitudeEstimator(core, "mrp", mrp, False)
+        core.init_params()
+        core.run(until=0.5)
+        self.assertGreater(len(samples["predict"]), 0)
+
+        # the float64 build matches the casadi virtual machine
+        lib = codegen.compile_library(eqs["mrp"], "mrp64", cache_dir=self.cache_dir)
+        f = codegen.CFunction(lib, eqs["mrp"]["predict"])
+        args = samples["predict"][-1]
+        for y, y_vm in zip(f(*args), eqs["mrp"]["predict"](*args)):
+            np.testing.assert_allclose(y, y_vm, atol=1e-12)
+
+        report = codegen.float32_divergence(
+            eqs["mrp"], samples, cache_dir=self.cache_dir
+        )
+        print("\n\nfloat32 vs float64 divergence, mrp estimator")
+        print("-" * 50)
+        for k, outputs in report.items():
+            for name, err in outputs.items():
+                print(
+                    "{:15s} {:12s} max {:8.2e} rms {:8.2e}".format(
+                        k, name, err["max"], err["rms"]
+                    )
+                )
+        self.assertLess(report["predict"]["x1"]["max"], 1e-4)